@@ -0,0 +1,21 @@
+import multiprocessing, os
+
+# gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Every worker opens the cached .idx files memory-mapped, so the index pages are
+# shared through the OS page cache rather than copied per process. Sessions and
+# upload jobs live in SESSION_DB (SQLite), which all workers share.
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 4))
+# building an index from a large PGN can take minutes
+timeout = int(os.environ.get('WORKER_TIMEOUT', 600))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+forwarded_allow_ips = os.environ.get('FORWARDED_ALLOW_IPS', '127.0.0.1')
+accesslog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'warning').lower()
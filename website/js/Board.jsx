@@ -18,7 +18,7 @@ import ExpandMore from '@material-ui/icons/ExpandMore';
 const axios = require('axios').default;
 const fs = require('fs').default;
 
-const HOST = 'http://' + window.location.host;
+const HOST = window.location.origin;
 
 import { makeStyles } from "@material-ui/core/styles";
 
@@ -51,7 +51,7 @@ export const Board = function(props) {
         },
       });
     const classes = useStyles();
-    const { onChange, sessionID, PGN } = props;
+    const { onChange, sessionID, PGN, eloRange } = props;
 
     const [state, setState] = React.useState({
         nextMovesLoading: false,
@@ -60,7 +60,10 @@ export const Board = function(props) {
         nextMoves: [],
         firstMove: "",
         history: [],
+        curGamesCount: 0,
         curGames: [],
+        curGamesCursor: null,
+        curGamePGN: "",
     });
 
     const {
@@ -70,17 +73,46 @@ export const Board = function(props) {
         nextMoves,
         firstMove,
         history,
+        curGamesCount,
         curGames,
+        curGamesCursor,
+        curGamePGN,
     } = state;
 
+    const params = {
+        headers: {'Content-Type': 'application/json'}
+    };
+
+    // games ending at the position come a page at a time; `append` keeps the pages already shown
+    var getCurGames = function(cursor, append) {
+        const action = 'list-games';
+        const json = JSON.stringify({ sessionID, action, cursor });
+        axios.post(HOST + '/api/analysis', json, params)
+            .then(response => {
+                setState(prevState => {
+                    return {
+                        ...prevState,
+                        curGames: append ? prevState.curGames.concat(response.data.games) : response.data.games,
+                        curGamesCursor: response.data.nextCursor,
+                    };
+                });
+        });
+    };
+
+    var getGamePGN = function(row) {
+        const action = 'get-game-pgn';
+        const json = JSON.stringify({ sessionID, action, row });
+        axios.post(HOST + '/api/analysis', json, params)
+            .then(response => {
+                setState(prevState => { return { ...prevState, curGamePGN: response.data.pgn }; });
+        });
+    };
+
     var getNextMoves = function(moves) {
         
         const action = 'get-moves';
-        const json = JSON.stringify({ sessionID, action, moves });
+        const json = JSON.stringify({ sessionID, action, moves, eloRange });
         console.log(sessionID, action, moves);
-        const params = {
-            headers: {'Content-Type': 'application/json'}
-        };
         setState(prevState => { return { ...prevState, nextMovesLoading: true }; });
         axios.post(HOST + '/api/analysis', json, params)
             .then(response => {
@@ -98,9 +130,15 @@ export const Board = function(props) {
                             ...prevState,
                             nextMoves: response.data.nextMoves,
                             firstMove: response.data.nextMoves[0],
-                            curGames: response.data.curGames,
+                            curGamesCount: response.data.curGamesCount,
+                            curGames: [],
+                            curGamesCursor: null,
+                            curGamePGN: "",
                         };
                     });
+                    if (response.data.curGamesCursor) {
+                        getCurGames(response.data.curGamesCursor, false);
+                    }
                 }
         });
     };
@@ -111,6 +149,15 @@ export const Board = function(props) {
         setState(prevState => { return { ...prevState, history: newHistory }; });
         getNextMoves(newHistory);
     }, []);
+
+    // re-query the current position when the Elo range changes (the first render is handled above)
+    const eloRangeSet = React.useRef(false);
+    useEffect(() => {
+        if (eloRangeSet.current) {
+            getNextMoves(history);
+        }
+        eloRangeSet.current = true;
+    }, [eloRange]);
     
     var handleMove = function(nextMove) {
 
@@ -186,7 +233,19 @@ export const Board = function(props) {
                     <Collapse in={nextMovesExpanded} timeout="auto">
                         <List>
                             {nextMoves === undefined ? '' : nextMoves.map(move => <ListItem><MoveButton move={move} /></ListItem>)}
-                            {curGames === undefined ? '' : curGames.map(game => <ListItem>{JSON.stringify(game)}</ListItem>)}
+                            {curGames.map(game =>
+                                <ListItem key={game.row} button onClick={() => {getGamePGN(game.row);}}>
+                                    <ListItemText>
+                                        {game.White} ({game.WhiteElo}) - {game.Black} ({game.BlackElo}) {game.Result} {game.Date}
+                                    </ListItemText>
+                                </ListItem>)}
+                            {curGamesCursor ?
+                                <ListItem>
+                                    <Button onClick={() => {getCurGames(curGamesCursor, true);}}>
+                                        More games ({curGames.length} of {curGamesCount})
+                                    </Button>
+                                </ListItem> : ''}
+                            {curGamePGN ? <ListItem><pre>{curGamePGN}</pre></ListItem> : ''}
                         </List>
                     </Collapse>
                 </List>
@@ -9,7 +9,8 @@ import Button from "@material-ui/core/Button";
 const LOWER = 0;
 const UPPER = 3500;
 const STEP = 100;
-const DEFAULT_RANGE = [1400, 3500];
+// the whole slider, which filters nothing (games with unknown Elo included) until it is moved
+const DEFAULT_RANGE = [LOWER, UPPER];
 
 const useStyles = makeStyles({
   root: {
@@ -40,9 +41,9 @@ const cleanValue = function (value) {
   return newValue;
 };
 
-function InputSlider(props) {
+export function InputSlider(props) {
   const classes = useStyles();
-  const [value, setValue] = React.useState(DEFAULT_RANGE);
+  const [value, setValue] = React.useState(props.value || DEFAULT_RANGE);
 
   const callback = function (value) {
     if (typeof props.callback === "function") {
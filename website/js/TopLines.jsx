@@ -25,7 +25,7 @@ import { Board } from '../js/Board.jsx';
 const axios = require('axios').default;
 const fs = require('fs').default;
 
-const HOST = 'http://' + window.location.host;
+const HOST = window.location.origin;
 
 
 export const TopLines = function(props) {
@@ -77,7 +77,7 @@ export const TopLines = function(props) {
     });
     const classes = useStyles();
 
-    const { sessionID, moves } = props;
+    const { sessionID, moves, eloRange } = props;
 
     const [topLines, setTopLines] = React.useState([]);
     const [topLinesLoading, setTopLinesLoading] = React.useState(false);
@@ -93,7 +93,7 @@ export const TopLines = function(props) {
         const quantity = parseInt(data.TopLinesQuantity.value);
 
         const action = 'top-lines';
-        const json = JSON.stringify({ sessionID, action, moves, depth, quantity });
+        const json = JSON.stringify({ sessionID, action, moves, depth, quantity, eloRange });
         console.log(sessionID, action, moves, depth);
         const params = {
             headers: {'Content-Type': 'application/json'}
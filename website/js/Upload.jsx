@@ -3,8 +3,6 @@ import ReactDOM from 'react-dom';
 import Form from 'react-bootstrap/Form';
 import Button from 'react-bootstrap/Button';
 import Spinner from 'react-bootstrap/Spinner';
-import Dropdown from 'react-dropdown';
-import 'react-dropdown/style.css';
 import Row from 'react-bootstrap/Row';
 import Col from 'react-bootstrap/Col';
 import 'bootstrap/dist/css/bootstrap.min.css';
@@ -22,7 +20,8 @@ import ExpandMore from '@material-ui/icons/ExpandMore';
 const axios = require('axios').default;
 const fs = require('fs').default;
 
-const HOST = 'http://' + window.location.host;
+const HOST = window.location.origin;
+const UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024;
 
 import { makeStyles } from "@material-ui/core/styles";
 
@@ -49,8 +48,9 @@ export const Upload = function(props) {
 
         PGN: "",
         PGNUploaded: false,
+        uploadedPGNFile: null,
         uploadedPGNFilename: null,
-        cachedPGNFilename: null,
+        selectedPGNFilenames: [],
         cachedPGNFilenames: [],
         PGNLoading: false,
         cachedPGNLoading: false,
@@ -65,8 +65,9 @@ export const Upload = function(props) {
         sessionID,
         PGN,
         PGNUploaded,
+        uploadedPGNFile,
         uploadedPGNFilename,
-        cachedPGNFilename,
+        selectedPGNFilenames,
         cachedPGNFilenames,
         PGNLoading,
         cachedPGNLoading,
@@ -96,10 +97,11 @@ export const Upload = function(props) {
         getCachedPGNIDs();
     }, []);
 
-    var getCachedPGN = function(pgn_filename) {
+    var getCachedPGN = function(cachedPGNFilenames) {
 
+        // several files are loaded as shards of one index
         const action = 'get-cached-pgn';
-        const json = JSON.stringify({ sessionID, action, cachedPGNFilename });
+        const json = JSON.stringify({ sessionID, action, cachedPGNFilenames });
         console.log(sessionID, action);
         const params = {
             headers: {'Content-Type': 'application/json'}
@@ -125,61 +127,89 @@ export const Upload = function(props) {
 
     var uploadFile = function(event) {
         const files = event.target.files;
+        setState({
+            ...state,
+            PGNUploaded: true,
+            uploadedPGNFile: files[0],
+            uploadedPGNFilename: files[0].name,
+        });
+    };
 
-        var read = new FileReader();
-        read.onloadstart = function() {
-            setState({ ...state, PGNLoading: true });
-        };
-        read.onloadend = function(){
-            setState({
-                ...state,
-                PGNLoading: false,
-                PGN: read.result,
-                PGNUploaded: true,
-                uploadedPGNFilename: files[0].name,
-            });
+    var pollJob = function(jobID) {
+        axios.get(HOST + '/api/jobs/' + jobID)
+            .then(response => {
+                const progress = response.data;
+                if (progress.status === 'pending' || progress.status === 'running') {
+                    const eta = progress.eta === null ? '' : `, ~${progress.eta.toFixed(0)}s left`;
+                    setState(prevState => {
+                        return {
+                            ...prevState,
+                            startResponse: `${progress.games} games indexed (${progress.gamesPerSecond.toFixed(0)} games/s${eta})`,
+                        };
+                    });
+                    setTimeout(() => pollJob(jobID), 1000);
+                    return;
+                }
+
+                const loaded = progress.status === 'done';
+                const message = loaded ? `${progress.games} games loaded` : `Indexing failed: ${progress.error}`;
+                setState(prevState => {
+                    return {
+                        ...prevState,
+                        PGNLoading: false,
+                        startResponse: message,
+                        PGNLoaded: loaded,
+                    };
+                });
+                if (loaded) {
+                    onLoad({ PGN: "", message });
+                }
+        });
+    };
+
+    var uploadChunk = function(jobID, file, start) {
+        const end = Math.min(start + UPLOAD_CHUNK_SIZE, file.size);
+        const final = end >= file.size ? '?final=1' : '';
+        const params = {
+            headers: {'Content-Type': 'application/octet-stream'}
         };
-        read.readAsText(files[0]);
+        return axios.put(HOST + '/api/upload/' + jobID + final, file.slice(start, end), params)
+            .then(response => {
+                if (end < file.size) {
+                    return uploadChunk(jobID, file, end);
+                }
+        });
     };
     
     var handleSubmitPGN = function(event) {
         event.preventDefault();
 
-        const form = event.target.elements;
-        const action = 'load';
-
-        const json = JSON.stringify({ sessionID, action, PGN, uploadedPGNFilename });
-        console.log(sessionID, action, PGN, uploadedPGNFilename);
+        const json = JSON.stringify({ sessionID, filename: uploadedPGNFilename, size: uploadedPGNFile.size });
+        console.log(sessionID, 'upload', uploadedPGNFilename);
         const params = {
             headers: {'Content-Type': 'application/json'}
         };
         setState({ ...state, PGNLoading: true });
-        axios.post(HOST + '/api/analysis', json, params)
+        axios.post(HOST + '/api/upload', json, params)
             .then(response => {
-                const data = response.data;
-
-                setState({
-                    ...state,
-                    PGNLoading: false,
-                    startResponse: data.message,
-                    PGNLoaded: true,
-                });
-
-                onLoad(data);
+                const jobID = response.data.jobID;
+                pollJob(jobID);
+                return uploadChunk(jobID, uploadedPGNFile, 0);
         });
     };
 
-    var onDropdownChange = function({value, label}) {
-        console.log(value);
-        setState({ ...state, cachedPGNFilename: value })
+    var onSelectChange = function(event) {
+        const selected = Array.from(event.target.selectedOptions, option => option.value);
+        console.log(selected);
+        setState({ ...state, selectedPGNFilenames: selected })
     }
 
     const onClearClick = function() {
-        setState({ ...state, cachedPGNFilename: null })
+        setState({ ...state, selectedPGNFilenames: [] })
     }
 
     const onLoadCached = function() {
-        getCachedPGN(cachedPGNFilename);
+        getCachedPGN(selectedPGNFilenames);
     }
 
     return (
@@ -206,19 +236,24 @@ export const Upload = function(props) {
 
                 <Col className={classes.cachedPGN}>
                     <Row>
-                        <Dropdown
-                            style={classes.cacheDropdown}
-                            options={cachedPGNFilenames}
-                            onChange={onDropdownChange}
-                            value={cachedPGNFilename}
-                            placeholder="select a cached PGN" />
+                        <Form.Control
+                            as="select"
+                            multiple
+                            htmlSize={6}
+                            className={classes.cacheDropdown}
+                            onChange={onSelectChange}
+                            value={selectedPGNFilenames}>
+                            {cachedPGNFilenames.map(filename => <option key={filename} value={filename}>{filename}</option>)}
+                        </Form.Control>
                         <Button onClick={onClearClick}>Clear</Button>
                         <Spinner hidden={!cachedPGNFilenamesLoading} animation="border" role="status">
                                 <span className="sr-only">Loading...</span>
                             </Spinner>
                     </Row>
                     <Row>
-                        <Button disabled={cachedPGNFilename === null} onClick={onLoadCached} type="submit" variant="primary">Load Cached</Button>
+                        <Button disabled={selectedPGNFilenames.length === 0} onClick={onLoadCached} type="submit" variant="primary">
+                            {selectedPGNFilenames.length > 1 ? `Load ${selectedPGNFilenames.length} as Shards` : 'Load Cached'}
+                        </Button>
                         <Spinner hidden={!cachedPGNLoading} animation="border" role="status">
                             <span className="sr-only">Loading...</span>
                         </Spinner>
@@ -5,6 +5,7 @@ import 'bootstrap/dist/css/bootstrap.min.css';
 import { Upload } from '../js/Upload.jsx';
 import { Board } from '../js/Board.jsx';
 import { TopLines } from '../js/TopLines.jsx';
+import { InputSlider } from '../js/ELOSlider.jsx';
 
 
 import { makeStyles } from "@material-ui/core/styles";
@@ -53,6 +54,7 @@ function AnalysisApp(props) {
     const [PGNLoaded, setPGNLoaded] = React.useState(false);
 
     const [moves, setMoves] = React.useState([]);
+    const [eloRange, setEloRange] = React.useState(null);
 
 
     var onPGNLoad = function(data) {
@@ -76,10 +78,12 @@ function AnalysisApp(props) {
             />
             
             <h3>Step 2 - Find a position</h3>
+            {PGNLoaded ? <InputSlider value={eloRange} callback={setEloRange} /> : null}
             {PGNLoaded ? <Board
                 className={classes.findPosition}
                 sessionID={sessionID}
                 PGN={PGN}
+                eloRange={eloRange}
                 onChange={onBoardChange}
             /> : <div>Not ready</div>}
 
@@ -90,6 +94,7 @@ function AnalysisApp(props) {
                 className={classes.topLineAnalyze}
                 sessionID={sessionID}
                 moves={moves}
+                eloRange={eloRange}
             /> : <div>STILL not ready</div>}
         </div>
     );
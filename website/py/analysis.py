@@ -1,31 +1,72 @@
 from collections import namedtuple
+from heapq import heappush, heappushpop
 
-from .game import build_move_df
-
-def get_top_lines(trie, max_depth=6):
-    
-    Line = namedtuple('Line', ['depth', 'score', 'moves', 'freqs', 'counts'])
-    
-    move_df = build_move_df(trie)
-    counts = move_df['move'].value_counts()
-    frequencies = counts / len(move_df)
-    
-    lines = []
-    for move, sub_trie in trie.items():
-        
-        if max_depth == 1 and move is not None:
-            score = freq = frequencies[move]
-            count = counts[move]
-            lines.append(Line(1, score, [move], [freq], [count]))
-        else:
-            if isinstance(sub_trie, dict):
-                top_sub_lines = get_top_lines(sub_trie, max_depth=max_depth-1)
-                for _, score, sub_line, freqs, counts_ in top_sub_lines:
-                    freq = frequencies[move]
-                    count = counts[move]
-                    score = score * freq
-                    lines.append(Line(len(sub_line)+1, score, [move] + sub_line, [freq] + freqs, [count] + counts_))
-            elif move is None and isinstance(sub_trie, list):
-                lines.append(Line(0, 1, [], [], []))
-                
-    return sorted(lines, reverse=True)
\ No newline at end of file
+from .trie import count_trie
+
+Line = namedtuple('Line', ['depth', 'score', 'moves', 'freqs', 'counts'])
+
+# partial scores are multiplied root first and Line scores leaf first, so bounds allow for rounding
+SCORE_SLACK = 1e-12
+
+def get_child_counts(trie):
+    if hasattr(trie, 'child_stats'):
+        # indexed tries (and the position graph) keep per-node counts, so no games need to be read
+        moves, counts, _ = trie.child_stats()
+        return list(zip(moves, counts.tolist())), trie.count
+    return [(move, count_trie(sub_trie)) for move, sub_trie in trie.items() if move is not None], count_trie(trie)
+
+def make_line(link):
+    # a partial line is a (parent link, move, freq, count) chain, so lines share their prefixes
+    moves, freqs, counts = [], [], []
+    while link is not None:
+        link, move, freq, move_count = link
+        moves.append(move)
+        freqs.append(freq)
+        counts.append(move_count)
+    moves.reverse(), freqs.reverse(), counts.reverse()
+    score = 1
+    for freq in reversed(freqs):
+        score = score * freq
+    return Line(len(moves), score, moves, freqs, counts)
+
+def push_bounded(heap, item, max_items):
+    # keeps the `max_items` largest items pushed (every item without a bound)
+    if not max_items or len(heap) < max_items:
+        heappush(heap, item)
+    else:
+        heappushpop(heap, item)
+
+def extensions(score, link, node):
+    # the node's children as (score, link, node), most probable first; child nodes are made only when visited
+    child_counts, total = get_child_counts(node)
+    for move, move_count in sorted(child_counts, key=lambda child: -child[1]):
+        freq = move_count / total
+        yield score * freq, (link, move, freq, move_count), node[move]
+
+def get_top_lines(trie, max_depth=6, max_lines=None):
+    # Depth-first branch and bound. A line only loses probability as it is extended,
+    # so once `max_lines` full-depth lines are found, a partial line no more probable
+    # than the worst of them is dropped along with its less probable siblings. Only the
+    # siblings along the current path (max_depth x branching) and the best lines so far
+    # are held. Lines cut short by games ending rank after every full-depth line. Lines
+    # are ranked as whole Lines, so equal scores fall back to the moves, as they always have.
+    full, ended = [], []
+    stack = [iter([(1.0, None, trie)])]
+    while stack:
+        if (entry := next(stack[-1], None)) is None:
+            stack.pop()
+            continue
+        score, link, node = entry
+        bounded = max_lines and len(full) == max_lines
+        if bounded and score < full[0].score * (1 - SCORE_SLACK):
+            stack.pop()
+            continue
+        depth = len(stack) - 1
+        if depth == max_depth:
+            push_bounded(full, make_line(link), max_lines)
+            continue
+        if None in node and not bounded:
+            push_bounded(ended, make_line(link), max_lines)
+        stack.append(extensions(score, link, node))
+
+    return (sorted(full, reverse=True) + sorted(ended, reverse=True))[:max_lines]
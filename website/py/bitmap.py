@@ -0,0 +1,278 @@
+import numpy as np
+from .table import StringColumn
+from .utils import build_lock
+
+ARRAY_MAX = 4096
+BITSET_BYTES = 2**16 // 8
+BATCH_PAIRS = 2**24
+
+
+def container_values(container):
+    # low 16 bits of the rows in a container: array containers are sorted uint16, bitsets packed uint8
+    if container.dtype == np.uint8:
+        return np.flatnonzero(np.unpackbits(container, bitorder='little')).astype(np.uint16)
+    return container
+
+def make_container(values):
+    if len(values) <= ARRAY_MAX:
+        return values.astype(np.uint16)
+    bits = np.zeros(2**16, dtype=bool)
+    bits[values] = True
+    return np.packbits(bits, bitorder='little')
+
+def container_len(container):
+    return int(np.unpackbits(container).sum()) if container.dtype == np.uint8 else len(container)
+
+def and_containers(a, b):
+    if a.dtype == np.uint8 and b.dtype == np.uint8:
+        bits = a & b
+        return make_container(container_values(bits)) if container_len(bits) <= ARRAY_MAX else bits
+    if a.dtype == np.uint8:
+        a, b = b, a
+    if b.dtype == np.uint8:
+        return a[np.unpackbits(b, bitorder='little')[a].astype(bool)]
+    return np.intersect1d(a, b, assume_unique=True)
+
+def or_containers(a, b):
+    if a.dtype == np.uint8 and b.dtype == np.uint8:
+        return a | b
+    return make_container(np.union1d(container_values(a), container_values(b)))
+
+
+class Bitmap:
+    # Roaring-style set of game rows: rows are split by their high 16 bits into
+    # containers of low 16 bits, kept as a sorted array while sparse and as a
+    # 2**16-bit bitset once they hold more than ARRAY_MAX rows.
+
+    def __init__(self, highs=(), containers=()):
+        self.highs = np.asarray(highs, dtype=np.uint16)
+        self.containers = list(containers)
+
+    @classmethod
+    def from_rows(cls, rows):
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        highs, starts = np.unique(rows >> 16, return_index=True)
+        ends = np.append(starts[1:], len(rows))
+        return cls(highs, [make_container(rows[start:end] & 0xFFFF) for start, end in zip(starts, ends)])
+
+    def __len__(self):
+        return sum(container_len(container) for container in self.containers)
+
+    def __and__(self, other):
+        highs, i, j = np.intersect1d(self.highs, other.highs, assume_unique=True, return_indices=True)
+        containers = [and_containers(self.containers[a], other.containers[b]) for a, b in zip(i, j)]
+        keep = [k for k, container in enumerate(containers) if len(container)]
+        return Bitmap(highs[keep], [containers[k] for k in keep])
+
+    def __or__(self, other):
+        merged = {}
+        for bitmap in (self, other):
+            for high, container in zip(bitmap.highs.tolist(), bitmap.containers):
+                merged[high] = or_containers(merged[high], container) if high in merged else container
+        highs = sorted(merged)
+        return Bitmap(highs, [merged[high] for high in highs])
+
+    def rows(self):
+        if not self.containers:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([(high << 16) + container_values(container).astype(np.int64)
+                               for high, container in zip(self.highs.tolist(), self.containers)])
+
+    def to_mask(self, n):
+        mask = np.zeros(n, dtype=bool)
+        mask[self.rows()] = True
+        return mask
+
+    def __repr__(self):
+        return f'Bitmap({len(self)} rows in {len(self.containers)} containers)'
+
+
+class BitmapIndex:
+    # Many bitmaps keyed by integers, flattened into arrays that can be saved and
+    # memory-mapped: each key owns a range of containers and each container a range
+    # of `payload` (its uint16 values, or the bitset viewed as uint16 words).
+
+    ARRAYS = ['keys', 'key_offsets', 'highs', 'cardinalities', 'payload_offsets', 'payload']
+
+    def __init__(self, arrays):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, keys, rows):
+        # from (key, row) pairs; duplicates are allowed
+        keys, rows = np.asarray(keys, dtype=np.int64), np.asarray(rows, dtype=np.int64)
+        order = np.lexsort((rows, keys))
+        keys, rows = keys[order], rows[order]
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (rows[1:] != rows[:-1])
+        keys, rows = keys[keep], rows[keep]
+
+        highs = rows >> 16
+        starts = np.ones(len(keys), dtype=bool)
+        starts[1:] = (keys[1:] != keys[:-1]) | (highs[1:] != highs[:-1])
+        starts = np.flatnonzero(starts)
+        cardinalities = np.diff(np.append(starts, len(keys))).astype(np.int32)
+        unique_keys, key_starts = np.unique(keys[starts], return_index=True)
+
+        bitsets = cardinalities > ARRAY_MAX
+        payload_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+        np.cumsum(np.where(bitsets, BITSET_BYTES // 2, cardinalities), out=payload_offsets[1:])
+        payload = np.zeros(payload_offsets[-1], dtype=np.uint16)
+        containers = np.repeat(np.arange(len(starts)), cardinalities)
+        in_array = ~bitsets[containers]
+        destinations = payload_offsets[containers] + np.arange(len(keys)) - starts[containers]
+        payload[destinations[in_array]] = rows[in_array] & 0xFFFF
+        for container in np.flatnonzero(bitsets):
+            values = rows[starts[container]:starts[container] + cardinalities[container]] & 0xFFFF
+            start, end = payload_offsets[container], payload_offsets[container + 1]
+            payload[start:end] = make_container(values).view(np.uint16)
+
+        return cls({
+            'keys': unique_keys,
+            'key_offsets': np.append(key_starts, len(starts)).astype(np.int64),
+            'highs': highs[starts].astype(np.uint16),
+            'cardinalities': cardinalities,
+            'payload_offsets': payload_offsets,
+            'payload': payload,
+        })
+
+    @classmethod
+    def concatenate(cls, indexes):
+        # indexes over disjoint, increasing key ranges
+        container_counts = np.cumsum([0] + [len(index.highs) for index in indexes])
+        payload_sizes = np.cumsum([0] + [len(index.payload) for index in indexes])
+        return cls({
+            'keys': np.concatenate([index.keys for index in indexes]),
+            'key_offsets': np.concatenate([index.key_offsets[:-1] + offset for index, offset in zip(indexes, container_counts)]
+                                          + [container_counts[-1:]]),
+            'highs': np.concatenate([index.highs for index in indexes]),
+            'cardinalities': np.concatenate([index.cardinalities for index in indexes]),
+            'payload_offsets': np.concatenate([index.payload_offsets[:-1] + offset for index, offset in zip(indexes, payload_sizes)]
+                                              + [payload_sizes[-1:]]),
+            'payload': np.concatenate([index.payload for index in indexes]),
+        })
+
+    def __contains__(self, key):
+        return (i := np.searchsorted(self.keys, key)) < len(self.keys) and self.keys[i] == key
+
+    def get(self, key):
+        if key not in self:
+            return Bitmap()
+        i = np.searchsorted(self.keys, key)
+        containers = []
+        for container in range(self.key_offsets[i], self.key_offsets[i + 1]):
+            values = self.payload[self.payload_offsets[container]:self.payload_offsets[container + 1]]
+            containers.append(values.view(np.uint8) if self.cardinalities[container] > ARRAY_MAX else values)
+        return Bitmap(self.highs[self.key_offsets[i]:self.key_offsets[i + 1]], containers)
+
+    def cardinality(self, key):
+        if key not in self:
+            return 0
+        i = np.searchsorted(self.keys, key)
+        return int(self.cardinalities[self.key_offsets[i]:self.key_offsets[i + 1]].sum())
+
+
+def move_pairs(trie):
+    # (move key, row) for every move of every game, where a move's key is
+    # 2 * move id + side (0 for white); nodes contribute all the games below them
+    nodes = np.arange(1, trie.n_nodes)
+    node_keys = trie.node_moves[nodes].astype(np.int64) * 2 + (trie.depths[nodes] + 1) % 2
+    starts = trie.game_offsets[trie.preorder[nodes]]
+    lengths = trie.game_offsets[trie.preorder[nodes] + trie.sizes[nodes]] - starts
+
+    hits = np.arange(len(trie.tail_moves))
+    tail_rows = np.searchsorted(trie.tail_offsets, hits, 'right') - 1
+    plies = trie.depths[trie.game_nodes[tail_rows]] + hits - trie.tail_offsets[tail_rows]
+    tail_keys = trie.tail_moves.astype(np.int64) * 2 + plies % 2
+
+    # batches of whole keys, so each batch is an independent slice of the index
+    n_keys = 2 * len(trie.moves)
+    key_sizes = np.bincount(node_keys, weights=lengths, minlength=n_keys) + np.bincount(tail_keys, minlength=n_keys)
+    batches = ((np.cumsum(key_sizes) - key_sizes) // BATCH_PAIRS).astype(np.int64)
+    node_order, tail_order = np.argsort(node_keys, kind='stable'), np.argsort(tail_keys, kind='stable')
+    node_keys, starts, lengths = node_keys[node_order], starts[node_order], lengths[node_order]
+    tail_keys, tail_rows = tail_keys[tail_order], tail_rows[tail_order]
+
+    for batch in np.unique(batches):
+        low, high = np.searchsorted(batches, batch), np.searchsorted(batches, batch, 'right')
+        n0, n1 = np.searchsorted(node_keys, [low, high])
+        t0, t1 = np.searchsorted(tail_keys, [low, high])
+        batch_lengths = lengths[n0:n1]
+        positions = np.arange(batch_lengths.sum()) + np.repeat(starts[n0:n1] - np.cumsum(batch_lengths) + batch_lengths,
+                                                                batch_lengths)
+        yield (np.concatenate([np.repeat(node_keys[n0:n1], batch_lengths), tail_keys[t0:t1]]),
+               np.concatenate([trie.game_rows[positions], tail_rows[t0:t1]]))
+
+
+class GameBitmaps:
+    # Inverted indexes over game rows: White player -> games, Black player -> games
+    # (keyed by the column's category code) and (move, side) -> games.
+
+    INDEXES = ['white', 'black', 'moves']
+
+    def __init__(self, trie, indexes, n_games):
+        self.trie = trie
+        self.indexes = indexes
+        self.n_games = n_games
+
+    @classmethod
+    def build(cls, trie):
+        if trie.builder:
+            trie.index()
+        indexes = {}
+        for name, key in (('white', 'White'), ('black', 'Black')):
+            codes = column.codes_array() if isinstance(column := trie.games.columns.get(key), StringColumn) else np.array([])
+            rows = np.flatnonzero(codes >= 0)
+            indexes[name] = BitmapIndex.build(codes[rows], rows)
+        parts = [BitmapIndex.build(keys, rows) for keys, rows in move_pairs(trie)]
+        indexes['moves'] = BitmapIndex.concatenate(parts) if parts else BitmapIndex.build([], [])
+        return cls(trie, indexes, trie.n_games)
+
+    def arrays(self):
+        arrays = {'n_games': np.array([self.n_games], dtype=np.int64)}
+        for name, index in self.indexes.items():
+            arrays.update({f'{name}/{array}': getattr(index, array) for array in BitmapIndex.ARRAYS})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, trie, arrays):
+        indexes = {name: BitmapIndex({array: arrays[f'{name}/{array}'] for array in BitmapIndex.ARRAYS})
+                   for name in cls.INDEXES}
+        return cls(trie, indexes, int(arrays['n_games'][0]))
+
+    def player(self, side, name):
+        column = self.trie.games.columns.get('White' if side == 'white' else 'Black')
+        if not isinstance(column, StringColumn) or (code := column.code(str(name))) is None:
+            return Bitmap()
+        return self.indexes[side].get(code)
+
+    def move(self, side, move):
+        if (move_id := self.trie.move_ids.get(move)) is None:
+            return Bitmap()
+        return self.indexes['moves'].get(move_id * 2 + (side == 'black'))
+
+    def select(self, white=None, black=None, white_moves=None, black_moves=None):
+        # rows matching every given condition, intersecting the smallest bitmaps first
+        bitmaps = [self.player(side, name) for side, name in (('white', white), ('black', black)) if name]
+        bitmaps += [self.move(side, move) for side, moves in (('white', white_moves), ('black', black_moves))
+                    for move in moves or ()]
+        if not bitmaps:
+            return None
+        bitmaps.sort(key=len)
+        selected = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            if not selected.containers:
+                break
+            selected = selected & bitmap
+        return selected
+
+
+def get_game_bitmaps(trie):
+    trie = getattr(trie, 'trie', trie)
+    trie = getattr(trie, 'base', trie)
+    if trie.bitmaps is None or trie.bitmaps.n_games != trie.n_games:
+        with build_lock:
+            if trie.bitmaps is None or trie.bitmaps.n_games != trie.n_games:
+                trie.bitmaps = GameBitmaps.build(trie)
+    return trie.bitmaps
@@ -0,0 +1,103 @@
+import hashlib, os
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from .store import save_index, load_index
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# path -> (size, mtime, digest), so an unchanged file is hashed once per process
+file_hashes = {}
+
+def file_hash(filename, chunk_size=2**20):
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    if (cached := file_hashes.get(path)) and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    file_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+
+class IndexCache:
+    # Process-wide LRU of loaded indexes keyed by the PGN's content hash.
+    # Every built index is also written to `cache_dir`, so evicted entries and
+    # restarts reload from disk (memory-mapped) instead of re-parsing the PGN.
+
+    def __init__(self, cache_dir='indexes', max_entries=8, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        # one lock per key being built, so concurrent misses on a key build it once
+        self.build_locks = {}
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+
+    def index_filename(self, key):
+        return self.cache_dir / f'{key}.idx'
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+        if not self.index_filename(key).exists():
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        return self.put(key, load_index(self.index_filename(key)))
+
+    def get_or_build(self, pgn_filename, build_fn, key=None):
+        key = key or file_hash(pgn_filename)
+        if (trie := self.get(key)) is not None:
+            return key, trie
+
+        with self.lock:
+            build_lock = self.build_locks.setdefault(key, Lock())
+        with build_lock:
+            # another thread may have built it while this one waited
+            if (trie := self.get(key)) is None:
+                with self.lock:
+                    self.misses += 1
+                trie = self.add(key, build_fn(pgn_filename))
+        with self.lock:
+            self.build_locks.pop(key, None)
+        return key, trie
+
+    def add(self, key, trie):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        save_index(trie, self.index_filename(key))
+        return self.put(key, load_index(self.index_filename(key)))
+
+    def put(self, key, trie):
+        size = os.path.getsize(self.index_filename(key)) if self.index_filename(key).exists() else 0
+        with self.lock:
+            self.entries[key] = (trie, size)
+            self.entries.move_to_end(key)
+            while len(self.entries) > 1 and (len(self.entries) > self.max_entries or
+                                            (self.max_bytes and self.nbytes() > self.max_bytes)):
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return trie
+
+    def nbytes(self):
+        return sum(size for _, size in self.entries.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.nbytes(),
+                'hits': self.hits,
+                'diskHits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
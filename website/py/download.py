@@ -1,9 +1,20 @@
-import wget, bz2
+import bz2, io, os, shutil, subprocess
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+
+# block-parallel bzip2 decompressors, in order of preference, with how each takes its thread count
+BZIP2_TOOLS = {'lbzip2': '-n {}', 'pbzip2': '-p{}'}
+COPY_BUFFER = 2**22
+
+
+def download(url, filename, overwrite=False, decompress=True, processes=None):
+    import wget
 
-def download(url, filename, overwrite=False):
-    
     if '.pgn' not in filename:
         filename += '.pgn'
         pgn_filename = filename
@@ -13,39 +24,81 @@ def download(url, filename, overwrite=False):
             pgn_filename = filename[:idx]
         else:
             pgn_filename = filename
-            
+
     filename = Path(filename)
     if not filename.exists() or overwrite:
         print(f'Downloading {str(filename)} from {url}')
         filename = wget.download(str(url), str(filename))
         if filename.endswith('.bz2'):
-            filename = bunzip(filename)
+            if not decompress:
+                return filename
+            filename = bunzip(filename, processes=processes)
     else:
         print(f'{str(filename)} already exists. Pass in `overwrite=True` to overwrite it.')
-        
+        if str(filename).endswith('.bz2') and not decompress:
+            return str(filename)
+
     return pgn_filename
 
-def bunzip(filename):
+def bzip2_command(filename=None, processes=None):
+    # decompresses `filename` (or stdin) to stdout, or None when no parallel tool is installed
+    for tool, thread_flag in BZIP2_TOOLS.items():
+        if path := shutil.which(tool):
+            threads = thread_flag.format(processes).split() if processes else []
+            return [path, '-d', '-c', *threads, *([str(filename)] if filename else [])]
+    return None
+
+@contextmanager
+def open_bz2(filename, processes=None):
+    # Binary stream of the decompressed bytes, read a buffer at a time so memory
+    # stays bounded. Uses lbzip2/pbzip2 (decompressing blocks on `processes`
+    # threads) when one is installed, then indexed_bzip2, then single-threaded bz2.
+    if command := bzip2_command(filename, processes):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=COPY_BUFFER)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            # a reader that stops early closes the pipe, and the tool exits on SIGPIPE
+            if (code := process.wait()) > 0:
+                raise OSError(f'{command[0]} failed with exit code {code} on {filename}')
+    elif indexed_bzip2 is not None:
+        with indexed_bzip2.open(str(filename), parallelization=processes or os.cpu_count()) as f_in:
+            yield io.BufferedReader(f_in, COPY_BUFFER)
+    else:
+        with bz2.open(filename, 'rb') as f_in:
+            yield f_in
+
+def bunzip(filename, processes=None):
     zipped_filename = Path(filename)
     unzipped_filename = zipped_filename.with_suffix('')
     with open(unzipped_filename, 'wb') as f_out:
-        with bz2.open(zipped_filename, 'rb') as f_in:
-            f_out.write(f_in.read())
-            print(f"Wrote {str(unzipped_filename)}")
-            return unzipped_filename
+        with open_bz2(zipped_filename, processes) as f_in:
+            shutil.copyfileobj(f_in, f_out, COPY_BUFFER)
+    print(f"Wrote {str(unzipped_filename)}")
+    return unzipped_filename
 
 
 if __name__ == '__main__':
 
-    from sys import argv
     from .utils import sanitize_url
+    import argparse
 
-    if len(argv) < 2:
-        print('Usage:  python download.py PGN_URL')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('PGN_URL', type=str, help="URL of a .pgn or .pgn.bz2 file")
+    parser.add_argument('-j', "--PROCESSES", type=int, help="number of threads to decompress with", default=None)
+    parser.add_argument('-i', "--INDEX_FILENAME", type=str, default=None,
+                        help="stream the decompressed games straight into this .idx instead of writing the .pgn")
+    args = parser.parse_args()
 
-    URL = argv[1]
-        
-    filename = sanitize_url(URL)
-    pgn_filename = download(URL, filename)
-    print()
-    print(pgn_filename)
\ No newline at end of file
+    filename = sanitize_url(args.PGN_URL)
+    if args.INDEX_FILENAME:
+        import logging
+        from .ingest import ingest_files
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        bz2_filename = download(args.PGN_URL, filename, decompress=False)
+        ingest_files(args.INDEX_FILENAME, [bz2_filename], decompress_processes=args.PROCESSES)
+    else:
+        pgn_filename = download(args.PGN_URL, filename, processes=args.PROCESSES)
+        print()
+        print(pgn_filename)
@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+from .index import CompactTrie, RESULTS
+from .positions import PositionIndex
+from .table import StringColumn, ResultColumn
+from .bitmap import get_game_bitmaps
+
+
+def column_equals(games, key, value):
+    if (column := games.columns.get(key)) is None:
+        return np.zeros(games.n_games, dtype=bool)
+    if isinstance(column, StringColumn):
+        if (code := column.code(str(value))) is None:
+            return np.zeros(games.n_games, dtype=bool)
+        return column.codes_array() == code
+    return np.array(column.tolist(), dtype=object) == value
+
+def column_numbers(games, key):
+    # float values with NaN for missing, whatever the column's storage
+    if (column := games.columns.get(key)) is None:
+        return np.full(games.n_games, np.nan)
+    if isinstance(column, StringColumn):
+        return pd.to_numeric(pd.Series(column.series()), errors='coerce').to_numpy(dtype=float)
+    return np.asarray(column.series(), dtype=float)
+
+def result_codes(games):
+    # white/draw/black code per game (-1 otherwise), indexed like the trie's result counts
+    if isinstance(column := games.columns.get('Result'), ResultColumn):
+        codes = column.array().astype(np.int8)
+        return np.where(column.is_missing(codes) | (codes >= len(RESULTS)), -1, codes)
+    results = column.tolist() if column is not None else [None] * games.n_games
+    return np.array([RESULTS.get(result, -1) for result in results], dtype=np.int8)
+
+def date_numbers(games):
+    # YYYYMMDD per game (NaN without a year), unknown months and days counting as 0
+    return column_numbers(games, 'year') * 10000 + np.nan_to_num(column_numbers(games, 'month')) * 100 + \
+           np.nan_to_num(column_numbers(games, 'day'))
+
+def date_key(date, fill):
+    # 'YYYY', 'YYYY.MM' or 'YYYY.MM.DD' as YYYYMMDD, unspecified parts filled with `fill`
+    parts = [int(part) for part in date.split('.')] + [fill] * 2
+    return parts[0] * 10000 + parts[1] * 100 + parts[2]
+
+
+def prefix_mask(trie, moves):
+    mask = np.zeros(trie.n_games, dtype=bool)
+    node = 0
+    for i, move in enumerate(moves):
+        if (child := trie.child(node, move)) is None:
+            break
+        node = child
+    else:
+        mask[trie.subtree_rows(node)] = True
+        return mask
+
+    # the rest of the prefix may be in the tails of games cut off at max_depth
+    if trie.max_depth is not None and trie.depths[node] == trie.max_depth:
+        rest = [trie.move_ids.get(move, -1) for move in moves[i:]]
+        for row in trie.ending_rows(node):
+            tail = trie.tail_moves[trie.tail_offsets[row]:trie.tail_offsets[row + 1]]
+            mask[row] = tail[:len(rest)].tolist() == rest
+    return mask
+
+def filter_mask(trie,
+                white=None,
+                black=None,
+                min_elo=0,
+                max_elo=4000,
+                require_elo=False,
+                moves=None,
+                white_moves=None,
+                black_moves=None,
+                time_control=None,
+                min_date=None,
+                max_date=None):
+    games = trie.games
+    mask = np.ones(trie.n_games, dtype=bool)
+    # players and unordered move sets are intersections of the inverted indexes
+    if white or black or white_moves or black_moves:
+        selected = get_game_bitmaps(trie).select(white, black, white_moves, black_moves)
+        mask &= selected.to_mask(trie.n_games)
+    if require_elo:
+        for key in ('WhiteElo', 'BlackElo'):
+            elos = column_numbers(games, key)
+            mask &= (min_elo < elos) & (elos < max_elo)
+    if time_control:
+        mask &= column_equals(games, 'TimeControl', time_control)
+    if min_date or max_date:
+        dates = date_numbers(games)
+        if min_date:
+            mask &= dates >= date_key(min_date, 0)
+        if max_date:
+            mask &= dates <= date_key(max_date, 99)
+    if moves:
+        mask &= prefix_mask(trie, moves)
+    return mask
+
+
+class FilteredTrie(CompactTrie):
+    # A filtered view of an index: every array is shared with `base` and only a row
+    # mask plus the per-node counts and results it implies are added. Nodes whose
+    # games are all filtered out disappear from the children.
+
+    def __init__(self, base, mask):
+        self.__dict__.update(base.__dict__)
+        self.base = base
+        self.mask = mask
+
+        # selected games in preorder, so a node's count is a difference of prefix sums
+        selected = mask[base.game_rows]
+        codes = result_codes(base.games)[base.game_rows]
+        starts = base.game_offsets[base.preorder]
+        ends = base.game_offsets[base.preorder + base.sizes]
+        prefix = np.zeros(len(selected) + 1, dtype=np.int64)
+        np.cumsum(selected, out=prefix[1:])
+        self.counts = prefix[ends] - prefix[starts]
+        self.results = np.zeros((len(self.counts), len(RESULTS)), dtype=np.int64)
+        for result in range(len(RESULTS)):
+            np.cumsum(selected & (codes == result), out=prefix[1:])
+            self.results[:, result] = prefix[ends] - prefix[starts]
+
+        self.positions = None if base.positions is None else PositionIndex(self, base.positions.keys, base.positions.order)
+        self.graph = None
+        self.histograms = None
+
+    @property
+    def n_selected(self):
+        return int(self.counts[0])
+
+    def child_nodes(self, node):
+        children = super().child_nodes(node)
+        return children[self.counts[children] > 0]
+
+    def subtree_rows(self, node):
+        rows = super().subtree_rows(node)
+        return rows[self.mask[rows]]
+
+    def ending_rows(self, node):
+        rows = super().ending_rows(node)
+        return rows[self.mask[rows]]
+
+    def add_game(self, game):
+        raise TypeError('Filtered views are read-only; add games to the base index')
+
+
+def filter_index(trie, **filters):
+    trie = getattr(trie, 'trie', trie)
+    if trie.builder:
+        trie.index()
+    if isinstance(trie, FilteredTrie):
+        return FilteredTrie(trie.base, trie.mask & filter_mask(trie.base, **filters))
+    return FilteredTrie(trie, filter_mask(trie, **filters))
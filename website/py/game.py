@@ -1,14 +1,25 @@
-from chess import pgn
+from chess import pgn, Board
 import numpy as np
 import pandas as pd
-from collections import defaultdict
+import heapq, io, logging, os, re, textwrap, time
+from collections import defaultdict, deque
+from itertools import chain
+from multiprocessing import Pool
+from .tokenizer import iter_games, SEVEN_TAG_ROSTER
+from .moves import PackedGames
+from .index import TrieNode
 from .trie import get_leaves
-from .utils import EmptyTrieError
+from .utils import EmptyTrieError, round_nearest
+
+logger = logging.getLogger(__name__)
 
 
 def get_avg_elo(game):
-    white_elo = game.headers.get('WhiteElo', '')
-    black_elo = game.headers.get('BlackElo', '')
+    return get_headers_avg_elo(game.headers)
+
+def get_headers_avg_elo(headers):
+    white_elo = headers.get('WhiteElo', '')
+    black_elo = headers.get('BlackElo', '')
     if white_elo and black_elo and \
         not white_elo.endswith('?') and not black_elo.endswith('?'):
         
@@ -47,37 +58,247 @@ def get_moves_generator(game):
     for move in game.mainline():
         yield move.san()
 
+def get_game_dict(game):
+    return make_game_dict(game.headers, get_moves(game))
+
+def make_game_dict(headers, moves):
+    game_dict = dict(headers)
+    game_dict['moves'] = moves
+    if (date := game_dict.get('UTCDate', None)) or (date := game_dict.get('Date', None)):
+        year, month, day = date.split('.')
+        game_dict['year'] = int(year) if '?' not in year else None
+        game_dict['month'] = int(month) if '?' not in month else 0
+        game_dict['day'] = int(day) if '?' not in day else 0
+    game_dict['avg_elo'] = get_headers_avg_elo(headers)
+    return game_dict
+
+DERIVED_FIELDS = {'moves', 'year', 'month', 'day', 'avg_elo'}
+
+def escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def make_pgn(game_dict):
+    # PGN text for a game dict (or indexed game record): the seven tag roster first, then the other headers
+    headers = {key: value for key, value in game_dict.items() if key not in DERIVED_FIELDS and value is not None}
+    keys = [key for key in SEVEN_TAG_ROSTER if key in headers] + [key for key in headers if key not in SEVEN_TAG_ROSTER]
+    tags = [f'[{key} "{escape_tag(headers[key])}"]' for key in keys]
+    moves = game_dict['moves']
+    tokens = [f'{i // 2 + 1}. {move}' if i % 2 == 0 else move for i, move in enumerate(moves)]
+    movetext = textwrap.fill(' '.join(tokens + [headers.get('Result', '*')]), width=80)
+    return '\n'.join(tags) + '\n\n' + movetext + '\n'
+
+def validate_moves(moves, fen=None):
+    board = Board(fen) if fen else Board()
+    for move in moves:
+        board.push_san(move)
+
+TAG_LINE = re.compile(rb'^\[\w+ "')
+GAME_BOUNDARY = re.compile(rb'\n[ \t\r]*\n(?=\[\w+ ")')
+
+def get_pgn_chunks(filename, chunk_size=2**24, start=0, end=None):
+    # byte ranges of roughly `chunk_size` within [start, end) that start and end on game boundaries
+    end = os.path.getsize(filename) if end is None else end
+    with open(filename, 'rb') as pgn_file:
+        while start < end:
+            pgn_file.seek(min(start + chunk_size, end))
+            pgn_file.readline()
+            chunk_end, prev_blank = end, False
+            while pgn_file.tell() < end:
+                line = pgn_file.readline()
+                if prev_blank and TAG_LINE.match(line):
+                    chunk_end = pgn_file.tell() - len(line)
+                    break
+                prev_blank = not line.strip()
+            yield start, chunk_end
+            start = chunk_end
+
+def get_stream_chunks(stream, chunk_size=2**24):
+    # roughly `chunk_size` blocks of a binary PGN stream that end on game boundaries
+    rest = b''
+    while block := stream.read(chunk_size):
+        data = rest + block
+        if not (boundaries := list(GAME_BOUNDARY.finditer(data, max(0, len(rest) - 16)))):
+            rest = data
+            continue
+        split = boundaries[-1].end()
+        yield data[:split]
+        rest = data[split:]
+    if rest.strip():
+        yield rest
+
+def game_spans(data):
+    # (start, end) of each game in a game-aligned chunk of PGN bytes, found without parsing any of them
+    starts = [0, *(match.end() for match in GAME_BOUNDARY.finditer(data))]
+    return list(zip(starts, starts[1:] + [len(data)]))
+
+def chunk_seed(seed, offset):
+    # Each chunk samples with its own generator, seeded by the chunk's byte offset,
+    # so a seeded sample is the same however the chunks are spread over processes
+    return None if seed is None else [seed, offset]
+
+def sample_pgn_bytes(data, sample, seed=None):
+    # keeps each game with probability `sample`; the others are cut out before anything is decoded or parsed
+    spans = game_spans(data)
+    keep = np.random.default_rng(seed).random(len(spans)) < sample
+    return b''.join(data[start:end] for (start, end), kept in zip(spans, keep) if kept)
+
+def parse_pgn_chunk(args):
+    filename, start, end, sample, fast, validate, seed = args
+    with open(filename, 'rb') as pgn_file:
+        pgn_file.seek(start)
+        data = pgn_file.read(end - start)
+
+    return parse_pgn_bytes((data, sample, fast, validate, chunk_seed(seed, start)))
+
+def parse_pgn_bytes(args):
+    # a chunk's games with their moves packed against the chunk's own vocabulary
+    data, sample, fast, validate, seed = args
+    if sample < 1.0:
+        data = sample_pgn_bytes(data, sample, seed)
+    return PackedGames.from_game_dicts(list(read_game_dicts(io.StringIO(data.decode('ISO-8859-1')), fast, validate)))
+
+def read_game_dicts(pgn_file, fast=False, validate=False):
+    if fast:
+        yield from read_fast_game_dicts(pgn_file, validate)
+        return
+
+    game = pgn.read_game(pgn_file)
+    while game:
+        try:
+            yield get_game_dict(game)
+        except ValueError as err:
+            logger.warning(err)
+        game = pgn.read_game(pgn_file)
+
+def read_fast_game_dicts(pgn_file, validate=False):
+    # headers and mainline SAN straight from the text; replays the moves only when `validate` is set
+    for headers, moves in iter_games(pgn_file):
+        try:
+            if validate:
+                validate_moves(moves, headers.get('FEN'))
+            yield make_game_dict(headers, moves)
+        except ValueError as err:
+            logger.warning(err)
+
+def reservoir_chunk(args):
+    # the `sample_size` games of a chunk with the smallest random keys, as (key, start, end) file spans
+    filename, start, end, sample_size, seed = args
+    with open(filename, 'rb') as pgn_file:
+        pgn_file.seek(start)
+        spans = game_spans(pgn_file.read(end - start))
+    keys = np.random.default_rng(chunk_seed(seed, start)).random(len(spans))
+    smallest = np.argsort(keys)[:sample_size]
+    return [(keys[i], start + spans[i][0], start + spans[i][1]) for i in smallest.tolist()]
+
+def sample_game_spans(filename, sample_size, seed=None, processes=None, chunk_size=2**24, start=0, end=None):
+    # Bottom-k reservoir sampling: every game gets a uniform random key and the
+    # `sample_size` smallest keys win, which is a uniform sample without replacement.
+    # Chunks only look for game boundaries, so this pass is a scan of the bytes.
+    chunks = ((filename, chunk_start, chunk_end, sample_size, seed)
+              for chunk_start, chunk_end in get_pgn_chunks(filename, chunk_size, start, end))
+    if processes and processes > 1:
+        with Pool(processes) as pool:
+            candidates = list(chain.from_iterable(pool.imap_unordered(reservoir_chunk, chunks)))
+    else:
+        candidates = list(chain.from_iterable(map(reservoir_chunk, chunks)))
+    return sorted((span_start, span_end) for _, span_start, span_end in heapq.nsmallest(sample_size, candidates))
+
+def read_spans(filename, spans, chunk_size=2**24):
+    # the bytes of each (start, end) span, batched into blocks of roughly `chunk_size`
+    with open(filename, 'rb') as pgn_file:
+        batch, size = [], 0
+        for start, end in spans:
+            pgn_file.seek(start)
+            batch.append(pgn_file.read(end - start))
+            if (size := size + end - start) >= chunk_size:
+                yield b''.join(batch)
+                batch, size = [], 0
+        if batch:
+            yield b''.join(batch)
+
 def games_generator_from_file(filename,
                               max_games=None,
                               sample=1.0,
-                              print_every=500):
-    
-    pgn_file = open(filename, encoding='ISO-8859-1')
+                              print_every=500,
+                              processes=None,
+                              ordered=True,
+                              chunk_size=2**24,
+                              fast=False,
+                              validate=False,
+                              start=0,
+                              end=None,
+                              sample_size=None,
+                              seed=None):
+    # `sample` keeps each game with that probability; `sample_size` instead keeps
+    # that many games chosen uniformly from the whole file (in file order). Either
+    # way the skipped games are never parsed, and a `seed` makes the choice repeatable.
+
+    if sample_size is not None:
+        spans = sample_game_spans(filename, sample_size, seed, processes, chunk_size, start, end)
+        games = (game for _, games in parse_pgn_chunks(read_spans(filename, spans, chunk_size), 1.0, processes, fast, validate)
+                 for game in games)
+    elif processes and processes > 1:
+        games = parallel_games_generator(filename, sample, processes, ordered, chunk_size, fast, validate, start, end, seed)
+    else:
+        games = serial_games_generator(filename, sample, fast, validate, start, end, seed, chunk_size)
+    yield from logged_games(games, max_games, print_every)
+
+def games_generator_from_stream(stream, max_games=None, sample=1.0, print_every=500, processes=None, chunk_size=2**24,
+                                fast=False, validate=False, seed=None):
+    # games from a binary PGN stream (e.g. a decompressor's output), never holding
+    # more than a few chunks of it in memory
+    chunks = parse_pgn_chunks(get_stream_chunks(stream, chunk_size), sample, processes, fast, validate, seed=seed)
+    yield from logged_games((game for _, games in chunks for game in games), max_games, print_every)
+
+def logged_games(games, max_games=None, print_every=500):
     count = 0
-    game = pgn.read_game(pgn_file)
-    while game:
-        if np.random.random() < sample:
-            try:
-                game_dict = dict(game.headers)
-                game_dict['moves'] = get_moves(game)
-                if (date := game_dict.get('UTCDate', None)) or (date := game_dict.get('Date', None)):
-                    year, month, day = date.split('.')
-                    game_dict['year'] = int(year) if '?' not in year else None
-                    game_dict['month'] = int(month) if '?' not in month else 0
-                    game_dict['day'] = int(day) if '?' not in day else 0
-                game_dict['avg_elo'] = get_avg_elo(game)
-                yield game_dict
-                
-                if (count % print_every) == 0:
-                    print(count)
-                count += 1
-            except ValueError as err:
-                print(err)
-
-            if max_games and count >= max_games:
-                break
-        
-        game = pgn.read_game(pgn_file)
+    start_t = time.time()
+    for game_dict in games:
+        yield game_dict
+
+        count += 1
+        if (count % print_every) == 0:
+            logger.info(f'{count} ({count / (time.time() - start_t):.1f} games/s)')
+        if max_games and count >= max_games:
+            break
+    games.close()
+
+    elapsed = time.time() - start_t
+    logger.info(f'Parsed {count} games in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.1f} games/s)')
+
+def serial_games_generator(filename, sample=1.0, fast=False, validate=False, start=0, end=None, seed=None, chunk_size=2**24):
+    for chunk_start, chunk_end in get_pgn_chunks(filename, chunk_size, start, end):
+        yield from parse_pgn_chunk((filename, chunk_start, chunk_end, sample, fast, validate, seed))
+
+def parallel_games_generator(filename, sample=1.0, processes=None, ordered=True, chunk_size=2**24, fast=False, validate=False,
+                             start=0, end=None, seed=None):
+    chunks = ((filename, chunk_start, chunk_end, sample, fast, validate, seed)
+              for chunk_start, chunk_end in get_pgn_chunks(filename, chunk_size, start, end))
+    with Pool(processes) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for game_dicts in imap(parse_pgn_chunk, chunks):
+            yield from game_dicts
+
+def parse_pgn_chunks(chunks, sample=1.0, processes=None, fast=False, validate=False, context=None, seed=None, offset=0):
+    # (chunk length, game dicts) for each chunk of PGN bytes, in order. Pool.imap
+    # would read every chunk ahead of the workers, so a bounded number is submitted
+    # and the oldest is waited on before reading more.
+    if not processes or processes < 2:
+        for data in chunks:
+            yield len(data), parse_pgn_bytes((data, sample, fast, validate, chunk_seed(seed, offset)))
+            offset += len(data)
+        return
+    with (context.Pool if context else Pool)(processes) as pool:
+        pending = deque()
+        for data in chunks:
+            pending.append((len(data), pool.apply_async(parse_pgn_bytes, ((data, sample, fast, validate, chunk_seed(seed, offset)),))))
+            offset += len(data)
+            if len(pending) > 2 * processes:
+                n_bytes, result = pending.popleft()
+                yield n_bytes, result.get()
+        while pending:
+            n_bytes, result = pending.popleft()
+            yield n_bytes, result.get()
 
 def get_move_to_games_mapping(trie, elo_min=0, elo_max=float('inf')):
     move_to_games = {}
@@ -98,6 +319,9 @@ def get_FEN_to_games(games):
     return FEN_to_games
 
 def build_move_df(trie, **kwargs):
+    if isinstance(trie, TrieNode):
+        return build_indexed_move_df(trie)
+
     data = []
     move_to_games = get_move_to_games_mapping(trie, *kwargs)
     for move, games in move_to_games.items():
@@ -109,6 +333,18 @@ def build_move_df(trie, **kwargs):
     move_df = pd.DataFrame(data)
     return move_df
 
+def build_indexed_move_df(node):
+    # columns straight from the game table for the rows below each next move; games ending here get a missing move
+    trie = node.trie
+    moves, rows = [], [trie.ending_rows(node.node)]
+    for child in trie.child_nodes(node.node):
+        moves.append(trie.moves[trie.node_moves[child]])
+        rows.append(trie.subtree_rows(child))
+    codes = np.repeat(np.arange(len(rows)), [len(move_rows) for move_rows in rows])
+    move_df = trie.games.frame(np.concatenate(rows))
+    move_df['move'] = np.array([None] + moves, dtype=object)[codes]
+    return move_df
+
 def get_elo_to_move_mapping(trie, bin_width=200):
     elo_to_move = defaultdict(list)
 
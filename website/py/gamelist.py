@@ -0,0 +1,48 @@
+import base64, json
+import numpy as np
+from .filters import column_numbers, date_numbers
+
+SUMMARY_FIELDS = ['White', 'Black', 'WhiteElo', 'BlackElo', 'Result', 'TimeControl', 'Event']
+SORT_KEYS = {
+    'date': date_numbers,
+    'elo': lambda games: column_numbers(games, 'avg_elo'),
+    'white_elo': lambda games: column_numbers(games, 'WhiteElo'),
+    'black_elo': lambda games: column_numbers(games, 'BlackElo'),
+}
+PAGE_SIZE = 20
+
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def line_rows(line_trie, scope='ending'):
+    # rows of the games ending at the line ('ending') or of every game through it ('line')
+    return line_trie.ending_rows() if scope == 'ending' else line_trie.rows()
+
+def sort_rows(trie, rows, sort=None, descending=False):
+    # in index order by default; games missing the sort key go last either way
+    if sort is None:
+        return rows[::-1] if descending else rows
+    if sort not in SORT_KEYS:
+        raise ValueError(f'Unknown sort key {sort}')
+    # a sharded index computes the sort key shard by shard
+    values = (trie.game_values(SORT_KEYS[sort]) if hasattr(trie, 'game_values') else SORT_KEYS[sort](trie.games))[rows]
+    return rows[np.argsort(-values if descending else values, kind='stable')]
+
+def game_summary(trie, row):
+    summary = {'row': int(row)}
+    for key in SUMMARY_FIELDS:
+        summary[key] = trie.games.value(key, row)
+    summary['Date'] = trie.games.value('UTCDate', row) or trie.games.value('Date', row)
+    summary['plies'] = len(trie.game_moves(row))
+    return summary
+
+def list_games(line_trie, scope='ending', sort=None, descending=False, offset=0, limit=PAGE_SIZE):
+    # (total, one page of game summaries)
+    trie = line_trie.trie
+    rows = sort_rows(trie, line_rows(line_trie, scope), sort, descending)
+    return len(rows), [game_summary(trie, row) for row in rows[offset:offset + limit]]
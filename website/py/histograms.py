@@ -0,0 +1,261 @@
+import numpy as np
+from .filters import column_numbers, result_codes
+from .index import TrieNode, RESULT_NAMES
+from .positions import PositionNode, get_position_index
+from .utils import build_lock
+
+ELO_BIN = 100
+N_ELO_BINS = 35
+HISTOGRAM_MIN_GAMES = 2**12
+
+
+class NodeHistograms:
+    # Every game gets an Elo bin (avg_elo in ELO_BIN steps) and a year bin, with bin 0
+    # meaning unknown. Nodes with at least `min_games` games keep a summed-area table
+    # of [games, white, draw, black] over (Elo bin, year bin), so any Elo/year range is
+    # four lookups; smaller nodes are answered by scanning their (contiguous) game rows.
+
+    ARRAYS = ['elo_bins', 'year_bins', 'codes', 'years', 'nodes', 'tables']
+
+    def __init__(self, trie, arrays):
+        self.trie = trie
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.n_games = len(self.codes)
+
+    @classmethod
+    def build(cls, trie, min_games=HISTOGRAM_MIN_GAMES):
+        if trie.builder:
+            trie.index()
+        games = trie.games
+        elos, years = column_numbers(games, 'avg_elo'), column_numbers(games, 'year')
+        elo_bins = np.where(np.isnan(elos), 0, np.clip(np.nan_to_num(elos) // ELO_BIN, 0, N_ELO_BINS - 1) + 1)
+        known_years = years[~np.isnan(years)]
+        first_year, last_year = (int(known_years.min()), int(known_years.max())) if len(known_years) else (0, -1)
+        year_bins = np.where(np.isnan(years), 0, np.nan_to_num(years) - first_year + 1)
+        elo_bins, year_bins = elo_bins.astype(np.int16), year_bins.astype(np.int16)
+        codes = result_codes(games)
+
+        n_years = last_year - first_year + 2
+        cells = (elo_bins.astype(np.int64) * n_years + year_bins)[trie.game_rows]
+        ordered_codes = codes[trie.game_rows]
+        selected = np.ones(len(cells), dtype=bool) if (mask := getattr(trie, 'mask', None)) is None else mask[trie.game_rows]
+
+        nodes = np.flatnonzero(trie.counts >= max(min_games, 1)).astype(np.int32)
+        tables = np.zeros((len(nodes), N_ELO_BINS + 2, n_years + 1, 1 + len(RESULT_NAMES)), dtype=np.int32)
+        for i, node in enumerate(nodes):
+            position = trie.preorder[node]
+            start, end = trie.game_offsets[position], trie.game_offsets[position + trie.sizes[node]]
+            node_cells, node_codes = cells[start:end][selected[start:end]], ordered_codes[start:end][selected[start:end]]
+            for channel, channel_cells in enumerate([node_cells] + [node_cells[node_codes == code] for code in range(3)]):
+                counts = np.bincount(channel_cells, minlength=(N_ELO_BINS + 1) * n_years).reshape(N_ELO_BINS + 1, n_years)
+                tables[i, 1:, 1:, channel] = counts.cumsum(0).cumsum(1)
+
+        return cls(trie, {
+            'elo_bins': elo_bins,
+            'year_bins': year_bins,
+            'codes': codes,
+            'years': np.array([first_year, last_year], dtype=np.int32),
+            'nodes': nodes,
+            'tables': tables,
+        })
+
+    def bin_ranges(self, elo_range=None, date_range=None):
+        # inclusive (elo bin, year bin) bounds; a missing range keeps games with unknown values too
+        elo_bounds = (0, N_ELO_BINS)
+        if elo_range is not None:
+            low, high = elo_range
+            low, high = int(low or 0), int(high or N_ELO_BINS * ELO_BIN)
+            # a range starting at the bottom of the slider keeps games with unknown Elo
+            elo_bounds = (low // ELO_BIN + 1 if low > 0 else 0, min(N_ELO_BINS, -(-high // ELO_BIN)))
+        first_year, last_year = self.years.tolist()
+        year_bounds = (0, last_year - first_year + 1)
+        if date_range is not None:
+            low, high = date_range
+            low, high = int(low or first_year), int(high or last_year)
+            year_bounds = (max(1, low - first_year + 1), min(last_year, high) - first_year + 1)
+        return elo_bounds, year_bounds
+
+    def in_range(self, rows, elo_bounds, year_bounds):
+        elo_bins, year_bins = self.elo_bins[rows], self.year_bins[rows]
+        return (elo_bounds[0] <= elo_bins) & (elo_bins <= elo_bounds[1]) & \
+               (year_bounds[0] <= year_bins) & (year_bins <= year_bounds[1])
+
+    def stats(self, node, elo_bounds, year_bounds):
+        # [games, white, draw, black] below `node` within the bounds
+        (e0, e1), (y0, y1) = elo_bounds, year_bounds
+        if e0 > e1 or y0 > y1:
+            return np.zeros(1 + len(RESULT_NAMES), dtype=np.int64)
+        i = np.searchsorted(self.nodes, node)
+        if i < len(self.nodes) and self.nodes[i] == node:
+            table = self.tables[i]
+            return (table[e1 + 1, y1 + 1] - table[e0, y1 + 1] - table[e1 + 1, y0] + table[e0, y0]).astype(np.int64)
+        rows = self.trie.subtree_rows(node)
+        codes = self.codes[rows][self.in_range(rows, elo_bounds, year_bounds)]
+        return np.concatenate([[len(codes)], np.bincount(codes[codes >= 0], minlength=len(RESULT_NAMES))])
+
+
+def get_histograms(trie):
+    trie = getattr(trie, 'trie', trie)
+    if trie.histograms is None or trie.histograms.n_games != trie.n_games:
+        with build_lock:
+            if trie.histograms is None or trie.histograms.n_games != trie.n_games:
+                trie.histograms = NodeHistograms.build(trie)
+    return trie.histograms
+
+
+class RangedNode(TrieNode):
+    # a TrieNode that only counts games within an Elo and/or year range
+
+    def __init__(self, trie, node, elo_range=None, date_range=None):
+        super().__init__(trie, node)
+        self.elo_range = elo_range
+        self.date_range = date_range
+        self.histograms = get_histograms(trie)
+        self.bounds = self.histograms.bin_ranges(elo_range, date_range)
+        self._stats = None
+
+    def node_stats(self):
+        if self._stats is None:
+            self._stats = self.histograms.stats(self.node, *self.bounds)
+        return self._stats
+
+    def child(self, child):
+        return RangedNode(self.trie, child, self.elo_range, self.date_range)
+
+    @property
+    def count(self):
+        return int(self.node_stats()[0])
+
+    @property
+    def results(self):
+        return dict(zip(RESULT_NAMES, self.node_stats()[1:].tolist()))
+
+    def child_stats(self):
+        children = self.trie.child_nodes(self.node)
+        stats = np.array([self.histograms.stats(child, *self.bounds) for child in children], dtype=np.int64)
+        stats = stats.reshape(len(children), 1 + len(RESULT_NAMES))
+        keep = stats[:, 0] > 0
+        children, stats = children[keep], stats[keep]
+        order = np.argsort(-stats[:, 0], kind='stable')
+        children, stats = children[order], stats[order]
+        return [self.trie.moves[move_id] for move_id in self.trie.node_moves[children]], stats[:, 0], stats[:, 1:]
+
+    def rows(self):
+        rows = self.trie.subtree_rows(self.node)
+        return rows[self.histograms.in_range(rows, *self.bounds)]
+
+    def ending_rows(self):
+        rows = self.trie.ending_rows(self.node)
+        return rows[self.histograms.in_range(rows, *self.bounds)]
+
+    def __getitem__(self, move):
+        if move is None:
+            return super().__getitem__(move)
+        if (child := self.trie.child(self.node, move)) is None or not (node := self.child(child)).count:
+            raise KeyError(move)
+        return node
+
+    def __contains__(self, move):
+        if move is None:
+            return self.ending_count() > 0
+        return (child := self.trie.child(self.node, move)) is not None and self.child(child).count > 0
+
+    def __iter__(self):
+        yield from self.child_stats()[0]
+        if self.ending_count():
+            yield None
+
+    def __len__(self):
+        return len(self.child_stats()[0]) + (self.ending_count() > 0)
+
+    def __repr__(self):
+        return f'RangedNode({self.moves}, count={self.count}, elo={self.elo_range}, years={self.date_range})'
+
+
+class RangedPositionNode(PositionNode):
+    # a PositionNode that only counts games within an Elo and/or year range, summed over
+    # the trie nodes where each move order first reaches the position
+
+    def __init__(self, graph, position, elo_range=None, date_range=None):
+        super().__init__(graph, position)
+        self.elo_range = elo_range
+        self.date_range = date_range
+        self.histograms = get_histograms(graph.trie)
+        self.bounds = self.histograms.bin_ranges(elo_range, date_range)
+        self._stats = None
+
+    def arrivals(self):
+        # nodes at the position that aren't inside the subtree of another one, as in PositionGraph.build
+        trie = self.trie
+        nodes = get_position_index(trie).nodes(self.graph.keys[self.position])
+        nodes = nodes[np.argsort(trie.preorder[nodes], kind='stable')]
+        starts, ends = trie.preorder[nodes], trie.preorder[nodes] + trie.sizes[nodes]
+        return nodes[starts >= np.concatenate([[0], np.maximum.accumulate(ends)[:-1]])]
+
+    def node_stats(self):
+        if self._stats is None:
+            stats = [self.histograms.stats(node, *self.bounds) for node in self.arrivals().tolist()]
+            self._stats = np.sum(stats, axis=0, dtype=np.int64) if stats else np.zeros(1 + len(RESULT_NAMES), dtype=np.int64)
+        return self._stats
+
+    def child(self, position):
+        return RangedPositionNode(self.graph, position, self.elo_range, self.date_range)
+
+    @property
+    def count(self):
+        return int(self.node_stats()[0])
+
+    @property
+    def results(self):
+        return dict(zip(RESULT_NAMES, self.node_stats()[1:].tolist()))
+
+    def child_stats(self):
+        trie = self.trie
+        children = [trie.child_nodes(node) for node in self.arrivals().tolist()]
+        children = np.concatenate(children) if children else np.zeros(0, dtype=np.int32)
+        children = children[self.graph.node_positions[children] >= 0]
+        stats = np.array([self.histograms.stats(child, *self.bounds) for child in children], dtype=np.int64)
+        stats = stats.reshape(len(children), 1 + len(RESULT_NAMES))
+        move_ids, inverse = np.unique(trie.node_moves[children], return_inverse=True)
+        totals = np.zeros((len(move_ids), 1 + len(RESULT_NAMES)), dtype=np.int64)
+        np.add.at(totals, inverse, stats)
+        keep = totals[:, 0] > 0
+        move_ids, totals = move_ids[keep], totals[keep]
+        order = np.argsort(-totals[:, 0], kind='stable')
+        move_ids, totals = move_ids[order], totals[order]
+        return [trie.moves[move_id] for move_id in move_ids], totals[:, 0], totals[:, 1:]
+
+    def rows(self):
+        rows = super().rows()
+        return rows[self.histograms.in_range(rows, *self.bounds)]
+
+    def ending_rows(self):
+        rows = super().ending_rows()
+        return rows[self.histograms.in_range(rows, *self.bounds)]
+
+    def ending_count(self):
+        return len(self.ending_rows())
+
+    def __getitem__(self, move):
+        if move is None:
+            return super().__getitem__(move)
+        if (child := self.graph.child(self.position, move)) is None or not (node := self.child(child)).count:
+            raise KeyError(move)
+        return node
+
+    def __contains__(self, move):
+        if move is None:
+            return self.ending_count() > 0
+        return (child := self.graph.child(self.position, move)) is not None and self.child(child).count > 0
+
+    def __iter__(self):
+        yield from self.child_stats()[0]
+        if self.ending_count():
+            yield None
+
+    def __len__(self):
+        return len(self.child_stats()[0]) + (self.ending_count() > 0)
+
+    def __repr__(self):
+        return f'RangedPositionNode({self.graph.keys[self.position]:016x}, count={self.count}, elo={self.elo_range}, years={self.date_range})'
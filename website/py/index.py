@@ -0,0 +1,266 @@
+from array import array
+from collections.abc import Mapping
+import numpy as np
+from .table import GameTable, GameRecord
+from .moves import GameMoves
+
+RESULTS = {'1-0': 0, '1/2-1/2': 1, '0-1': 2}
+RESULT_NAMES = ['white', 'draw', 'black']
+
+
+def to_array(typecode, values):
+    buffer = array(typecode)
+    buffer.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return buffer
+
+
+class TrieBuilder:
+    # growable copies of the node arrays plus the (parent, move id) -> child lookup used while inserting
+
+    def __init__(self, trie):
+        self.parents = to_array('i', trie.parents)
+        self.node_moves = to_array('i', trie.node_moves)
+        self.depths = to_array('i', trie.depths)
+        self.game_nodes = to_array('i', trie.game_nodes)
+        self.tail_offsets = to_array('q', trie.tail_offsets)
+        self.tail_moves = to_array('i', trie.tail_moves)
+        self.counts = to_array('i', trie.counts)
+        self.results = [to_array('i', trie.results[:, i]) for i in range(len(RESULTS))]
+        self.edges = {(parent, move_id): node
+                      for node, (parent, move_id) in enumerate(zip(trie.parents.tolist(), trie.node_moves.tolist()))
+                      if node}
+
+
+class CompactTrie:
+    # Nodes are integer ids into flat arrays and games are row ids into `games`.
+    # After `index()`, a node's subtree is a contiguous range of the preorder,
+    # so the games below it are a contiguous slice of `game_rows`.
+
+    def __init__(self, max_depth=None):
+        self.max_depth = max_depth
+        self.moves = []
+        self.move_ids = {}
+        self.games = GameTable()
+        self.sources = {}
+        self.positions = None
+        self.graph = None
+        self.histograms = None
+        self.bitmaps = None
+        self.parents = np.array([-1], dtype=np.int32)
+        self.node_moves = np.array([-1], dtype=np.int32)
+        self.depths = np.array([0], dtype=np.int32)
+        self.game_nodes = np.array([], dtype=np.int32)
+        self.tail_offsets = np.array([0], dtype=np.int64)
+        self.tail_moves = np.array([], dtype=np.int32)
+        self.counts = np.zeros(1, dtype=np.int32)
+        self.results = np.zeros((1, len(RESULTS)), dtype=np.int32)
+        self.builder = None
+        self.index()
+
+    @property
+    def n_nodes(self):
+        return len(self.builder.parents if self.builder else self.parents)
+
+    @property
+    def n_games(self):
+        return len(self.builder.game_nodes if self.builder else self.game_nodes)
+
+    @property
+    def root(self):
+        return TrieNode(self, 0)
+
+    def intern(self, move):
+        if (move_id := self.move_ids.get(move)) is None:
+            move_id = self.move_ids[move] = len(self.moves)
+            self.moves.append(move)
+        return move_id
+
+    def add_game(self, game):
+        builder = self.builder = self.builder or TrieBuilder(self)
+        moves = game['moves']
+        # packed moves map their batch vocabulary once instead of interning every ply
+        move_ids = moves.ids(self) if isinstance(moves, GameMoves) else [self.intern(move) for move in moves]
+        depth = len(move_ids) if self.max_depth is None else min(len(move_ids), self.max_depth)
+        result_counts = builder.results[result] if (result := RESULTS.get(game.get('Result'))) is not None else None
+
+        node = 0
+        builder.counts[node] += 1
+        if result_counts is not None:
+            result_counts[node] += 1
+        for move_id in move_ids[:depth]:
+            if (child := builder.edges.get((node, move_id))) is None:
+                child = builder.edges[(node, move_id)] = len(builder.parents)
+                builder.parents.append(node)
+                builder.node_moves.append(move_id)
+                builder.depths.append(builder.depths[node] + 1)
+                builder.counts.append(0)
+                for counts in builder.results:
+                    counts.append(0)
+            node = child
+            builder.counts[node] += 1
+            if result_counts is not None:
+                result_counts[node] += 1
+
+        builder.tail_moves.extend(move_ids[depth:])
+        builder.tail_offsets.append(len(builder.tail_moves))
+        builder.game_nodes.append(node)
+        return self.games.append(game)
+
+    def add_games(self, games):
+        for game in games:
+            self.add_game(game)
+        self.index()
+        return self
+
+    def index(self):
+        if builder := self.builder:
+            self.parents = np.frombuffer(builder.parents, dtype=np.int32).copy()
+            self.node_moves = np.frombuffer(builder.node_moves, dtype=np.int32).copy()
+            self.depths = np.frombuffer(builder.depths, dtype=np.int32).copy()
+            self.game_nodes = np.frombuffer(builder.game_nodes, dtype=np.int32).copy()
+            self.tail_offsets = np.frombuffer(builder.tail_offsets, dtype=np.int64).copy()
+            self.tail_moves = np.frombuffer(builder.tail_moves, dtype=np.int32).copy()
+            self.counts = np.frombuffer(builder.counts, dtype=np.int32).copy()
+            self.results = np.stack([np.frombuffer(counts, dtype=np.int32) for counts in builder.results], axis=1)
+            self.builder = None
+
+        n = len(self.parents)
+        parents = self.parents[1:]
+
+        # children grouped by parent, ordered by move id
+        self.children = (np.lexsort((self.node_moves[1:], parents)) + 1).astype(np.int32)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parents, minlength=n), out=self.child_offsets[1:])
+
+        # subtree sizes, accumulated from the deepest level up
+        by_depth = np.argsort(self.depths, kind='stable')
+        level_offsets = np.zeros(self.depths.max() + 2, dtype=np.int64)
+        np.cumsum(np.bincount(self.depths), out=level_offsets[1:])
+        levels = [by_depth[level_offsets[d]:level_offsets[d + 1]] for d in range(len(level_offsets) - 1)]
+        sizes = np.ones(n, dtype=np.int64)
+        for level in reversed(levels[1:]):
+            sizes += np.bincount(self.parents[level], weights=sizes[level], minlength=n).astype(np.int64)
+        self.sizes = sizes
+
+        # preorder position: parent's position + 1 + sizes of the earlier siblings
+        child_sizes = sizes[self.children]
+        before = np.cumsum(child_sizes) - child_sizes
+        sibling_offsets = np.zeros(n, dtype=np.int64)
+        sibling_offsets[self.children] = before - before[self.child_offsets[self.parents[self.children]]]
+        preorder = np.zeros(n, dtype=np.int64)
+        for level in levels[1:]:
+            preorder[level] = preorder[self.parents[level]] + 1 + sibling_offsets[level]
+        self.preorder = preorder
+
+        game_positions = preorder[self.game_nodes]
+        self.game_rows = np.argsort(game_positions, kind='stable').astype(np.int32)
+        self.game_offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(game_positions, minlength=n), out=self.game_offsets[1:])
+        return self
+
+    def child_nodes(self, node):
+        return self.children[self.child_offsets[node]:self.child_offsets[node + 1]]
+
+    def child(self, node, move):
+        if (move_id := self.move_ids.get(move)) is None:
+            return None
+        children = self.child_nodes(node)
+        i = np.searchsorted(self.node_moves[children], move_id)
+        if i < len(children) and self.node_moves[children[i]] == move_id:
+            return int(children[i])
+        return None
+
+    def child_stats(self, node):
+        # (moves, counts, white/draw/black results) of a node's children, most played first
+        children = self.child_nodes(node)
+        order = np.argsort(-self.counts[children], kind='stable')
+        children = children[order]
+        return [self.moves[move_id] for move_id in self.node_moves[children]], self.counts[children], self.results[children]
+
+    def subtree_rows(self, node):
+        position = self.preorder[node]
+        return self.game_rows[self.game_offsets[position]:self.game_offsets[position + self.sizes[node]]]
+
+    def ending_rows(self, node):
+        position = self.preorder[node]
+        return self.game_rows[self.game_offsets[position]:self.game_offsets[position + 1]]
+
+    def path(self, node):
+        move_ids = []
+        while node > 0:
+            move_ids.append(self.node_moves[node])
+            node = self.parents[node]
+        return [self.moves[move_id] for move_id in reversed(move_ids)]
+
+    def game_moves(self, row):
+        tail = self.tail_moves[self.tail_offsets[row]:self.tail_offsets[row + 1]]
+        return self.path(self.game_nodes[row]) + [self.moves[move_id] for move_id in tail]
+
+    def record(self, row):
+        return GameRecord(self, int(row))
+
+
+class TrieNode(Mapping):
+    # dict-like view of one node so code written against nested-dict tries keeps working
+
+    def __init__(self, trie, node):
+        self.trie = trie
+        self.node = node
+
+    @property
+    def count(self):
+        return int(self.trie.counts[self.node])
+
+    @property
+    def results(self):
+        return dict(zip(RESULT_NAMES, self.trie.results[self.node].tolist()))
+
+    @property
+    def moves(self):
+        return self.trie.path(self.node)
+
+    def child_stats(self):
+        return self.trie.child_stats(self.node)
+
+    def rows(self):
+        return self.trie.subtree_rows(self.node)
+
+    def ending_rows(self):
+        return self.trie.ending_rows(self.node)
+
+    def ending_count(self):
+        return len(self.ending_rows())
+
+    def games(self):
+        for row in self.rows():
+            yield self.trie.record(row)
+
+    def __getitem__(self, move):
+        if move is None:
+            if not self.ending_count():
+                raise KeyError(move)
+            return [self.trie.record(row) for row in self.ending_rows()]
+        if (child := self.trie.child(self.node, move)) is None:
+            raise KeyError(move)
+        return TrieNode(self.trie, child)
+
+    def __contains__(self, move):
+        if move is None:
+            return self.ending_count() > 0
+        return self.trie.child(self.node, move) is not None
+
+    def __iter__(self):
+        for child in self.trie.child_nodes(self.node):
+            yield self.trie.moves[self.trie.node_moves[child]]
+        if self.ending_count():
+            yield None
+
+    def __len__(self):
+        return len(self.trie.child_nodes(self.node)) + (self.ending_count() > 0)
+
+    def __repr__(self):
+        return f'TrieNode({self.moves}, count={self.count})'
+
+    def to_dict(self):
+        return {move: [record.copy() for record in sub_trie] if move is None else sub_trie.to_dict()
+                for move, sub_trie in self.items()}
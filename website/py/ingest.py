@@ -0,0 +1,159 @@
+import hashlib, logging, os, re
+from .download import open_bz2
+from .game import games_generator_from_file, games_generator_from_stream
+from .index import CompactTrie
+from .trie import make_game_trie
+
+FINGERPRINT_BYTES = 2**20
+TERMINATION = re.compile(rb'(1-0|0-1|1/2-1/2|\*)\s*$')
+GAME_START = re.compile(rb'\n\s*\n\[')
+
+logger = logging.getLogger(__name__)
+
+
+def range_fingerprint(filename, start, end, n_bytes=FINGERPRINT_BYTES):
+    # hash of the first and last `n_bytes` of [start, end) plus its length; cheap enough to check on every run
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(end - start).encode())
+    with open(filename, 'rb') as pgn_file:
+        pgn_file.seek(start)
+        digest.update(pgn_file.read(min(n_bytes, end - start)))
+        pgn_file.seek(max(start, end - n_bytes))
+        digest.update(pgn_file.read(min(n_bytes, end - start)))
+    return digest.hexdigest()
+
+def complete_end(filename, size, start=0, n_bytes=FINGERPRINT_BYTES):
+    # A file that is still being written may end mid-game; stop before that game so
+    # it is parsed whole next run. The last game start after `start` is searched for
+    # `n_bytes` at a time from the end, and without one nothing past `start` is complete.
+    with open(filename, 'rb') as pgn_file:
+        pgn_file.seek(window_start := max(start, size - n_bytes))
+        window = pgn_file.read(size - window_start)
+        if TERMINATION.search(window):
+            return size
+        while not (starts := list(GAME_START.finditer(window))):
+            if window_start == start:
+                return start
+            # the windows overlap so a game start split between two is still found
+            window_end = min(size, window_start + 64)
+            pgn_file.seek(window_start := max(start, window_start - n_bytes))
+            window = pgn_file.read(window_end - window_start)
+    return window_start + starts[-1].end() - 1
+
+def find_source(trie, filename):
+    # The (key, record) of `filename` in trie.sources. Sources are keyed by path, and
+    # a renamed or moved file is recognised by the fixed prefix its record keeps.
+    key = os.path.abspath(filename)
+    if source := trie.sources.get(key):
+        return key, source
+    for other_key, source in trie.sources.items():
+        if (n_bytes := source.get('prefix_bytes')) and not os.path.exists(source['filename']) and \
+                os.path.getsize(filename) >= n_bytes and range_fingerprint(filename, 0, n_bytes) == source['prefix']:
+            logger.info(f"{filename} was ingested as {source['filename']}")
+            return other_key, source
+    return key, None
+
+def source_record(filename, end, **fields):
+    prefix_bytes = min(FINGERPRINT_BYTES, end)
+    return {
+        'filename': os.path.abspath(filename),
+        'end': end,
+        'fingerprint': range_fingerprint(filename, 0, end),
+        'prefix': range_fingerprint(filename, 0, prefix_bytes),
+        'prefix_bytes': prefix_bytes,
+        **fields,
+    }
+
+
+def append_pgn_file(root, filename, **parse_kwargs):
+    # Adds the games of `filename` that are not yet in the index. Sources are
+    # tracked by the byte range already ingested, so re-running is a no-op and a
+    # file that has grown only has its new bytes parsed.
+    trie = root.trie
+    size = os.path.getsize(filename)
+    key, source = find_source(trie, filename)
+    start = 0
+    if source:
+        start = source['end']
+        if size < start or range_fingerprint(filename, 0, start) != source['fingerprint']:
+            raise ValueError(f'{filename} changed since it was ingested; rebuild the index')
+    if (size := complete_end(filename, size, start)) == start:
+        logger.info(f'{filename} already ingested')
+        return root, 0
+
+    n_games = trie.n_games
+    root = make_game_trie(games_generator_from_file(filename, start=start, end=size, **parse_kwargs), root=root)
+    # a renamed source is keyed by its new path from now on
+    trie.sources.pop(key, None)
+    trie.sources[os.path.abspath(filename)] = source_record(filename, size, ranges=(source['ranges'] if source else []) + [[start, size]])
+    return root, trie.n_games - n_games
+
+def append_bz2_file(root, filename, decompress_processes=None, **parse_kwargs):
+    # Streams the games of a .pgn.bz2 into the index without writing the .pgn.
+    # A compressed source can't be resumed mid-stream, so it is ingested whole, once.
+    trie = root.trie
+    size = os.path.getsize(filename)
+    key, source = find_source(trie, filename)
+    if source:
+        if source['end'] != size or range_fingerprint(filename, 0, size) != source['fingerprint']:
+            raise ValueError(f'{filename} changed since it was ingested; rebuild the index')
+        logger.info(f'{filename} already ingested')
+        return root, 0
+
+    n_games = trie.n_games
+    with open_bz2(filename, decompress_processes) as pgn_stream:
+        root = make_game_trie(games_generator_from_stream(pgn_stream, **parse_kwargs), root=root)
+    trie.sources[os.path.abspath(filename)] = source_record(filename, size, ranges=[[0, size]], compressed=True)
+    return root, trie.n_games - n_games
+
+def append_pgn_files(root, filenames, decompress_processes=None, **parse_kwargs):
+    total = 0
+    for filename in filenames:
+        if filename.endswith('.bz2'):
+            root, n_games = append_bz2_file(root, filename, decompress_processes, **parse_kwargs)
+        else:
+            root, n_games = append_pgn_file(root, filename, **parse_kwargs)
+        logger.info(f'Added {n_games} games from {filename}')
+        total += n_games
+    return root, total
+
+def ingest_files(index_filename, filenames, max_depth=None, **parse_kwargs):
+    from .store import save_index, load_index
+    from .bitmap import get_game_bitmaps
+
+    if os.path.exists(index_filename):
+        root = load_index(index_filename)
+    else:
+        root = CompactTrie(max_depth=max_depth).root
+
+    root, n_games = append_pgn_files(root, filenames, **parse_kwargs)
+    if n_games:
+        # player and move-set inverted indexes are saved with the index
+        get_game_bitmaps(root.trie)
+        print(f"Wrote {save_index(root, index_filename)} ({root.trie.n_games} games)")
+    return root, n_games
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('INDEX_FILENAME', type=str, help="the .idx file to update; created if missing")
+    parser.add_argument('PGN_FILENAMES', type=str, nargs='+', help="the .pgn (or .pgn.bz2, decompressed as a stream) files to add")
+    parser.add_argument('-p', "--PRINT_EVERY", type=int, help="how often to log game number", default=100)
+    parser.add_argument('-j', "--PROCESSES", type=int, help="number of processes to parse with", default=None)
+    parser.add_argument('-f', "--FAST", action='store_true', help="tokenize the movetext instead of replaying each game")
+    parser.add_argument('-v', "--VALIDATE", action='store_true', help="check move legality when using --FAST")
+    parser.add_argument('-d', "--MAX_DEPTH", type=int, help="max trie depth for a new index", default=None)
+    parser.add_argument('-z', "--DECOMPRESS_THREADS", type=int, help="threads for lbzip2/pbzip2 on .bz2 inputs", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    ingest_files(args.INDEX_FILENAME, args.PGN_FILENAMES,
+                 max_depth=args.MAX_DEPTH,
+                 decompress_processes=args.DECOMPRESS_THREADS,
+                 print_every=args.PRINT_EVERY,
+                 processes=args.PROCESSES,
+                 fast=args.FAST,
+                 validate=args.VALIDATE)
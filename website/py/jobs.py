@@ -0,0 +1,261 @@
+import hashlib, io, itertools, logging, os, socket, threading, time, uuid
+from .bitmap import get_game_bitmaps
+from .cache import file_hash
+from .game import read_game_dicts
+from .trie import make_game_trie
+
+PUBLISH_INTERVAL = 0.5
+# an upload that gets no new bytes for this long was abandoned by its client
+UPLOAD_IDLE_TIMEOUT = float(os.environ.get('UPLOAD_IDLE_TIMEOUT', 300))
+MAX_POLL_INTERVAL = 1.0
+# without a shared store, finished jobs are kept this long so their last progress can be polled
+JOB_RETENTION = 300
+# the worker running a job refreshes its heartbeat this often; a job whose heartbeat
+# is older than ORPHAN_TIMEOUT lost its worker (restarted or killed) and is failed
+HEARTBEAT_INTERVAL = 5
+ORPHAN_TIMEOUT = 60
+ACTIVE_STATUSES = ('pending', 'running')
+
+logger = logging.getLogger(__name__)
+
+
+def worker_id():
+    # looked up each time, since workers may be forked after this module is imported
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ChunkReader(io.RawIOBase):
+    # File-like view over an upload that is still being appended to, possibly by
+    # another worker. Reads wait for more bytes until `is_final()` reports that the
+    # last chunk has been written, polling less often the longer they wait, and give
+    # up after `idle_timeout` seconds without new bytes.
+
+    def __init__(self, filename, is_final, poll_interval=0.05, idle_timeout=UPLOAD_IDLE_TIMEOUT):
+        self.filename = filename
+        self.is_final = is_final
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.file = None
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read_available(self, b):
+        if self.file is None:
+            self.file = open(self.filename, 'rb')
+        n = self.file.readinto(b)
+        self.digest.update(memoryview(b)[:n])
+        self.bytes_read += n
+        return n
+
+    def readinto(self, b):
+        idle_t, poll_interval = time.time(), self.poll_interval
+        while not (n := self.read_available(b)):
+            # every byte is on disk before the upload is marked final, so one more read finds the rest
+            if self.is_final():
+                return self.read_available(b)
+            if time.time() - idle_t > self.idle_timeout:
+                raise TimeoutError(f'No upload data for {self.idle_timeout:.0f}s')
+            time.sleep(poll_interval)
+            poll_interval = min(2 * poll_interval, MAX_POLL_INTERVAL)
+        return n
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        super().close()
+
+
+def append_chunk(filename, chunk):
+    with open(filename, 'ab') as part_file:
+        part_file.write(chunk)
+
+def claim_filename(part_filename, filename, key):
+    # Moves a finished upload to `filename`, or to `<name>-1.pgn`, `<name>-2.pgn`, ...
+    # when a different file has that name. Linking fails instead of replacing, so
+    # concurrent uploads of the same name can't overwrite each other either.
+    stem, suffix = os.path.splitext(filename)
+    for n in itertools.count():
+        target = f'{stem}-{n}{suffix}' if n else filename
+        try:
+            os.link(part_filename, target)
+        except FileExistsError:
+            if file_hash(target) != key:
+                continue
+        os.unlink(part_filename)
+        return target
+
+
+class Job:
+    # Runs `work(job)` on a thread, like a pipeline Stage; its return value is the job's result
+
+    def __init__(self, work, total_bytes=None, store=None):
+        self.id = uuid.uuid4().hex
+        self.work = work
+        self.status = 'pending'
+        self.error = None
+        self.games = 0
+        self.bytes_done = 0
+        self.total_bytes = total_bytes
+        self.start_t = self.end_t = None
+        self.result = None
+        self.store = store
+        self.published_t = 0
+
+    def publish(self, force=True, **fields):
+        # progress goes to the shared store so any worker can answer polls for it
+        if self.store is None or not (force or time.time() - self.published_t > PUBLISH_INTERVAL):
+            return
+        self.published_t = time.time()
+        self.store.update_job(self.id, progress=self.progress(), owner=worker_id(), heartbeat=time.time(), **fields)
+
+    def start(self, on_done=None):
+        def target():
+            self.status, self.start_t = 'running', time.time()
+            self.publish()
+            try:
+                self.result = self.work(self)
+                if on_done:
+                    on_done(self)
+                self.status = 'done'
+            except Exception as err:
+                logger.exception(f'job {self.id} failed')
+                self.status, self.error = 'failed', str(err)
+            self.end_t = time.time()
+            self.publish()
+        threading.Thread(target=target, daemon=True).start()
+        return self
+
+    def progress(self):
+        elapsed = ((self.end_t or time.time()) - self.start_t) if self.start_t else 0
+        eta = None
+        if self.status == 'running' and self.total_bytes and self.bytes_done:
+            eta = elapsed * (self.total_bytes - self.bytes_done) / self.bytes_done
+        return {
+            'jobID': self.id,
+            'status': self.status,
+            'error': self.error,
+            'games': self.games,
+            'gamesPerSecond': self.games / elapsed if elapsed else 0,
+            'bytes': self.bytes_done,
+            'totalBytes': self.total_bytes,
+            'elapsed': elapsed,
+            'eta': eta,
+        }
+
+
+class StreamIndexJob(Job):
+    # Builds an index from PGN bytes while they are still being uploaded. Chunks are
+    # appended to `<pgn_filename>.<job id>.part` by whichever worker receives them
+    # (`feed`), and the indexing thread follows that file until the upload is finished.
+
+    def __init__(self, pgn_filename, fast, total_bytes=None, validate=False, store=None):
+        super().__init__(index_upload, total_bytes, store)
+        self.pgn_filename = pgn_filename
+        self.part_filename = f'{pgn_filename}.{self.id}.part'
+        self.fast = fast
+        self.validate = validate
+        self.final = False
+        open(self.part_filename, 'wb').close()
+        self.reader = ChunkReader(self.part_filename, self.is_final)
+        self.key = None
+        self.publish(partFilename=os.path.abspath(self.part_filename))
+
+    def is_final(self):
+        if not self.final and self.store is not None:
+            self.final = self.store.get_job(self.id).get('final', False)
+        return self.final
+
+    def feed(self, chunk):
+        append_chunk(self.part_filename, chunk)
+
+    def finish(self):
+        self.final = True
+        if self.store is not None:
+            self.store.update_job(self.id, final=True)
+
+    def counted(self, games):
+        for game in games:
+            self.games += 1
+            self.bytes_done = self.reader.bytes_read
+            self.publish(force=False)
+            yield game
+        self.bytes_done = self.reader.bytes_read
+
+def index_upload(job):
+    pgn_text = io.TextIOWrapper(io.BufferedReader(job.reader), encoding='ISO-8859-1')
+    try:
+        trie = make_game_trie(job.counted(read_game_dicts(pgn_text, fast=job.fast, validate=job.validate)))
+    except BaseException:
+        job.reader.close()
+        os.unlink(job.part_filename)
+        raise
+    job.reader.close()
+    get_game_bitmaps(trie)
+    job.key = job.reader.digest.hexdigest()
+    job.pgn_filename = claim_filename(job.part_filename, job.pgn_filename, job.key)
+    return trie
+
+
+class StoredJob:
+    # a job running in another worker, seen through the shared store
+
+    def __init__(self, store, job_id, record):
+        self.store = store
+        self.id = job_id
+        self.record = record
+
+    def progress(self):
+        return self.record['progress']
+
+    def feed(self, chunk):
+        append_chunk(self.record['partFilename'], chunk)
+
+    def finish(self):
+        self.store.update_job(self.id, final=True)
+
+
+class JobManager:
+
+    def __init__(self, store=None):
+        self.jobs = {}
+        self.store = store
+        self.heartbeat_thread = None
+
+    def start(self, job, on_done=None):
+        self.evict()
+        self.jobs[job.id] = job
+        if self.store is not None and self.heartbeat_thread is None:
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+        return job.start(on_done)
+
+    def heartbeat(self):
+        # tells the other workers this process is still running its jobs
+        while True:
+            for job in list(self.jobs.values()):
+                if job.status in ACTIVE_STATUSES:
+                    self.store.update_job(job.id, heartbeat=time.time())
+            self.evict()
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def evict(self):
+        # Finished jobs are dropped along with their result. With a store, polls are
+        # answered from its record once the final progress has been published.
+        retention = HEARTBEAT_INTERVAL if self.store is not None else JOB_RETENTION
+        for job in list(self.jobs.values()):
+            if job.end_t is not None and time.time() - job.end_t > retention:
+                self.jobs.pop(job.id, None)
+
+    def get(self, job_id):
+        if (job := self.jobs.get(job_id)) is not None:
+            return job
+        if self.store is not None and (record := self.store.get_job(job_id)):
+            if record['progress']['status'] in ACTIVE_STATUSES and \
+                    time.time() - record.get('heartbeat', 0) > ORPHAN_TIMEOUT:
+                progress = {**record['progress'], 'status': 'failed', 'error': f"worker {record.get('owner')} stopped"}
+                record = self.store.update_job(job_id, progress=progress)
+            return StoredJob(self.store, job_id, record)
+        return None
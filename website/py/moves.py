@@ -0,0 +1,108 @@
+from collections.abc import Sequence
+import numpy as np
+
+
+class PackedMoves:
+    # The moves of a batch of games in one buffer: game i's moves are
+    # codes[offsets[i]:offsets[i + 1]], each an index into the batch's own
+    # `vocabulary` of SAN strings (uint16, or uint32 past 65536 distinct moves).
+
+    def __init__(self, vocabulary, codes, offsets):
+        self.vocabulary = vocabulary
+        self.codes = codes
+        self.offsets = offsets
+        self.ids = None
+
+    @classmethod
+    def pack(cls, move_lists):
+        codes = {}
+        flat = [codes.setdefault(move, len(codes)) for moves in move_lists for move in moves]
+        offsets = np.zeros(len(move_lists) + 1, dtype=np.int64)
+        np.cumsum([len(moves) for moves in move_lists], out=offsets[1:])
+        dtype = np.uint16 if len(codes) <= 2**16 else np.uint32
+        return cls(list(codes), np.array(flat, dtype=dtype), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return GameMoves(self, i)
+
+    def __getstate__(self):
+        # the trie remapping is local to the process that made it
+        return self.vocabulary, self.codes, self.offsets
+
+    def __setstate__(self, state):
+        self.vocabulary, self.codes, self.offsets = state
+        self.ids = None
+
+    def game_codes(self, i):
+        return self.codes[self.offsets[i]:self.offsets[i + 1]]
+
+    def decode(self, i):
+        vocabulary = self.vocabulary
+        return [vocabulary[code] for code in self.game_codes(i).tolist()]
+
+    def move_ids(self, trie):
+        # the vocabulary as `trie` move ids, so each distinct move is interned once per batch
+        if self.ids is None or self.ids[0] is not trie:
+            self.ids = (trie, np.array([trie.intern(move) for move in self.vocabulary], dtype=np.int32))
+        return self.ids[1]
+
+
+class GameMoves(Sequence):
+    # one game's moves inside a PackedMoves buffer, decoded to SAN only when read
+
+    def __init__(self, packed, i):
+        self.packed = packed
+        self.i = i
+
+    def __len__(self):
+        return int(self.packed.offsets[self.i + 1] - self.packed.offsets[self.i])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.decode()[index]
+        return self.packed.vocabulary[self.packed.game_codes(self.i)[index]]
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(self.decode())
+
+    def decode(self):
+        return self.packed.decode(self.i)
+
+    def ids(self, trie):
+        return self.packed.move_ids(trie)[self.packed.game_codes(self.i)].tolist()
+
+
+class PackedGames(Sequence):
+    # Game dicts of a parsed chunk, as sent back by parse workers: headers stay
+    # dicts and the moves are packed, so a chunk pickles as a few buffers instead
+    # of a string object per ply.
+
+    def __init__(self, headers, moves):
+        self.headers = headers
+        self.moves = moves
+
+    @classmethod
+    def from_game_dicts(cls, game_dicts):
+        headers = [{key: value for key, value in game.items() if key != 'moves'} for game in game_dicts]
+        return cls(headers, PackedMoves.pack([game['moves'] for game in game_dicts]))
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __getitem__(self, i):
+        return {**self.headers[i], 'moves': self.moves[i]}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
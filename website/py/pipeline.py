@@ -0,0 +1,377 @@
+import bz2, io, logging, multiprocessing, os, queue, subprocess, threading, time
+import urllib.error, urllib.request
+from functools import partial
+from pathlib import Path
+from .download import bzip2_command
+from .game import get_stream_chunks, parse_pgn_chunks
+from .index import CompactTrie
+from .trie import make_game_trie
+from .utils import sanitize_url
+
+BLOCK_SIZE = 2**20
+QUEUE_BLOCKS = 16
+CHUNK_SIZE = 2**24
+CHECKPOINT_BYTES = 2**30
+CHECKPOINT_SECONDS = 600
+STATS_INTERVAL = 30
+HTTP_TIMEOUT = 60
+
+DONE = object()
+
+logger = logging.getLogger(__name__)
+
+
+class Stopped(Exception):
+    pass
+
+
+class Stage(threading.Thread):
+    # One step of the pipeline on its own thread. Stages hand blocks on through
+    # bounded queues, so a slow stage makes the ones before it wait; the time spent
+    # waiting to put (blocked: backpressure from downstream) and to get (starved:
+    # upstream too slow) is kept per stage to show where the bottleneck is.
+
+    def __init__(self, name, work=None, inbox=None, stop=None, maxsize=QUEUE_BLOCKS):
+        super().__init__(name=name, daemon=True)
+        self.work = work
+        self.inbox = inbox
+        self.outbox = queue.Queue(maxsize)
+        self.stop = stop or threading.Event()
+        self.items = self.bytes = 0
+        self.blocked = self.starved = 0.0
+        self.start_t = time.time()
+        self.end_t = None
+        self.error = None
+
+    def wait(self, fn):
+        # retries a queue operation until it succeeds or another stage fails
+        while not self.stop.is_set():
+            try:
+                return fn(timeout=0.1)
+            except (queue.Empty, queue.Full):
+                pass
+        raise Stopped(self.name)
+
+    def get(self):
+        t = time.time()
+        item = self.wait(self.inbox.get)
+        self.starved += time.time() - t
+        return item
+
+    def iter_inbox(self):
+        while (item := self.get()) is not DONE:
+            yield item
+
+    def put(self, item, n_bytes=0):
+        t = time.time()
+        self.wait(partial(self.outbox.put, item))
+        self.blocked += time.time() - t
+        self.items += 1
+        self.bytes += n_bytes
+
+    def run(self):
+        self.start_t = time.time()
+        try:
+            self.work(self)
+            self.wait(partial(self.outbox.put, DONE))
+        except Stopped:
+            pass
+        except Exception as err:
+            logger.exception(f'{self.name} stage failed')
+            self.error = err
+            self.stop.set()
+        self.end_t = time.time()
+
+    def stats(self):
+        elapsed = max((self.end_t or time.time()) - self.start_t, 1e-9)
+        return {
+            'stage': self.name,
+            'items': self.items,
+            'MB': self.bytes / 2**20,
+            'MB/s': self.bytes / 2**20 / elapsed,
+            'blocked': self.blocked / elapsed,
+            'starved': self.starved / elapsed,
+            'queued': self.outbox.qsize(),
+        }
+
+
+class BlockReader(io.RawIOBase):
+    # file-like view over an iterator of byte blocks
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.block = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.block:
+            if (block := next(self.blocks, None)) is None:
+                return 0
+            self.block = memoryview(block)
+        n = min(len(b), len(self.block))
+        b[:n] = self.block[:n]
+        self.block = self.block[n:]
+        return n
+
+
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+def open_range(source, start=0):
+    # the bytes of a file or URL from `start` on; HTTP downloads resume with a Range request
+    if not is_url(source):
+        source_file = open(source, 'rb')
+        source_file.seek(start)
+        return source_file
+    request = urllib.request.Request(source, headers={'Range': f'bytes={start}-'} if start else {})
+    response = urllib.request.urlopen(request, timeout=HTTP_TIMEOUT)
+    if start and response.status != 206:
+        # the server ignored the range, so skip to `start` ourselves
+        while start and (skipped := len(response.read(min(start, BLOCK_SIZE)))):
+            start -= skipped
+    return response
+
+def read_blocks(source_file):
+    with source_file:
+        while block := source_file.read(BLOCK_SIZE):
+            yield block
+
+def fetch_blocks(source, start=0, download_filename=None):
+    # Blocks of `source` from byte `start`. With a `download_filename` every byte is
+    # also kept on disk: what an earlier run saved is replayed and only the rest is
+    # requested, and the file loses its .part suffix once the download completes.
+    if download_filename is None:
+        yield from read_blocks(open_range(source, start))
+        return
+    if os.path.exists(download_filename):
+        yield from read_blocks(open(download_filename, 'rb'))
+        return
+    part_filename = f'{download_filename}.part'
+    if os.path.exists(part_filename):
+        yield from read_blocks(open(part_filename, 'rb'))
+    try:
+        source_file = open_range(source, os.path.getsize(part_filename) if os.path.exists(part_filename) else 0)
+    except urllib.error.HTTPError as err:
+        # 416: the range starts at the end, so the earlier run already had every byte
+        if err.code != 416:
+            raise
+    else:
+        with open(part_filename, 'ab') as part_file:
+            for block in read_blocks(source_file):
+                part_file.write(block)
+                yield block
+    os.replace(part_filename, download_filename)
+
+def command_blocks(command, blocks):
+    # pipes `blocks` through a subprocess, feeding it from a thread so its output can be read here
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            for block in blocks:
+                process.stdin.write(block)
+        except Exception as err:
+            errors.append(err)
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    with process.stdout:
+        while block := process.stdout.read(BLOCK_SIZE):
+            yield block
+    feeder.join()
+    if errors:
+        raise errors[0]
+    if process.wait():
+        raise OSError(f'{command[0]} failed with exit code {process.returncode}')
+
+def decompressed_blocks(blocks, processes=None):
+    if command := bzip2_command(processes=processes):
+        yield from command_blocks(command, blocks)
+        return
+    decompressor, in_stream = bz2.BZ2Decompressor(), False
+    for block in blocks:
+        while block:
+            if data := decompressor.decompress(block):
+                yield data
+            block, in_stream = b'', True
+            if decompressor.eof:
+                # the next stream of a multi-stream file
+                block, decompressor, in_stream = decompressor.unused_data, bz2.BZ2Decompressor(), False
+    if in_stream:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def fetch_stage(stage, source, start=0, download_filename=None):
+    for block in fetch_blocks(source, start, download_filename):
+        stage.put(block, len(block))
+
+def decompress_stage(stage, skip=0, processes=None):
+    # bz2 can't be entered mid-stream, so a resumed run decompresses from the start
+    # and drops the `skip` bytes an earlier run already indexed
+    for block in decompressed_blocks(stage.iter_inbox(), processes):
+        if skip:
+            if len(block) <= skip:
+                skip -= len(block)
+                continue
+            block, skip = block[skip:], 0
+        stage.put(block, len(block))
+
+def parse_stage(stage, start=0, processes=None, chunk_size=CHUNK_SIZE, sample=1.0, fast=False, validate=False, seed=None):
+    # parsed games of each game-aligned chunk, with the stream offset the chunk ends at
+    chunks = get_stream_chunks(io.BufferedReader(BlockReader(stage.iter_inbox()), BLOCK_SIZE), chunk_size)
+    offset = start
+    # forked workers would inherit the decompressor's stdin pipe and keep it from ever seeing EOF
+    context = multiprocessing.get_context('spawn')
+    # chunks are seeded by their stream offset, so a resumed run samples the rest of the stream the same way
+    for n_bytes, game_dicts in parse_pgn_chunks(chunks, sample, processes, fast, validate, context, seed, start):
+        offset += n_bytes
+        stage.put((game_dicts, offset), n_bytes)
+
+
+def source_name(source):
+    return source if is_url(source) else os.path.abspath(source)
+
+class Pipeline:
+    # Streams one PGN (or .pgn.bz2) file or URL into an index:
+    #
+    #   fetch -> [decompress ->] parse -> index
+    #
+    # Every stage but the last runs on its own thread, behind a bounded queue.
+    # The index is saved every `checkpoint_bytes` of PGN (or `checkpoint_seconds`)
+    # along with the PGN offset it covers, so an interrupted run starts again from
+    # the last checkpoint: plain PGN is requested from that offset, and compressed
+    # input is kept on disk (resumed with a Range request) and replayed.
+
+    def __init__(self, source, index_filename, download_dir='.', processes=None, decompress_processes=None,
+                 checkpoint_bytes=CHECKPOINT_BYTES, checkpoint_seconds=CHECKPOINT_SECONDS, max_depth=None, **parse_kwargs):
+        from .store import load_index
+        self.source = source
+        self.index_filename = index_filename
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoint_seconds = checkpoint_seconds
+        self.root = load_index(index_filename) if os.path.exists(index_filename) else CompactTrie(max_depth=max_depth).root
+        self.key = f'stream:{source_name(source)}'
+        self.state = self.root.trie.sources.get(self.key, {})
+        self.offset = self.state.get('end', 0)
+        self.games = self.state.get('games', 0)
+        self.complete = self.state.get('complete', False)
+        self.stats_t = time.time()
+
+        self.stop = threading.Event()
+        if source.endswith('.bz2'):
+            download_filename = Path(download_dir) / sanitize_url(source) if is_url(source) else None
+            self.stages = [
+                Stage('fetch', partial(fetch_stage, source=source, download_filename=download_filename), stop=self.stop),
+            ]
+            self.add_stage('decompress', partial(decompress_stage, skip=self.offset, processes=decompress_processes))
+        else:
+            self.stages = [Stage('fetch', partial(fetch_stage, source=source, start=self.offset), stop=self.stop)]
+        self.add_stage('parse', partial(parse_stage, start=self.offset, processes=processes, **parse_kwargs))
+        self.indexer = Stage('index', inbox=self.stages[-1].outbox, stop=self.stop)
+
+    def add_stage(self, name, work):
+        self.stages.append(Stage(name, work, self.stages[-1].outbox, self.stop))
+
+    def segment(self):
+        # parsed games up to the next checkpoint
+        start, start_t = self.offset, time.time()
+        for game_dicts, end in self.indexer.iter_inbox():
+            yield from game_dicts
+            self.indexer.items += len(game_dicts)
+            self.indexer.bytes += end - self.offset
+            self.games += len(game_dicts)
+            self.offset = end
+            if time.time() - self.stats_t > STATS_INTERVAL:
+                self.log_stats()
+            if end - start >= self.checkpoint_bytes or time.time() - start_t >= self.checkpoint_seconds:
+                return
+        self.complete = True
+
+    def checkpoint(self):
+        from .store import save_index
+        from .bitmap import get_game_bitmaps
+        if self.complete:
+            get_game_bitmaps(self.root.trie)
+        self.root.trie.sources[self.key] = {
+            'source': source_name(self.source),
+            'end': self.offset,
+            'games': self.games,
+            'complete': self.complete,
+        }
+        save_index(self.root, self.index_filename)
+        logger.info(f'Checkpoint at {self.offset / 2**20:.1f} MB ({self.games} games)')
+
+    def run(self):
+        if self.complete:
+            logger.info(f'{self.source} already indexed')
+            return self.root, 0
+        if self.offset:
+            logger.info(f'Resuming {self.source} at {self.offset / 2**20:.1f} MB ({self.games} games)')
+        n_games = self.root.trie.n_games
+        for stage in self.stages:
+            stage.start()
+        try:
+            while not self.complete:
+                self.root = make_game_trie(self.segment(), root=self.root)
+                self.checkpoint()
+        except Stopped:
+            # only a failing stage sets `stop` while the index is still reading
+            failed = next(stage for stage in self.stages if stage.error is not None)
+            raise RuntimeError(f'{failed.name} stage failed: {failed.error!r}') from failed.error
+        finally:
+            self.stop.set()
+        self.indexer.end_t = time.time()
+        self.log_stats()
+        return self.root, self.root.trie.n_games - n_games
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages + [self.indexer]]
+
+    def log_stats(self):
+        self.stats_t = time.time()
+        for stats in self.stats():
+            logger.info(f"{stats['stage']:>10}: {stats['MB']:10.1f} MB {stats['MB/s']:7.1f} MB/s  "
+                        f"blocked {stats['blocked']:4.0%}  starved {stats['starved']:4.0%}  queued {stats['queued']}")
+        logger.info(f'{self.games} games')
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('SOURCE', type=str, help="URL or path of a .pgn or .pgn.bz2 file")
+    parser.add_argument('INDEX_FILENAME', type=str, help="the .idx file to add the games to; created if missing")
+    parser.add_argument('-o', "--DOWNLOAD_DIR", type=str, help="where compressed downloads are kept for resuming", default='.')
+    parser.add_argument('-j', "--PROCESSES", type=int, help="number of processes to parse with", default=None)
+    parser.add_argument('-z', "--DECOMPRESS_THREADS", type=int, help="threads for lbzip2/pbzip2", default=None)
+    parser.add_argument('-f', "--FAST", action='store_true', help="tokenize the movetext instead of replaying each game")
+    parser.add_argument('-v', "--VALIDATE", action='store_true', help="check move legality when using --FAST")
+    parser.add_argument('-d', "--MAX_DEPTH", type=int, help="max trie depth for a new index", default=None)
+    parser.add_argument('-c', "--CHECKPOINT_MB", type=int, help="MB of PGN between checkpoints", default=CHECKPOINT_BYTES // 2**20)
+    parser.add_argument('-B', "--BATCH", type=str, help="a report batch file (see py.report) to run on the finished index", default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    pipeline = Pipeline(args.SOURCE, args.INDEX_FILENAME,
+                        download_dir=args.DOWNLOAD_DIR,
+                        processes=args.PROCESSES,
+                        decompress_processes=args.DECOMPRESS_THREADS,
+                        checkpoint_bytes=args.CHECKPOINT_MB * 2**20,
+                        max_depth=args.MAX_DEPTH,
+                        fast=args.FAST,
+                        validate=args.VALIDATE)
+    root, n_games = pipeline.run()
+    print(f"{args.INDEX_FILENAME}: added {n_games} games ({root.trie.n_games} total)")
+
+    if args.BATCH:
+        from .report import read_specs, write_reports
+        fn_base = Path(args.INDEX_FILENAME).name.split('.pgn')[0].split('.idx')[0]
+        for filename in write_reports(args.INDEX_FILENAME, read_specs(args.BATCH), Path('reports') / fn_base,
+                                      ['avg_elo', 'year'], [400, 1], processes=args.PROCESSES):
+            print(f"Wrote {filename}")
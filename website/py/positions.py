@@ -0,0 +1,356 @@
+from collections import defaultdict
+from collections.abc import Mapping
+import chess, chess.polyglot
+import numpy as np
+from .index import RESULT_NAMES
+from .utils import build_lock
+
+HASHER = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def position_key(position):
+    if isinstance(position, (int, np.integer)):
+        return int(position)
+    board = position if isinstance(position, chess.Board) else chess.Board(position)
+    return chess.polyglot.zobrist_hash(board)
+
+def piece_key(piece_type, color, square):
+    return HASHER.array[64 * ((piece_type - 1) * 2 + color) + square]
+
+def push_hashed(board, san, pieces_hash):
+    # push a SAN move, updating the piece part of the Zobrist hash from just the squares it touches
+    move = board.parse_san(san)
+    color, piece_type = board.turn, board.piece_type_at(move.from_square)
+    pieces_hash ^= piece_key(piece_type, color, move.from_square)
+    pieces_hash ^= piece_key(move.promotion or piece_type, color, move.to_square)
+    if board.is_castling(move):
+        rank = move.to_square & ~7
+        rook_from, rook_to = (rank + 7, rank + 5) if board.is_kingside_castling(move) else (rank, rank + 3)
+        pieces_hash ^= piece_key(chess.ROOK, color, rook_from) ^ piece_key(chess.ROOK, color, rook_to)
+    elif board.is_en_passant(move):
+        pieces_hash ^= piece_key(chess.PAWN, not color, move.to_square ^ 8)
+    elif captured := board.piece_type_at(move.to_square):
+        pieces_hash ^= piece_key(captured, not color, move.to_square)
+    board.push(move)
+    return pieces_hash, pieces_hash ^ HASHER.hash_castling(board) ^ HASHER.hash_ep_square(board) ^ HASHER.hash_turn(board)
+
+
+class PositionIndex:
+    # Polyglot Zobrist hash of the position at every trie node, plus the node ids
+    # sorted by hash, so every move order reaching a position is one binary search
+    # away. Node ids only ever grow, so `update` hashes just the nodes added since.
+    # Moves past the trie's max_depth are not indexed.
+
+    def __init__(self, trie, keys=None, order=None):
+        self.trie = trie
+        self.keys = np.zeros(0, dtype=np.uint64) if keys is None else keys
+        self.order = np.zeros(0, dtype=np.int32) if order is None else order
+        self.sorted_keys = self.keys[self.order]
+        self.update()
+
+    def update(self):
+        trie = self.trie
+        if trie.builder:
+            trie.index()
+        start, n = len(self.keys), trie.n_nodes
+        if start == n:
+            return self
+
+        keys = np.zeros(n, dtype=np.uint64)
+        keys[:start] = self.keys
+
+        # only walk into subtrees that contain new nodes
+        parents = trie.parents.tolist()
+        pending = [False] * n
+        for node in range(max(start, 1), n):
+            while node and not pending[node]:
+                pending[node] = True
+                node = parents[node]
+
+        board = chess.Board()
+        keys[0] = position_key(board)
+        root_hash = HASHER.hash_board(board)
+        stack = [(child, root_hash) for child in trie.child_nodes(0).tolist() if pending[child]]
+        while stack:
+            node, pieces_hash = stack.pop()
+            if node < 0:
+                board.pop()
+                continue
+            try:
+                pieces_hash, key = push_hashed(board, trie.moves[trie.node_moves[node]], pieces_hash)
+            except ValueError:
+                # unparseable move (e.g. fast-parsed without validation); its subtree stays unhashed
+                continue
+            if node >= start:
+                keys[node] = key
+            stack.append((-1, None))
+            stack.extend((child, pieces_hash) for child in trie.child_nodes(node).tolist() if pending[child])
+
+        self.keys = keys
+        self.order = np.argsort(keys, kind='stable').astype(np.int32)
+        self.sorted_keys = keys[self.order]
+        return self
+
+    def nodes(self, position):
+        key = np.uint64(position_key(position))
+        lo, hi = np.searchsorted(self.sorted_keys, key, 'left'), np.searchsorted(self.sorted_keys, key, 'right')
+        return self.order[lo:hi]
+
+    def games(self, position):
+        # (rows, plies) of every game reaching the position, each at the first ply it got there
+        if not len(nodes := self.nodes(position)):
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        subtrees = [self.trie.subtree_rows(node) for node in nodes]
+        rows = np.concatenate(subtrees)
+        plies = np.concatenate([np.full(len(rows), self.trie.depths[node]) for node, rows in zip(nodes, subtrees)])
+        by_ply = np.argsort(plies, kind='stable')
+        rows, first = np.unique(rows[by_ply], return_index=True)
+        return rows, plies[by_ply][first]
+
+    def move_orders(self, position):
+        # [(moves, count)] for each distinct move order reaching the position, most played first
+        nodes = self.nodes(position)
+        return sorted(((self.trie.path(node), int(self.trie.counts[node])) for node in nodes), key=lambda x: -x[1])
+
+    def next_move_games(self, position):
+        # {move: [games]} of the move played after reaching the position, over all move orders;
+        # None holds the games that ended there
+        trie = self.trie
+        move_to_games, seen = defaultdict(list), set()
+        for node in sorted(self.nodes(position).tolist(), key=lambda node: trie.depths[node]):
+            branches = [(None, trie.ending_rows(node))]
+            branches += [(trie.moves[trie.node_moves[child]], trie.subtree_rows(child)) for child in trie.child_nodes(node)]
+            for move, rows in branches:
+                for row in rows.tolist():
+                    if row not in seen:
+                        seen.add(row)
+                        move_to_games[move].append(trie.record(row))
+        return dict(move_to_games)
+
+
+class PositionGraph:
+    # Transpositions merged into a graph: one vertex per distinct position and one
+    # edge per (position, move), aggregated from the trie nodes with array
+    # operations over the position index, so no game is replayed. A game that
+    # repeats a position is counted at its first arrival only.
+
+    ARRAYS = ['keys', 'node_positions', 'counts', 'results', 'endings',
+              'edge_offsets', 'edge_moves', 'edge_targets', 'edge_counts', 'edge_results']
+
+    def __init__(self, trie, arrays):
+        self.trie = trie
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, trie):
+        positions = get_position_index(trie)
+        n = trie.n_nodes
+        nodes = np.flatnonzero(positions.keys != 0)
+        keys, inverse = np.unique(positions.keys[nodes], return_inverse=True)
+        node_positions = np.full(n, -1, dtype=np.int32)
+        node_positions[nodes] = inverse
+
+        # a node is nested when an ancestor already reached its position; since subtrees are preorder
+        # ranges, that is a start inside an earlier range of the same position
+        order = np.lexsort((trie.preorder[nodes], inverse))
+        nodes, offset = nodes[order], inverse[order].astype(np.int64) * (n + 1)
+        starts = trie.preorder[nodes] + offset
+        ends = np.maximum.accumulate(trie.preorder[nodes] + trie.sizes[nodes] + offset)
+        first = np.zeros(n, dtype=bool)
+        first[nodes[starts >= np.concatenate([[0], ends[:-1]])]] = True
+
+        n_positions = len(keys)
+        firsts = np.flatnonzero(first)
+        counts = np.bincount(node_positions[firsts], weights=trie.counts[firsts], minlength=n_positions).astype(np.int64)
+        results = np.stack([np.bincount(node_positions[firsts], weights=trie.results[firsts, i], minlength=n_positions)
+                            for i in range(len(RESULT_NAMES))], axis=1).astype(np.int64)
+        game_positions = node_positions[trie.game_nodes]
+        if (mask := getattr(trie, 'mask', None)) is not None:
+            game_positions = game_positions[mask]
+        endings = np.bincount(game_positions[game_positions >= 0], minlength=n_positions).astype(np.int64)
+
+        # edges leave first arrivals only, grouped by (position, move)
+        children = np.flatnonzero(node_positions >= 0)
+        children = children[(children > 0) & first[trie.parents[children]] & (trie.counts[children] > 0)]
+        sources, moves = node_positions[trie.parents[children]], trie.node_moves[children]
+        order = np.lexsort((moves, sources))
+        children, sources, moves = children[order], sources[order], moves[order]
+        groups = np.flatnonzero(np.concatenate([[True], (sources[1:] != sources[:-1]) | (moves[1:] != moves[:-1])]))
+        if len(children):
+            edge_counts = np.add.reduceat(trie.counts[children].astype(np.int64), groups)
+            edge_results = np.add.reduceat(trie.results[children].astype(np.int64), groups, axis=0)
+        else:
+            edge_counts, edge_results = np.zeros(0, dtype=np.int64), np.zeros((0, len(RESULT_NAMES)), dtype=np.int64)
+        edge_offsets = np.zeros(n_positions + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources[groups], minlength=n_positions), out=edge_offsets[1:])
+
+        return cls(trie, {
+            'keys': keys,
+            'node_positions': node_positions,
+            'counts': counts,
+            'results': results,
+            'endings': endings,
+            'edge_offsets': edge_offsets,
+            'edge_moves': moves[groups],
+            'edge_targets': node_positions[children[groups]],
+            'edge_counts': edge_counts,
+            'edge_results': edge_results,
+        })
+
+    @property
+    def root(self):
+        return PositionNode(self, int(self.node_positions[0]))
+
+    def position_id(self, position):
+        key = np.uint64(position_key(position))
+        i = np.searchsorted(self.keys, key)
+        return int(i) if i < len(self.keys) and self.keys[i] == key else None
+
+    def find(self, moves):
+        board = chess.Board()
+        try:
+            for move in moves:
+                board.push_san(move)
+        except ValueError:
+            return None
+        return None if (position := self.position_id(board)) is None else PositionNode(self, position)
+
+    def edges(self, position):
+        return slice(self.edge_offsets[position], self.edge_offsets[position + 1])
+
+    def child(self, position, move):
+        if (move_id := self.trie.move_ids.get(move)) is None:
+            return None
+        edges = self.edges(position)
+        moves = self.edge_moves[edges]
+        i = np.searchsorted(moves, move_id)
+        return int(self.edge_targets[edges][i]) if i < len(moves) and moves[i] == move_id else None
+
+    def child_stats(self, position):
+        edges = self.edges(position)
+        order = np.argsort(-self.edge_counts[edges], kind='stable')
+        moves = [self.trie.moves[move_id] for move_id in self.edge_moves[edges][order]]
+        return moves, self.edge_counts[edges][order], self.edge_results[edges][order]
+
+    def ending_rows(self, position):
+        rows = np.flatnonzero(self.node_positions[self.trie.game_nodes] == position)
+        if (mask := getattr(self.trie, 'mask', None)) is not None:
+            rows = rows[mask[rows]]
+        return rows
+
+    def rows(self, position):
+        return get_position_index(self.trie).games(self.keys[position])[0]
+
+
+class PositionNode(Mapping):
+    # TrieNode-like view of one position of a PositionGraph; children are the moves played from it
+
+    def __init__(self, graph, position):
+        self.graph = graph
+        self.position = position
+
+    @property
+    def trie(self):
+        return self.graph.trie
+
+    @property
+    def count(self):
+        return int(self.graph.counts[self.position])
+
+    @property
+    def results(self):
+        return dict(zip(RESULT_NAMES, self.graph.results[self.position].tolist()))
+
+    def child_stats(self):
+        return self.graph.child_stats(self.position)
+
+    def rows(self):
+        return self.graph.rows(self.position)
+
+    def ending_rows(self):
+        return self.graph.ending_rows(self.position)
+
+    def ending_count(self):
+        return int(self.graph.endings[self.position])
+
+    def games(self):
+        for row in self.rows():
+            yield self.graph.trie.record(row)
+
+    def __getitem__(self, move):
+        if move is None:
+            if not self.ending_count():
+                raise KeyError(move)
+            return [self.graph.trie.record(row) for row in self.ending_rows()]
+        if (child := self.graph.child(self.position, move)) is None:
+            raise KeyError(move)
+        return PositionNode(self.graph, child)
+
+    def __contains__(self, move):
+        if move is None:
+            return self.ending_count() > 0
+        return self.graph.child(self.position, move) is not None
+
+    def __iter__(self):
+        for move_id in self.graph.edge_moves[self.graph.edges(self.position)]:
+            yield self.graph.trie.moves[move_id]
+        if self.ending_count():
+            yield None
+
+    def __len__(self):
+        edges = self.graph.edges(self.position)
+        return edges.stop - edges.start + (self.ending_count() > 0)
+
+    def __repr__(self):
+        return f'PositionNode({self.graph.keys[self.position]:016x}, count={self.count})'
+
+
+def get_position_index(trie):
+    trie = getattr(trie, 'trie', trie)
+    with build_lock:
+        if trie.positions is None:
+            trie.positions = PositionIndex(trie)
+        return trie.positions.update()
+
+def get_position_graph(trie):
+    trie = getattr(trie, 'trie', trie)
+    if trie.graph is None or len(trie.graph.node_positions) != trie.n_nodes:
+        with build_lock:
+            if trie.graph is None or len(trie.graph.node_positions) != trie.n_nodes:
+                trie.graph = PositionGraph.build(trie)
+    return trie.graph
+
+def games_reaching_fen(trie, fen):
+    trie = getattr(trie, 'trie', trie)
+    rows, _ = get_position_index(trie).games(fen)
+    return [trie.record(row) for row in rows]
+
+def find_move_orders_reaching_fen(trie, fen):
+    return get_position_index(trie).move_orders(fen)
+
+
+if __name__ == '__main__':
+
+    from .store import load_index, save_index
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('INDEX_FILENAME', type=str, help="the .idx file to add a position index to")
+    parser.add_argument('-f', "--FEN", type=str, help="print the move orders reaching this FEN", default=None)
+    parser.add_argument('-n', "--N", type=int, help="how many move orders to print", default=10)
+    parser.add_argument('-g', "--GRAPH", action='store_true', help="also build the transposition graph")
+    args = parser.parse_args()
+
+    root = load_index(args.INDEX_FILENAME)
+    if root.trie.positions is None or len(root.trie.positions.keys) < root.trie.n_nodes or \
+            (args.GRAPH and root.trie.graph is None):
+        get_position_index(root)
+        if args.GRAPH:
+            get_position_graph(root)
+        print(f"Wrote {save_index(root, args.INDEX_FILENAME)}")
+
+    if args.FEN:
+        print(f"{len(games_reaching_fen(root, args.FEN))} games reach {args.FEN}")
+        for moves, count in find_move_orders_reaching_fen(root, args.FEN)[:args.N]:
+            print(f"\t{count} {' '.join(moves)}")
@@ -1,9 +1,18 @@
 
+import hashlib, json, logging, os
+from multiprocessing import Pool
+from pathlib import Path
+import matplotlib.pyplot as plt
 from .statistics import get_count_df
 from .game import build_move_df,  get_board_for_moves
-from .trie import filter_trie, get_sub_trie
+from .trie import filter_trie, get_sub_trie, filter_games
 from .viz import plot_count, plot_dist, plot_violin
-from .utils import encode_image
+from .utils import encode_image, sanitize_url
+
+SPEC_FILTERS = ['white', 'black', 'white_moves', 'black_moves']
+VIOLIN_BINS = 10  # violins are drawn from counts this many times finer than the report bins
+
+logger = logging.getLogger(__name__)
 
 def generate_report(move_df, var=None, bin_width=None, map_fn=None, board_filepath=None, line=None, dist_kwargs={}, violin_kwargs={}):
     df = move_df.dropna(subset=[var])
@@ -20,38 +29,178 @@ def generate_report(move_df, var=None, bin_width=None, map_fn=None, board_filepa
     else:
         raise ValueError(var)
 
+    # every plot and table below is drawn from these two count matrices
     count_df = get_count_df(df, by=var, bin_width=bin_width, map_fn=map_fn)
+    fine_count_df = get_count_df(df, by=var, bin_width=bin_width / VIOLIN_BINS, map_fn=map_fn)
     frequency_df = count_df.div(count_df.sum(axis=1), axis=0).round(3)
 
     count_plot = plot_count(count_df, by=var, bin_width=bin_width)
-    distr_plot = plot_dist(df, by=var, bin_width=bin_width, **dist_kwargs)
-    violin_plot = plot_violin(df, by=var, **violin_kwargs)
-    
+    distr_plot = plot_dist(count_df, by=var, bin_width=bin_width, **dist_kwargs)
+    violin_plot = plot_violin(fine_count_df, by=var, **violin_kwargs)
+    images = [encode_image(plot) for plot in (count_plot, distr_plot, violin_plot)]
+    plt.close('all')
+
     return f"""
         <div style="display:block; width:800px;">
             {f'<div><img src={str(board_filepath)} /></div>' if board_filepath else ''}
             {f'<div>{str(line)}</div>' if line else ''}
             <div style="display:flex">
-                <div style="margin:auto;"><img src="data:image/png;base64,{encode_image(count_plot)}" /> </div>
+                <div style="margin:auto;"><img src="data:image/png;base64,{images[0]}" /> </div>
                 <div style="margin:auto;">{count_df.to_html()}</div>
             </div>
             <div style="display:flex">
-                <div style="margin:auto;"><img src="data:image/png;base64,{encode_image(distr_plot)}" /> </div>
+                <div style="margin:auto;"><img src="data:image/png;base64,{images[1]}" /> </div>
                 <div style="margin:auto;">{frequency_df.to_html()}</div>
             </div>
             <div>
-                <div><img src="data:image/png;base64,{encode_image(violin_plot)}"/></div>
+                <div><img src="data:image/png;base64,{images[2]}"/></div>
             </div>
         </div>
     """
 
 
+
+def parse_spec(text):
+    # a batch line is either space-separated moves or a JSON object with
+    # 'line' and/or 'fen' plus any of SPEC_FILTERS
+    if (text := text.strip()).startswith('{'):
+        spec = json.loads(text)
+        if isinstance(spec.get('line'), str):
+            spec['line'] = spec['line'].split()
+        return spec
+    return {'line': text.split()}
+
+def read_specs(filename):
+    with open(filename) as spec_file:
+        return [parse_spec(line) for line in spec_file if line.strip() and not line.lstrip().startswith('#')]
+
+def spec_key(spec, index_id, n):
+    # identifies a report set: the index it was computed from, the line, its filters and the number of moves
+    normalized = {key: sorted(value) if isinstance(value, (set, list)) and key != 'line' else value
+                  for key, value in spec.items() if value}
+    data = json.dumps([index_id, normalized, n], sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
+
+def spec_dirname(spec, key):
+    name = spec.get('fen') or ' '.join(spec.get('line') or []) or 'start'
+    return f"{sanitize_url(name.replace('/', '-').replace(' ', '_'))[:60]}-{key}"
+
+def index_id(filename):
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, int(stat.st_mtime)]
+
+def report_filename(var, bin_width):
+    return f'{var}_{bin_width}_report.html'
+
+
+def get_line_move_df(trie, spec):
+    # (move_df, board) for the position a spec describes
+    filters = {key: spec.get(key) for key in SPEC_FILTERS}
+    for key in ('white_moves', 'black_moves'):
+        if filters[key] is not None:
+            filters[key] = set(filters[key])
+
+    if spec.get('fen'):
+        # every move order reaching the position, looked up in the position index
+        from .positions import get_position_index
+        from .trie import make_game_trie, get_leaves
+        from chess import Board
+        if isinstance(trie, dict):
+            trie = make_game_trie(get_leaves(trie))
+        line_trie = {move: filter_games(games, **filters)
+                     for move, games in get_position_index(trie).next_move_games(spec['fen']).items()}
+        board = Board(spec['fen'])
+    else:
+        line = spec.get('line') or []
+        filtered_trie = filter_trie(trie, moves=line, **filters)
+        line_trie = get_sub_trie(filtered_trie, line)
+        board = get_board_for_moves(line)
+    return build_move_df(line_trie), board
+
+def write_board(board, filepath):
+    from cairosvg import svg2png
+    svg2png(bytestring=board._repr_svg_(), write_to=str(filepath))
+
+def write_line_reports(trie, spec, report_dir, report_vars, bin_widths, n=10):
+    # Writes one HTML report per (var, bin width) into `report_dir`, skipping the
+    # ones already there; the directory name already encodes the index, line,
+    # filters and n, so an existing file is a cache hit.
+    report_dir = Path(report_dir)
+    todo = [(var, bin_width) for var, bin_width in zip(report_vars, bin_widths)
+            if not (report_dir / report_filename(var, bin_width)).exists()]
+    if not todo:
+        logger.info(f"Cached {report_dir}")
+        return []
+
+    move_df, board = get_line_move_df(trie, spec)
+    move_counts = move_df['move'].value_counts()
+    top_moves = move_counts.iloc[:n].index.values.tolist()
+    top_moves_df = move_df[move_df['move'].isin(top_moves)]
+
+    os.makedirs(report_dir, exist_ok=True)
+    if not (board_filepath := report_dir / 'board.png').exists():
+        write_board(board, board_filepath)
+
+    written = []
+    for var, bin_width in todo:
+        logger.info(f"Generating `{var}` report with `bin_width={bin_width}` in {report_dir}")
+        report_html = generate_report(top_moves_df, var=var, bin_width=bin_width, board_filepath='board.png',
+                                      line=spec.get('fen') or spec.get('line'))
+        with open(filepath := report_dir / report_filename(var, bin_width), 'w+t') as report_file:
+            report_file.write(report_html)
+        written.append(str(filepath))
+    return written
+
+
+worker_trie = None
+
+def load_worker_index(filename):
+    # each pool worker opens the index itself; .idx files are memory-mapped, so the pages are shared
+    global worker_trie
+    worker_trie = load_trie(filename)
+
+def run_worker_spec(args):
+    spec, report_dir, report_vars, bin_widths, n = args
+    try:
+        return write_line_reports(worker_trie, spec, report_dir, report_vars, bin_widths, n)
+    except Exception:
+        logger.exception(f"Failed {report_dir}")
+        return []
+
+def load_trie(filename):
+    if filename.endswith('.idx'):
+        from .store import load_index
+        return load_index(filename)
+    with open(filename, 'rb') as trie_file:
+        return json.load(trie_file)
+
+def write_reports(trie_filename, specs, report_root, report_vars, bin_widths, n=10, processes=None, force=False):
+    index = index_id(trie_filename)
+    jobs = []
+    for spec in specs:
+        report_dir = Path(report_root) / spec_dirname(spec, spec_key(spec, index, n))
+        if force:
+            for var, bin_width in zip(report_vars, bin_widths):
+                (report_dir / report_filename(var, bin_width)).unlink(missing_ok=True)
+        jobs.append((spec, report_dir, report_vars, bin_widths, n))
+
+    # in batches a failing spec is reported and skipped; a single report raises
+    if len(jobs) == 1:
+        results = [write_line_reports(load_trie(trie_filename), *jobs[0])]
+    elif processes and processes > 1:
+        with Pool(processes, initializer=load_worker_index, initargs=(trie_filename,)) as pool:
+            results = pool.map(run_worker_spec, jobs, chunksize=1)
+    else:
+        load_worker_index(trie_filename)
+        results = [run_worker_spec(job) for job in jobs]
+    return [filename for written in results for filename in written]
+
 if __name__ == '__main__':
-    import argparse, json
+    import argparse
     from pprint import pprint
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('TRIE_FILENAME', type=str, help="the .trie.json file to load in")
+    parser.add_argument('TRIE_FILENAME', type=str, help="the .idx (or legacy .trie.json) file to load in")
     parser.add_argument('-l', "--LINE", type=lambda x: x.split(' '), help="the line to filter by", default=[])
     parser.add_argument('-w', "--WHITE", type=str, help="the white player to filter by", default=None)
     parser.add_argument('-b', "--BLACK", type=str, help="the black player to filter by", default=None)
@@ -61,46 +210,22 @@ if __name__ == '__main__':
     parser.add_argument('-wm', "--WHITE_MOVES", type=lambda x: set(x.split(' ')), help="(unordered) moves for white to filter by", default=None)
     parser.add_argument('-bm', "--BLACK_MOVES", type=lambda x: set(x.split(' ')), help="(unordered) moves for white to filter by", default=None)
     parser.add_argument('-f', "--FEN", type=str, help="filter for games that reach this FEN", default=None)
+    parser.add_argument('-B', "--BATCH", type=str, help="a file of lines (space-separated moves or JSON specs), one report set each", default=None)
+    parser.add_argument('-j', "--PROCESSES", type=int, help="number of processes to render batch reports with", default=None)
+    parser.add_argument("--FORCE", action='store_true', help="regenerate reports even if they are cached")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     pprint(args)
 
-    with open(args.TRIE_FILENAME, 'rb') as trie_file:
-        trie = json.load(trie_file)
-    
-    filtered_trie = filter_trie(trie,
-                                moves=args.LINE,
-                                white=args.WHITE,
-                                black=args.BLACK)
-    line_trie = get_sub_trie(filtered_trie, args.LINE)
-    board = get_board_for_moves(args.LINE)
-
-    move_df = build_move_df(line_trie)
-
-    move_counts = move_df['move'].value_counts()
-    top_moves = move_counts.iloc[:args.N].index.values.tolist()
-
-    top_moves_df = move_df[move_df['move'].isin(top_moves)]
-
-    print('Move counts:')
-    print(move_counts)
-
-    from pathlib import Path
-    import os
-    fn_base = args.TRIE_FILENAME[:args.TRIE_FILENAME.index('.pgn')]
-    report_dir = Path(f'reports/{fn_base}')
-    os.makedirs(report_dir, exist_ok=True)
-
-    from cairosvg import svg2png
-    board_filepath = report_dir / 'board.png'
-    svg2png(bytestring=board._repr_svg_(), write_to=str(board_filepath))
-
-    for report_var, bin_width in zip(args.REPORT_VARS, args.BIN_WIDTHS):
-        print(f"Generating `{report_var}` report with `bin_width={bin_width}`")
-        report_html = generate_report(top_moves_df, var=report_var, board_filepath='board.png', line=args.LINE)
-        report_var_filename = report_dir / f'{report_var}_report.html'
-        with open(report_var_filename, 'w+t') as report_file:
-            report_file.write(report_html)
-            print(f"Wrote {report_var_filename}")
-    
-    
+    if args.BATCH:
+        specs = read_specs(args.BATCH)
+    else:
+        specs = [{'line': args.LINE, 'fen': args.FEN, 'white': args.WHITE, 'black': args.BLACK,
+                  'white_moves': args.WHITE_MOVES, 'black_moves': args.BLACK_MOVES}]
+
+    fn_base = Path(args.TRIE_FILENAME).name.split('.pgn')[0].split('.idx')[0]
+    written = write_reports(args.TRIE_FILENAME, specs, Path('reports') / fn_base, args.REPORT_VARS, args.BIN_WIDTHS,
+                            n=args.N, processes=args.PROCESSES, force=args.FORCE)
+    for filename in written:
+        print(f"Wrote {filename}")
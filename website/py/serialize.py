@@ -0,0 +1,65 @@
+import json
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STREAM_ITEMS = 2**12
+
+
+def to_builtin(obj):
+    # fallback for whatever the encoder cannot write natively (numpy values for plain json, game records, sets)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, (set, frozenset, Sequence)):
+        return list(obj)
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+if orjson is not None:
+    OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=to_builtin, option=OPTIONS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=to_builtin, separators=(',', ':')).encode()
+
+
+def is_long(value, chunk_items=STREAM_ITEMS):
+    return isinstance(value, (list, tuple, np.ndarray)) and len(value) > chunk_items
+
+def should_stream(obj, chunk_items=STREAM_ITEMS):
+    if isinstance(obj, dict):
+        return any(is_long(value, chunk_items) for value in obj.values())
+    return is_long(obj, chunk_items)
+
+def iter_list(values, chunk_items=STREAM_ITEMS):
+    yield b'['
+    for start in range(0, len(values), chunk_items):
+        chunk = dumps(values[start:start + chunk_items])
+        yield (b',' if start else b'') + chunk[1:-1]
+    yield b']'
+
+def iter_json(obj, chunk_items=STREAM_ITEMS):
+    # the same bytes as dumps(obj), but long lists (at the top level or as values
+    # of a top-level dict) are encoded a chunk at a time
+    if is_long(obj, chunk_items):
+        yield from iter_list(obj, chunk_items)
+    elif isinstance(obj, dict):
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b',' if i else b'{') + dumps(str(key)) + b':'
+            yield from iter_list(value, chunk_items) if is_long(value, chunk_items) else [dumps(value)]
+        yield b'}' if obj else b'{}'
+    else:
+        yield dumps(obj)
@@ -0,0 +1,69 @@
+import json, os, sqlite3, threading, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+"""
+
+
+class SessionStore:
+    # Session and job state shared by every worker process, kept in one SQLite
+    # file (WAL mode, so readers never wait on the single writer). Rows are small
+    # JSON documents; updates merge fields into them inside a transaction.
+
+    def __init__(self, filename='state.db', timeout=30):
+        self.filename = str(filename)
+        self.timeout = timeout
+        self.local = threading.local()
+        if os.path.dirname(self.filename):
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self.connection() as db:
+            db.executescript(SCHEMA)
+
+    def connection(self):
+        # sqlite3 connections can't be shared across threads, so each thread opens its own
+        if (db := getattr(self.local, 'db', None)) is None:
+            db = self.local.db = sqlite3.connect(self.filename, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def get(self, table, key):
+        row = self.connection().execute(f'SELECT data FROM {table} WHERE id = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def update(self, table, key, **fields):
+        # fields set to None are removed
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(f'SELECT data FROM {table} WHERE id = ?', (key,)).fetchone()
+            data = json.loads(row[0]) if row else {}
+            data.update(fields)
+            data = {name: value for name, value in data.items() if value is not None}
+            db.execute(f'INSERT OR REPLACE INTO {table} (id, data, updated) VALUES (?, ?, ?)',
+                       (key, json.dumps(data), time.time()))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return data
+
+    def get_session(self, session_id):
+        return self.get('sessions', session_id)
+
+    def update_session(self, session_id, **fields):
+        return self.update('sessions', session_id, **fields)
+
+    def get_job(self, job_id):
+        return self.get('jobs', job_id)
+
+    def update_job(self, job_id, **fields):
+        return self.update('jobs', job_id, **fields)
+
+    def expire(self, max_age):
+        # drops sessions and jobs untouched for `max_age` seconds
+        cutoff = time.time() - max_age
+        db = self.connection()
+        for table in ('sessions', 'jobs'):
+            db.execute(f'DELETE FROM {table} WHERE updated < ?', (cutoff,))
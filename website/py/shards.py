@@ -0,0 +1,238 @@
+import os
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .index import RESULT_NAMES
+
+SHARD_THREADS = int(os.environ.get('SHARD_THREADS', min(8, os.cpu_count() or 1)))
+
+executor = ThreadPoolExecutor(SHARD_THREADS, thread_name_prefix='shard')
+
+
+def scatter(fn, items):
+    # fn over every item on the shard threads (None items are passed through), in order
+    if len(items) < 2:
+        return [None if item is None else fn(item) for item in items]
+    return list(executor.map(lambda item: None if item is None else fn(item), items))
+
+
+class ShardedGames:
+    # game columns of several shards, addressed by global row
+
+    def __init__(self, index):
+        self.index = index
+
+    @property
+    def n_games(self):
+        return self.index.n_games
+
+    def value(self, key, row):
+        shard, row = self.index.locate(row)
+        return self.index.shards[shard].games.value(key, row)
+
+
+class ShardedIndex:
+    # Several independently built indexes (one per source file or time range) seen
+    # as one: a game's global row is its row in its shard plus the number of games
+    # in the shards before it.
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.offsets = np.zeros(len(shards) + 1, dtype=np.int64)
+        np.cumsum([shard.n_games for shard in shards], out=self.offsets[1:])
+        self.games = ShardedGames(self)
+
+    @property
+    def n_games(self):
+        return int(self.offsets[-1])
+
+    def locate(self, row):
+        # (shard, row within the shard) of a global row
+        shard = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        return shard, int(row - self.offsets[shard])
+
+    def record(self, row):
+        shard, row = self.locate(row)
+        return self.shards[shard].record(row)
+
+    def game_moves(self, row):
+        shard, row = self.locate(row)
+        return self.shards[shard].game_moves(row)
+
+    def game_values(self, fn):
+        # fn(games) computed per shard and concatenated in global row order
+        return np.concatenate(scatter(lambda shard: fn(shard.games), self.shards))
+
+
+class ShardedNode(Mapping):
+    # The same line in every shard (None where a shard never reaches it). Reads
+    # scatter to the shards on a thread pool and merge the counts, so a sharded
+    # index answers like a single TrieNode.
+
+    def __init__(self, index, nodes):
+        self.index = index
+        self.nodes = nodes
+
+    @classmethod
+    def from_roots(cls, roots):
+        return cls(ShardedIndex([root.trie for root in roots]), list(roots))
+
+    @property
+    def trie(self):
+        return self.index
+
+    @property
+    def present(self):
+        return [node for node in self.nodes if node is not None]
+
+    @property
+    def count(self):
+        return sum(node.count for node in self.present)
+
+    @property
+    def results(self):
+        results = dict.fromkeys(RESULT_NAMES, 0)
+        for node in self.present:
+            for name, count in node.results.items():
+                results[name] += count
+        return results
+
+    @property
+    def moves(self):
+        return self.present[0].moves if self.present else []
+
+    def map(self, fn):
+        # fn over each shard's node; None if no shard has a result
+        nodes = scatter(fn, self.nodes)
+        return ShardedNode(self.index, nodes) if any(node is not None for node in nodes) else None
+
+    def filter(self, filter_fn):
+        # filtered views have their own tries, so the global rows are laid out again (they are unchanged)
+        nodes = scatter(filter_fn, self.nodes)
+        return ShardedNode(ShardedIndex([node.trie for node in nodes]), nodes)
+
+    def child_stats(self):
+        totals = {}
+        for stats in scatter(lambda node: node.child_stats(), self.nodes):
+            if stats is None:
+                continue
+            moves, counts, results = stats
+            for move, count, result in zip(moves, np.asarray(counts).tolist(), np.asarray(results).tolist()):
+                if (total := totals.get(move)) is None:
+                    total = totals[move] = [0, [0] * len(RESULT_NAMES)]
+                total[0] += count
+                total[1] = [a + b for a, b in zip(total[1], result)]
+        merged = sorted(totals.items(), key=lambda item: -item[1][0])
+        moves = [move for move, _ in merged]
+        counts = np.array([count for _, (count, _) in merged], dtype=np.int64)
+        results = np.array([result for _, (_, result) in merged], dtype=np.int64).reshape(-1, len(RESULT_NAMES))
+        return moves, counts, results
+
+    def shard_rows(self, rows_fn):
+        rows = scatter(rows_fn, self.nodes)
+        return np.concatenate([shard_rows.astype(np.int64) + self.index.offsets[shard]
+                               for shard, shard_rows in enumerate(rows) if shard_rows is not None] or
+                              [np.zeros(0, dtype=np.int64)])
+
+    def rows(self):
+        return self.shard_rows(lambda node: node.rows())
+
+    def ending_rows(self):
+        return self.shard_rows(lambda node: node.ending_rows())
+
+    def ending_count(self):
+        return sum(node.ending_count() for node in self.present)
+
+    def games(self):
+        for node in self.present:
+            yield from node.games()
+
+    def __getitem__(self, move):
+        if move is None:
+            if not self.ending_count():
+                raise KeyError(move)
+            return [record for node in self.present if None in node for record in node[None]]
+        nodes = [node[move] if node is not None and move in node else None for node in self.nodes]
+        if all(node is None for node in nodes):
+            raise KeyError(move)
+        return ShardedNode(self.index, nodes)
+
+    def __contains__(self, move):
+        return any(move in node for node in self.present)
+
+    def __iter__(self):
+        yield from self.child_stats()[0]
+        if self.ending_count():
+            yield None
+
+    def __len__(self):
+        return len(self.child_stats()[0]) + (self.ending_count() > 0)
+
+    def __repr__(self):
+        return f'ShardedNode({self.moves}, count={self.count}, shards={len(self.nodes)})'
+
+
+def period_key(game, by='month'):
+    # 'YYYY' or 'YYYY-MM' of a game's date, 'unknown' without a year
+    date = (game.get('UTCDate') or game.get('Date') or '').split('.')
+    if not date[0].isdigit():
+        return 'unknown'
+    if by == 'year' or len(date) < 2 or not date[1].isdigit():
+        return date[0]
+    return f'{date[0]}-{date[1]}'
+
+def build_period_shards(games, out_dir, basename, by='month', max_depth=None):
+    # one index per year or month of play, written as `<basename>.<period>.idx`
+    from .index import CompactTrie
+    from .bitmap import get_game_bitmaps
+    from .store import save_index
+    tries = {}
+    for game in games:
+        if (trie := tries.get(key := period_key(game, by))) is None:
+            trie = tries[key] = CompactTrie(max_depth=max_depth)
+        trie.add_game(game)
+    os.makedirs(out_dir, exist_ok=True)
+    filenames = []
+    for key, trie in sorted(tries.items()):
+        trie.index()
+        get_game_bitmaps(trie)
+        filenames.append(save_index(trie, os.path.join(out_dir, f'{basename}.{key}.idx')))
+    return filenames
+
+
+if __name__ == '__main__':
+
+    from .game import games_generator_from_file
+    from .store import load_index
+    from .trie import get_sub_trie, get_move_stats
+    from .shards import ShardedNode
+    import argparse, logging
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='COMMAND', required=True)
+    split = subparsers.add_parser('split', help="index a PGN as one shard per time period")
+    split.add_argument('PGN_FILENAME', type=str, help="the .pgn file to load in")
+    split.add_argument('-o', "--OUT_DIR", type=str, help="where to write the shards", default='.')
+    split.add_argument('-b', "--BY", type=str, choices=['month', 'year'], help="the period of each shard", default='month')
+    split.add_argument('-j', "--PROCESSES", type=int, help="number of processes to parse with", default=None)
+    split.add_argument('-f', "--FAST", action='store_true', help="tokenize the movetext instead of replaying each game")
+    split.add_argument('-d', "--MAX_DEPTH", type=int, help="max trie depth", default=None)
+    query = subparsers.add_parser('query', help="merged next-move counts of a line across shards")
+    query.add_argument('INDEX_FILENAMES', type=str, nargs='+', help="the shard .idx files")
+    query.add_argument('-l', "--LINE", type=lambda x: x.split(' '), help="the line to look up", default=[])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.COMMAND == 'split':
+        games = games_generator_from_file(args.PGN_FILENAME, processes=args.PROCESSES, fast=args.FAST)
+        basename = os.path.basename(args.PGN_FILENAME).split('.pgn')[0]
+        for filename in build_period_shards(games, args.OUT_DIR, basename, args.BY, args.MAX_DEPTH):
+            print(f"Wrote {filename}")
+    else:
+        root = ShardedNode.from_roots([load_index(filename) for filename in args.INDEX_FILENAMES])
+        if (line := get_sub_trie(root, args.LINE)) is None:
+            print(f"No games reach {args.LINE}")
+        else:
+            print(f"{line.count} games in {len(args.INDEX_FILENAMES)} shards")
+            for move, count, results in get_move_stats(line):
+                print(f"{move:8} {count:8} {results}")
@@ -1,13 +1,38 @@
+import numpy as np
 import pandas as pd
-from .utils import round_nearest
+
+
+def bin_numbers(values, bin_width):
+    # index of the nearest multiple of `bin_width` (the rounding round_nearest does)
+    return np.round(np.asarray(values, dtype=float) / bin_width).astype(np.int64)
+
+def count_matrix(values, moves, bin_width):
+    # (bins, moves, counts) where counts[i, j] is the number of games in bins[i] that played moves[j];
+    # bins with no games are left out, like crosstab does
+    keep = ~np.isnan(values) & pd.notna(moves)
+    move_codes, move_names = pd.factorize(moves[keep], sort=True)
+    if not len(move_codes):
+        return np.zeros(0, dtype=np.int64), np.asarray(move_names), np.zeros((0, len(move_names)), dtype=np.int64)
+    bins = bin_numbers(values[keep], bin_width)
+    low = bins.min()
+    n_bins, n_moves = bins.max() - low + 1, len(move_names)
+    counts = np.bincount((bins - low) * n_moves + move_codes, minlength=n_bins * n_moves).reshape(n_bins, n_moves)
+    present = counts.any(axis=1)
+    return (np.arange(low, low + n_bins)[present] * bin_width), np.asarray(move_names), counts[present]
 
 def get_count_df(move_df, by=None, bin_width=10, map_fn=None):
-    move_df = move_df.copy()
-    if map_fn:
-        move_df[by] = map_fn(move_df)
-    move_df[by] = round_nearest(move_df[by], bin_width)
-    group_df = move_df.groupby([by, 'move']).size().reset_index().rename(columns={0: 'count'})
-    return pd.crosstab(group_df[by], group_df['move'], group_df['count'], aggfunc=sum).fillna(0)
+    # (bin x move) counts
+    values = map_fn(move_df) if map_fn else move_df[by]
+    bins, moves, counts = count_matrix(np.asarray(values, dtype=float), move_df['move'].to_numpy(), bin_width)
+    return pd.DataFrame(counts, index=pd.Index(bins, name=by), columns=pd.Index(moves, name='move'))
+
+def expand_counts(count_df):
+    # one (bin, move) row per counted game, for plots that need observations rather than counts
+    stacked = count_df.stack()
+    stacked = stacked[stacked > 0]
+    repeats = stacked.to_numpy()
+    return pd.DataFrame({name: np.repeat(stacked.index.get_level_values(name).to_numpy(), repeats)
+                         for name in stacked.index.names})
 
 def normalize(d, target=1.0):
     raw = sum(d.values())
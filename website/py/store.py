@@ -0,0 +1,156 @@
+import json, os, struct, tempfile
+import numpy as np
+from .index import CompactTrie
+from .positions import PositionIndex, PositionGraph
+from .histograms import NodeHistograms
+from .bitmap import GameBitmaps
+from .table import GameTable, COLUMN_KINDS
+from .utils import IndexFormatError
+
+# Layout: MAGIC, u32 version, u64 header length, JSON header, then every array
+# at an ALIGNMENT-byte boundary. The header records each array's dtype, shape
+# and offset, so loading is a header parse plus zero-copy views into an mmap.
+MAGIC = b'CHESSIDX'
+FORMAT_VERSION = 2
+READABLE_VERSIONS = (1, 2)
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sIQ')
+
+TRIE_ARRAYS = ['parents', 'node_moves', 'depths', 'game_nodes', 'tail_offsets', 'tail_moves', 'counts', 'results',
+               'children', 'child_offsets', 'sizes', 'preorder', 'game_rows', 'game_offsets']
+
+
+def write_arrays(filename, arrays, meta):
+    header = {'arrays': {}, 'meta': meta}
+    offset = 0
+    for name, array in arrays.items():
+        array = arrays[name] = np.ascontiguousarray(array)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(PREAMBLE.size + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    # a unique temporary file next to the target, so processes or threads writing the same index never interleave
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                        prefix=f'{os.path.basename(filename)}.', suffix='.tmp')
+    try:
+        # mkstemp files are owner-only; the index is as readable as any other written file
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as index_file:
+            index_file.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            index_file.write(header_bytes)
+            for name, array in arrays.items():
+                index_file.seek(data_start + header['arrays'][name]['offset'])
+                index_file.write(array.tobytes())
+            index_file.truncate(data_start + offset)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+def read_arrays(filename, mmap=True):
+    with open(filename, 'rb') as index_file:
+        magic, version, header_length = PREAMBLE.unpack(index_file.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise IndexFormatError(f'{filename} is not a chess-analytics index')
+        if version not in READABLE_VERSIONS:
+            raise IndexFormatError(f'{filename} has index format version {version}, expected {FORMAT_VERSION}')
+        header = json.loads(index_file.read(header_length))
+    data_start = -(-(PREAMBLE.size + header_length) // ALIGNMENT) * ALIGNMENT
+
+    if mmap:
+        buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+    else:
+        buffer = np.fromfile(filename, dtype=np.uint8)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        start = data_start + spec['offset']
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).reshape(spec['shape'])
+    return arrays, header['meta']
+
+def save_index(trie, filename):
+    trie = getattr(trie, 'trie', trie)
+    trie.index()
+    arrays = {f'trie/{name}': getattr(trie, name) for name in TRIE_ARRAYS}
+    columns = {}
+    for key, column in trie.games.columns.items():
+        columns[key] = column.kind
+        arrays.update({f'games/{key}/{name}': array for name, array in column.arrays().items()})
+    if trie.positions is not None:
+        trie.positions.update()
+        arrays.update({'positions/keys': trie.positions.keys, 'positions/order': trie.positions.order})
+    if trie.graph is not None and len(trie.graph.node_positions) == trie.n_nodes:
+        arrays.update({f'graph/{name}': getattr(trie.graph, name) for name in PositionGraph.ARRAYS})
+    if trie.histograms is not None and trie.histograms.n_games == trie.n_games:
+        arrays.update({f'hist/{name}': getattr(trie.histograms, name) for name in NodeHistograms.ARRAYS})
+    if trie.bitmaps is not None:
+        if trie.bitmaps.n_games != trie.n_games:
+            trie.bitmaps = GameBitmaps.build(trie)
+        arrays.update({f'bitmaps/{name}': array for name, array in trie.bitmaps.arrays().items()})
+    meta = {
+        'max_depth': trie.max_depth,
+        'moves': trie.moves,
+        'n_games': trie.n_games,
+        'columns': columns,
+        'sources': trie.sources,
+    }
+    write_arrays(filename, arrays, meta)
+    return filename
+
+def load_index(filename, mmap=True):
+    arrays, meta = read_arrays(filename, mmap=mmap)
+
+    trie = CompactTrie.__new__(CompactTrie)
+    trie.max_depth = meta['max_depth']
+    trie.moves = meta['moves']
+    trie.move_ids = {move: move_id for move_id, move in enumerate(trie.moves)}
+    trie.sources = meta.get('sources', {})
+    trie.builder = None
+    for name in TRIE_ARRAYS:
+        setattr(trie, name, arrays[f'trie/{name}'])
+
+    trie.games = GameTable()
+    trie.games.n_games = meta['n_games']
+    for key, kind in meta['columns'].items():
+        prefix = f'games/{key}/'
+        column_arrays = {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+        if kind not in COLUMN_KINDS:
+            raise IndexFormatError(f'Unknown column kind {kind}')
+        trie.games.columns[key] = COLUMN_KINDS[kind].from_arrays(column_arrays)
+
+    trie.positions = None
+    if 'positions/keys' in arrays:
+        trie.positions = PositionIndex(trie, arrays['positions/keys'], arrays['positions/order'])
+    trie.graph = None
+    if 'graph/keys' in arrays:
+        trie.graph = PositionGraph(trie, {name: arrays[f'graph/{name}'] for name in PositionGraph.ARRAYS})
+    trie.histograms = None
+    if 'hist/tables' in arrays:
+        trie.histograms = NodeHistograms(trie, {name: arrays[f'hist/{name}'] for name in NodeHistograms.ARRAYS})
+    trie.bitmaps = None
+    if 'bitmaps/n_games' in arrays:
+        trie.bitmaps = GameBitmaps.from_arrays(trie, {name[len('bitmaps/'):]: array for name, array in arrays.items()
+                                                      if name.startswith('bitmaps/')})
+    return trie.root
+
+def convert_json_trie(json_filename, filename=None):
+    from .trie import make_game_trie, get_leaves
+    with open(json_filename, 'rb') as trie_file:
+        dict_trie = json.load(trie_file)
+    trie = make_game_trie(get_leaves(dict_trie))
+    filename = filename or json_filename.replace('.trie.json', '') + '.idx'
+    return save_index(trie, filename)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('TRIE_FILENAMES', type=str, nargs='+', help="the .trie.json files to convert to .idx files")
+    args = parser.parse_args()
+
+    for trie_filename in args.TRIE_FILENAMES:
+        print(f"Wrote {convert_json_trie(trie_filename)}")
@@ -0,0 +1,286 @@
+from array import array
+from collections.abc import Mapping
+from functools import partial
+import numpy as np
+import pandas as pd
+
+TYPECODES = {np.dtype(dtype): typecode for dtype, typecode in
+             [(np.int8, 'b'), (np.int16, 'h'), (np.int32, 'i'), (np.int64, 'q'), (np.float32, 'f'), (np.float64, 'd')]}
+RESULT_TAGS = ['1-0', '1/2-1/2', '0-1', '*']
+RESULT_CODES = {result: code for code, result in enumerate(RESULT_TAGS)}
+
+
+class IntColumn:
+    # Typed values with a sentinel for missing ones. While a table is being built
+    # `values` is a growable array.array; once frozen or loaded it is a numpy array
+    # (possibly a view into a memory-mapped index), and appending thaws it again.
+    kind = 'int'
+
+    def __init__(self, values=None, dtype=np.int64):
+        self.dtype = np.dtype(dtype if values is None else values.dtype)
+        self.values = array(TYPECODES[self.dtype]) if values is None else values
+
+    @property
+    def missing(self):
+        return np.iinfo(self.dtype).min
+
+    def parse(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return self.missing
+
+    def is_missing(self, value):
+        return value == self.missing
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        value = self.values[i]
+        return None if self.is_missing(value) else int(value)
+
+    def tolist(self):
+        return [self[i] for i in range(len(self))]
+
+    def append(self, value):
+        if isinstance(self.values, np.ndarray):
+            self.values = array(TYPECODES[self.dtype], self.values.tobytes())
+        try:
+            self.values.append(self.missing if value is None else self.parse(value))
+        except OverflowError:
+            self.values.append(self.missing)
+
+    def pad(self, n):
+        for _ in range(n):
+            self.append(None)
+
+    def array(self):
+        return self.values if isinstance(self.values, np.ndarray) else np.frombuffer(self.values, dtype=self.dtype)
+
+    def series(self, rows=None):
+        values = self.array() if rows is None else self.array()[rows]
+        if (missing := self.is_missing(values)).any():
+            return np.where(missing, np.nan, values)
+        return values
+
+    def arrays(self):
+        return {'values': self.array()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['values'])
+
+
+class FloatColumn(IntColumn):
+    kind = 'float'
+
+    def __init__(self, values=None, dtype=np.float64):
+        super().__init__(values, dtype)
+
+    @property
+    def missing(self):
+        return np.nan
+
+    def parse(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return self.missing
+
+    def is_missing(self, value):
+        return np.isnan(value)
+
+    def __getitem__(self, i):
+        value = self.values[i]
+        return None if self.is_missing(value) else float(value)
+
+    def series(self, rows=None):
+        return self.array() if rows is None else self.array()[rows]
+
+
+class ResultColumn(IntColumn):
+    # '1-0', '1/2-1/2', '0-1' and '*' as int8 codes
+    kind = 'result'
+
+    def __init__(self, values=None, dtype=np.int8):
+        super().__init__(values, dtype)
+
+    def parse(self, value):
+        return RESULT_CODES.get(value, self.missing)
+
+    def __getitem__(self, i):
+        value = self.values[i]
+        return None if self.is_missing(value) else RESULT_TAGS[value]
+
+    def series(self, rows=None):
+        codes = self.array() if rows is None else self.array()[rows]
+        return pd.Categorical.from_codes(np.where(self.is_missing(codes), -1, codes), categories=RESULT_TAGS)
+
+
+class StringColumn:
+    # dictionary-encoded strings: per-row int32 codes into categories, stored as one utf-8 blob
+    kind = 'str'
+
+    def __init__(self, codes=None, offsets=None, blob=None):
+        self.codes = array('i') if codes is None else codes
+        self.offsets = offsets
+        self.blob = blob
+        self.categories = [] if blob is None else None
+        self.category_codes = {} if blob is None else None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return None if code < 0 else self.category(code)
+
+    def category(self, code):
+        if self.categories is not None:
+            return self.categories[code]
+        return bytes(self.blob[self.offsets[code]:self.offsets[code + 1]]).decode('utf-8')
+
+    def code(self, value):
+        if self.category_codes is None:
+            self.category_codes = {category: code for code, category in enumerate(self.all_categories())}
+        return self.category_codes.get(value)
+
+    def all_categories(self):
+        if self.categories is None:
+            self.categories = [self.category(code) for code in range(len(self.offsets) - 1)]
+        return self.categories
+
+    def tolist(self):
+        categories = self.all_categories()
+        return [None if code < 0 else categories[code] for code in self.codes_array().tolist()]
+
+    def append(self, value):
+        self.code(None)
+        if isinstance(self.codes, np.ndarray):
+            self.codes = array('i', self.codes.tobytes())
+        if value is None:
+            self.codes.append(-1)
+            return
+        if (code := self.category_codes.get(value := str(value))) is None:
+            code = self.category_codes[value] = len(self.categories)
+            self.categories.append(value)
+        self.codes.append(code)
+
+    def pad(self, n):
+        for _ in range(n):
+            self.append(None)
+
+    def codes_array(self):
+        return self.codes if isinstance(self.codes, np.ndarray) else np.frombuffer(self.codes, dtype=np.int32)
+
+    def series(self, rows=None):
+        codes = self.codes_array() if rows is None else self.codes_array()[rows]
+        return pd.Categorical.from_codes(codes, categories=self.all_categories())
+
+    def arrays(self):
+        encoded = [category.encode('utf-8') for category in self.all_categories()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(category) for category in encoded], out=offsets[1:])
+        return {'codes': self.codes_array(), 'offsets': offsets, 'blob': np.frombuffer(b''.join(encoded), dtype=np.uint8)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['codes'], arrays['offsets'], arrays['blob'])
+
+
+COLUMN_KINDS = {column.kind: column for column in (IntColumn, FloatColumn, ResultColumn, StringColumn)}
+
+SCHEMA = {
+    'WhiteElo': partial(IntColumn, dtype=np.int16),
+    'BlackElo': partial(IntColumn, dtype=np.int16),
+    'WhiteRatingDiff': partial(IntColumn, dtype=np.int16),
+    'BlackRatingDiff': partial(IntColumn, dtype=np.int16),
+    'year': partial(IntColumn, dtype=np.int16),
+    'month': partial(IntColumn, dtype=np.int8),
+    'day': partial(IntColumn, dtype=np.int8),
+    'avg_elo': partial(FloatColumn, dtype=np.float32),
+    'Result': ResultColumn,
+}
+
+def make_column(key, value):
+    if key in SCHEMA:
+        return SCHEMA[key]()
+    if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        return IntColumn()
+    if isinstance(value, (float, np.floating)):
+        return FloatColumn()
+    return StringColumn()
+
+
+class GameTable:
+    # Game headers column by column (see SCHEMA for the typed ones; other headers are
+    # dictionary-encoded strings). Moves live in the trie, not here.
+
+    def __init__(self):
+        self.columns = {}
+        self.n_games = 0
+
+    def __len__(self):
+        return self.n_games
+
+    def append(self, game):
+        n_values = 0
+        for key, value in game.items():
+            if key == 'moves':
+                continue
+            if (column := self.columns.get(key)) is None:
+                column = self.columns[key] = make_column(key, value)
+                column.pad(self.n_games)
+            column.append(value)
+            n_values += 1
+        self.n_games += 1
+        if n_values < len(self.columns):
+            for column in self.columns.values():
+                if len(column) < self.n_games:
+                    column.append(None)
+        return self.n_games - 1
+
+    def value(self, key, i):
+        column = self.columns.get(key)
+        return None if column is None else column[i]
+
+    def row(self, i):
+        # every column, missing values as None, so records have the same keys as the table's frame
+        return {key: column[i] for key, column in self.columns.items()}
+
+    def frame(self, rows=None):
+        # one DataFrame column per table column, built from the typed arrays without per-game dicts
+        return pd.DataFrame({key: column.series(rows) for key, column in self.columns.items()})
+
+
+class GameRecord(Mapping):
+    # a game dict that reads its headers from the table and its moves from the trie on access
+
+    def __init__(self, trie, row):
+        self.trie = trie
+        self.row = row
+
+    def _fields(self):
+        fields = self.trie.games.row(self.row)
+        fields['moves'] = self.trie.game_moves(self.row)
+        return fields
+
+    def __getitem__(self, key):
+        if key == 'moves':
+            return self.trie.game_moves(self.row)
+        if key not in self.trie.games.columns:
+            raise KeyError(key)
+        return self.trie.games.value(key, self.row)
+
+    def __iter__(self):
+        return iter(self._fields())
+
+    def __len__(self):
+        return len(self._fields())
+
+    def copy(self):
+        return self._fields()
+
+    def __repr__(self):
+        return repr(self._fields())
@@ -0,0 +1,59 @@
+import re
+
+TAG = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+TAG_START = re.compile(r'^\[\w+\s+"')
+COMMENT = re.compile(r'\{[^}]*\}|;[^\n]*')
+VARIATION = re.compile(r'\([^()]*\)')
+NAG = re.compile(r'\$\d+')
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+ANNOTATION = re.compile(r'[!?]+$')
+RESULTS = {'1-0', '0-1', '1/2-1/2', '*'}
+SEVEN_TAG_ROSTER = {'Event': '?', 'Site': '?', 'Date': '????.??.??', 'Round': '?', 'White': '?', 'Black': '?', 'Result': '*'}
+
+
+def parse_headers(header_lines):
+    headers = dict(SEVEN_TAG_ROSTER)
+    for line in header_lines:
+        if match := TAG.match(line):
+            headers[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+    return headers
+
+def strip_movetext(movetext):
+    movetext = COMMENT.sub(' ', movetext)
+    n = 1
+    while n:
+        movetext, n = VARIATION.subn(' ', movetext)
+    return NAG.sub(' ', movetext)
+
+def tokenize_movetext(movetext):
+    moves = []
+    for token in strip_movetext(movetext).split():
+        token = MOVE_NUMBER.sub('', token)
+        if not token or token in RESULTS:
+            continue
+        token = ANNOTATION.sub('', token)
+        if token.startswith('0-0'):
+            token = token.replace('0', 'O')
+        moves.append(token)
+    return moves
+
+def iter_game_texts(pgn_file):
+    # yields (header_lines, movetext_lines) for each game without interpreting the movetext
+    header_lines, movetext_lines, in_movetext = [], [], False
+    for line in pgn_file:
+        if TAG_START.match(line):
+            if in_movetext:
+                yield header_lines, movetext_lines
+                header_lines, movetext_lines, in_movetext = [], [], False
+            header_lines.append(line)
+        elif line.strip():
+            movetext_lines.append(line)
+            in_movetext = True
+        elif header_lines:
+            in_movetext = True
+    if header_lines or movetext_lines:
+        yield header_lines, movetext_lines
+
+def iter_games(pgn_file):
+    for header_lines, movetext_lines in iter_game_texts(pgn_file):
+        yield parse_headers(header_lines), tokenize_movetext(''.join(movetext_lines))
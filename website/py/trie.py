@@ -1,8 +1,20 @@
 from .utils import time_profile
+from .index import CompactTrie, TrieNode, RESULTS, RESULT_NAMES
+from .positions import PositionNode
+from .filters import filter_index
+from .shards import ShardedNode
+
+INDEXED_NODES = (TrieNode, PositionNode, ShardedNode)
 
 
 @time_profile
-def make_game_trie(games, root=None):
+def make_game_trie(games, root=None, max_depth=None):
+    if isinstance(root, dict):
+        return make_dict_trie(games, root)
+    trie = root.trie if root is not None else CompactTrie(max_depth=max_depth)
+    return trie.add_games(games).root
+
+def make_dict_trie(games, root=None):
     root = root or dict()
     for game in games:
         current_dict = root
@@ -30,7 +42,9 @@ def get_sub_trie(trie, moves):
     return current_dict
 
 def count_trie(trie):
-    if isinstance(trie, list):
+    if isinstance(trie, INDEXED_NODES):
+        return trie.count
+    elif isinstance(trie, list):
         return len(trie)
     else:
         count = 0
@@ -38,11 +52,31 @@ def count_trie(trie):
             count += count_trie(sub_trie)
         return count
 
+def get_move_stats(trie):
+    # [(move, count, {'white': ..., 'draw': ..., 'black': ...})] for each next move, most played first
+    if isinstance(trie, INDEXED_NODES):
+        moves, counts, results = trie.child_stats()
+        return [(move, int(count), dict(zip(RESULT_NAMES, result)))
+                for move, count, result in zip(moves, counts, results.tolist())]
+
+    stats = []
+    for move, sub_trie in trie.items():
+        if move is None or isinstance(sub_trie, list):
+            continue
+        results = [0] * len(RESULT_NAMES)
+        for game in get_leaves(sub_trie):
+            if (result := RESULTS.get(game.get('Result'))) is not None:
+                results[result] += 1
+        stats.append((move, count_trie(sub_trie), dict(zip(RESULT_NAMES, results))))
+    return sorted(stats, key=lambda x: x[1], reverse=True)
+
 def get_leaves(trie):
     leaves = []
     if isinstance(trie, list):
         for game in trie:
             yield game
+    elif isinstance(trie, INDEXED_NODES):
+        yield from trie.games()
     elif isinstance(trie, dict):
         for move, sub_trie in trie.items():
             for game in get_leaves(sub_trie):
@@ -82,6 +116,11 @@ def filter_games(games,
     return filtered
 
 def filter_trie(trie, **kwargs):
+    if isinstance(trie, TrieNode):
+        return TrieNode(filter_index(trie.trie, **kwargs), trie.node)
+    if isinstance(trie, ShardedNode):
+        return trie.filter(lambda node: filter_trie(node, **kwargs))
+
     new_trie = {}
     
     for move, sub_trie in trie.items():
@@ -96,23 +135,49 @@ if __name__ == '__main__':
 
     from .game import games_generator_from_file
     from .trie import make_game_trie, count_trie
-    import json, argparse
+    from .store import save_index
+    from .bitmap import get_game_bitmaps
+    import json, argparse, logging
 
     parser = argparse.ArgumentParser()
     parser.add_argument('PGN_FILENAME', type=str, help="the .pgn file to load in")
     parser.add_argument('-m', "--MAX_GAMES", type=int, help="max number of moves to extract", default=None)
     parser.add_argument('-s', "--SAMPLE", type=float, help="the frequency with which to sample games", default=1.0)
+    parser.add_argument('-n', "--SAMPLE_SIZE", type=int, help="index this many games chosen at random instead", default=None)
+    parser.add_argument("--SEED", type=int, help="seed for --SAMPLE and --SAMPLE_SIZE", default=None)
     parser.add_argument('-p', "--PRINT_EVERY", type=int, help="how often to log game number", default=100)
+    parser.add_argument('-j', "--PROCESSES", type=int, help="number of processes to parse with", default=None)
+    parser.add_argument('-u', "--UNORDERED", action='store_true', help="merge parsed chunks in completion order")
+    parser.add_argument('-f', "--FAST", action='store_true', help="tokenize the movetext instead of replaying each game")
+    parser.add_argument('-v', "--VALIDATE", action='store_true', help="check move legality when using --FAST")
+    parser.add_argument('-d', "--MAX_DEPTH", type=int, help="max trie depth; later moves are kept with the game", default=None)
+    parser.add_argument('-P', "--POSITIONS", action='store_true', help="also build the position (Zobrist) index")
+    parser.add_argument("--JSON", action='store_true', help="also write the legacy .trie.json")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 
     games_gen = games_generator_from_file(args.PGN_FILENAME,
                                           max_games=args.MAX_GAMES,
                                           sample=args.SAMPLE,
-                                          print_every=args.PRINT_EVERY)
-    trie = make_game_trie(games_gen)
+                                          print_every=args.PRINT_EVERY,
+                                          processes=args.PROCESSES,
+                                          ordered=not args.UNORDERED,
+                                          fast=args.FAST,
+                                          validate=args.VALIDATE,
+                                          sample_size=args.SAMPLE_SIZE,
+                                          seed=args.SEED)
+    trie = make_game_trie(games_gen, max_depth=args.MAX_DEPTH)
     print(count_trie(trie))
+    get_game_bitmaps(trie)
+
+    if args.POSITIONS:
+        from .positions import get_position_index
+        get_position_index(trie)
+
+    print(f"Wrote {save_index(trie, f'{args.PGN_FILENAME}.idx')}")
 
-    with open(trie_filename := f'{args.PGN_FILENAME}.trie.json', 'w+') as trie_file:
-        json.dump(trie, trie_file)
-        print(f"Wrote {trie_filename}")
\ No newline at end of file
+    if args.JSON:
+        with open(trie_filename := f'{args.PGN_FILENAME}.trie.json', 'w+') as trie_file:
+            json.dump(trie.to_dict(), trie_file)
+            print(f"Wrote {trie_filename}")
\ No newline at end of file
@@ -1,8 +1,13 @@
 from pathlib import Path
 import numpy as np
-import time
+import logging, threading, time
 import base64, io
 
+# Position graphs, histograms and bitmaps are built on first use and attached to
+# tries that request threads share, so they are built by one thread at a time.
+# Reentrant, since one structure may need another while it is built.
+build_lock = threading.RLock()
+
 def sanitize_url(url):
     return Path(url).name.translate(dict.fromkeys(map(ord, '?='), '_'))
 
@@ -14,7 +19,7 @@ def time_profile(fn):
         start_t = time.time()
         ret = fn(*args, **kwargs)
         end_t = time.time()
-        print(f'{fn.__name__} took {end_t - start_t:.2f}s')
+        logging.getLogger(fn.__module__).info(f'{fn.__name__} took {end_t - start_t:.2f}s')
         return ret
     return new_fn
 
@@ -26,4 +31,7 @@ def encode_image(img):
     return encoded.decode("utf-8").replace("\n", "")
 
 class EmptyTrieError(Exception):
+    pass
+
+class IndexFormatError(Exception):
     pass
\ No newline at end of file
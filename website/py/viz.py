@@ -4,7 +4,8 @@ sns.set_theme(style="whitegrid")
 sns.set(rc={'figure.figsize':(8, 5)})
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-from .utils import round_nearest
+import numpy as np
+from .statistics import expand_counts
 
 def plot_count(count_df, by=None, bin_width=10, normalize_=False, **kwargs):
     plt.figure()
@@ -30,34 +31,32 @@ def plot_count(count_df, by=None, bin_width=10, normalize_=False, **kwargs):
                     **kwargs)
     return g
 
-def plot_dist(move_df, by=None, bin_width=10, fmt_fn=True, **kwargs):
-    fig, ax = plt.subplots()
-    
-    if by == 'year':
-        move_df = move_df.copy()
-        move_df['year'] = round_nearest(move_df['year'].values + (move_df['month'].values / 12).round(1), bin_width)
+def plot_dist(count_df, by=None, bin_width=10, fmt_fn=True, binrange=None, **kwargs):
+    # stacked share of each move per bin, drawn straight from the count matrix
+    fig, g = plt.subplots()
     
-    g = sns.histplot(ax=ax,
-                     x=by,
-                     y=None,
-                     hue='move',
-                     binwidth=bin_width,
-                     stat='frequency',
-                     multiple='fill',
-                     legend=True,
-                     data=move_df,
-                     **kwargs)
+    frequency_df = count_df.div(count_df.sum(axis=1), axis=0)
+    bottom = np.zeros(len(frequency_df))
+    colors = sns.color_palette(n_colors=len(frequency_df.columns))
+    for move, color in zip(frequency_df.columns, colors):
+        g.bar(frequency_df.index, frequency_df[move], width=bin_width, bottom=bottom, color=color, label=move, **kwargs)
+        bottom += frequency_df[move].to_numpy()
+    g.set_xlabel(by)
+    g.set_ylabel('frequency')
+    g.legend(title='move')
+    if binrange:
+        g.set_xlim(binrange)
     if fmt_fn:
         g.get_xaxis().set_minor_formatter(ticker.FuncFormatter(lambda x, pos: f'{x:g}'))
         g.get_xaxis().set_major_formatter(ticker.FuncFormatter(lambda x, pos: f'{x:g}'))
     return fig
 
-def plot_violin(move_df, by=None, **kwargs):
+def plot_violin(count_df, by=None, **kwargs):
     fig, ax = plt.subplots()
     _ = sns.violinplot(ax=ax,
                        x=by,
                        y='move',
-                       data=move_df,
+                       data=expand_counts(count_df),
                        scale='count',
                        **kwargs)
     return fig
\ No newline at end of file
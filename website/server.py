@@ -1,18 +1,50 @@
-import os
-from flask import Flask, render_template, request, abort, jsonify
+import os, json, logging, threading
+from collections import OrderedDict
+from flask import Flask, Response, render_template, request, abort, jsonify
 from pathlib import Path
 import pandas as pd
 import numpy as np
-import json
-from pprint import pprint
 
 from py.game import games_generator_from_file
-from py.trie import make_game_trie, count_trie, filter_trie, get_sub_trie
+from py.trie import make_game_trie, count_trie, filter_trie, get_sub_trie, get_move_stats
 from py.analysis import get_top_lines
+from py.positions import get_position_graph
+from py.bitmap import get_game_bitmaps
+from py.histograms import RangedNode, RangedPositionNode
+from py.shards import ShardedNode
+from py.gamelist import list_games, encode_cursor, decode_cursor, PAGE_SIZE
+from py.game import make_pgn
+from py.serialize import dumps, iter_json, should_stream
+from py.store import load_index
+from py.cache import IndexCache
+from py.jobs import JobManager, StreamIndexJob, ACTIVE_STATUSES
+from py.sessions import SessionStore
 
 app = Flask(__name__)
 
-app_cache = {}
+# request and response dumps are debug-level, so they are off unless LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger(__name__)
+
+PROCESSES = int(os.environ.get('PROCESSES', 1))
+FAST_PARSE = os.environ.get('FAST_PARSE', '0') == '1'
+POSITION_GRAPH = os.environ.get('POSITION_GRAPH', '0') == '1'
+
+index_cache = IndexCache(cache_dir=os.environ.get('INDEX_CACHE_DIR', 'indexes'),
+                         max_entries=int(os.environ.get('INDEX_CACHE_ENTRIES', 8)),
+                         max_bytes=int(os.environ.get('INDEX_CACHE_BYTES', 0)) or None)
+# session and job state live in SQLite so every worker process sees the same sessions
+sessions = SessionStore(os.environ.get('SESSION_DB', 'state.db'))
+sessions.expire(float(os.environ.get('SESSION_MAX_AGE', 7 * 24 * 3600)))
+job_manager = JobManager(store=sessions)
+# filtered views are per process, rebuilt on demand from the stored filters
+filtered_tries = OrderedDict()
+filtered_lock = threading.Lock()
+FILTERED_CACHE_ENTRIES = int(os.environ.get('FILTERED_CACHE_ENTRIES', 64))
+
+UPLOAD_CHUNK_SIZE = 2**20
+MAX_PAGE_SIZE = 200
 
 @app.route('/')
 def index():
@@ -23,16 +55,122 @@ def detr():
     return render_template('analysis.html')
 
 
-class NpEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        else:
-            return super(NpEncoder, self).default(obj)
+def build_index(pgn_filename, processes=PROCESSES, fast=FAST_PARSE):
+    # a bare .idx (e.g. a shard built elsewhere) is loaded as is
+    if pgn_filename.endswith('.idx'):
+        trie = load_index(pgn_filename)
+    elif Path(index_filename := f'{pgn_filename}.idx').exists():
+        trie = load_index(index_filename)
+    else:
+        games_gen = games_generator_from_file(pgn_filename, processes=processes, fast=fast)
+        trie = make_game_trie(games_gen)
+    # player and move-set bitmaps are saved with the cached index instead of built by the first filter
+    get_game_bitmaps(trie)
+    if POSITION_GRAPH:
+        get_position_graph(trie)
+    return trie
+
+def get_cached_trie(key):
+    # a list of keys is a sharded index, queried across every shard
+    if isinstance(key, list):
+        roots = [index_cache.get(shard_key) for shard_key in key]
+        return None if any(root is None for root in roots) else ShardedNode.from_roots(roots)
+    return index_cache.get(key)
+
+def get_session_trie(session_id):
+    session = sessions.get_session(session_id)
+    if (key := session.get('index')) is None:
+        return None
+    trie = get_cached_trie(key)
+    if trie is None or not (filters := session.get('filters')):
+        return trie
+    signature = (json.dumps(key), json.dumps(filters, sort_keys=True))
+    with filtered_lock:
+        if (cached := filtered_tries.get(session_id)) is not None and cached[0] == signature:
+            filtered_tries.move_to_end(session_id)
+            return cached[1]
+    # filtering runs outside the lock so other sessions aren't held up behind it
+    kwargs = {key: set(value) if key in ('white_moves', 'black_moves') and value is not None else value
+              for key, value in filters.items()}
+    filtered = filter_trie(trie, **kwargs)
+    with filtered_lock:
+        filtered_tries[session_id] = (signature, filtered)
+        filtered_tries.move_to_end(session_id)
+        while len(filtered_tries) > FILTERED_CACHE_ENTRIES:
+            filtered_tries.popitem(last=False)
+    return filtered
+
+def get_line_trie(trie, moves, transpositions=POSITION_GRAPH, elo_range=None, date_range=None):
+    if isinstance(trie, ShardedNode):
+        return trie.map(lambda shard: get_line_trie(shard, moves, transpositions, elo_range, date_range))
+    # with transpositions, the node is the position reached, merged over every move order
+    if transpositions:
+        graph = get_position_graph(trie)
+        if (node := graph.find(moves)) is None or not (elo_range or date_range):
+            return node
+        return RangedPositionNode(graph, node.position, elo_range, date_range)
+    line_trie = get_sub_trie(trie, moves)
+    # Elo/year ranges are answered from per-node histograms instead of re-filtering the index
+    if (elo_range or date_range) and hasattr(line_trie, 'node'):
+        line_trie = RangedNode(line_trie.trie, line_trie.node, elo_range, date_range)
+    return line_trie
+
+def set_session_index(session_id, pgn_filenames):
+    # One file is a plain index; several are kept as shards and queried scatter-gather.
+    # How they are parsed (PROCESSES, FAST_PARSE) is server configuration, never up to the client.
+    if isinstance(pgn_filenames, str):
+        pgn_filenames = [pgn_filenames]
+    keys, roots = zip(*(index_cache.get_or_build(pgn_filename, build_index) for pgn_filename in pgn_filenames))
+    if len(roots) == 1:
+        sessions.update_session(session_id, index=keys[0])
+        return roots[0]
+    sessions.update_session(session_id, index=list(keys))
+    return ShardedNode.from_roots(roots)
+
+
+@app.route('/api/upload', methods=['POST'])
+def api_upload_start():
+    data = request.json
+    if 'sessionID' not in data or 'filename' not in data:
+        return {'message': 'sessionID and filename are required'}, 401
+
+    session_id = data['sessionID']
+    job = StreamIndexJob(Path(data['filename']).name, FAST_PARSE,
+                         total_bytes=data.get('size'),
+                         store=sessions)
+
+    def on_done(job):
+        index_cache.add(job.key, job.result)
+        sessions.update_session(session_id, index=job.key)
+
+    job_manager.start(job, on_done)
+    return {'message': f'Indexing {job.pgn_filename}', 'jobID': job.id}, 201
+
+@app.route('/api/upload/<job_id>', methods=['PUT'])
+def api_upload_chunk(job_id):
+    # chunks may reach any worker; they are appended to the upload file the indexing worker follows
+    if (job := job_manager.get(job_id)) is None or not hasattr(job, 'feed'):
+        return {'message': f'No upload job {job_id}'}, 404
+    if (progress := job.progress())['status'] not in ACTIVE_STATUSES:
+        return {**progress, 'message': f'Upload job {job_id} is {progress["status"]}'}, 409
+    while chunk := request.stream.read(UPLOAD_CHUNK_SIZE):
+        job.feed(chunk)
+    if request.args.get('final'):
+        job.finish()
+    return job.progress(), 201
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job_progress(job_id):
+    if (job := job_manager.get(job_id)) is None:
+        return {'message': f'No job {job_id}'}, 404
+    return job.progress(), 200
+
+
+def json_response(ret, status):
+    # numpy values are encoded natively; responses with long lists are streamed in chunks
+    if should_stream(ret):
+        return Response(iter_json(ret), status=status, mimetype='application/json')
+    return Response(dumps(ret), status=status, mimetype='application/json')
 
 @app.route('/api/analysis', methods=['POST'])
 def api_analysis():
@@ -45,67 +183,123 @@ def api_analysis():
         session_id = data['sessionID']
         action = data['action']
 
-        if session_id not in app_cache:
-            app_cache[session_id] = {}
-
         if action == 'load':
-            pgn = app_cache[session_id]['PGN'] = data['PGN']
+            pgn = data['PGN']
             pgn_filename = data['uploadedPGNFilename']
-            if (pgn_hash := hash(pgn)) != 0:
+            if pgn.strip():
                 if not Path(pgn_filename).exists():
                     with open(pgn_filename, 'w+t') as pgn_file:
                         pgn_file.write(pgn)
-                games_gen = games_generator_from_file(pgn_filename)
-                games = app_cache[session_id]['games'] = list(games_gen)
-                trie = app_cache[session_id]['trie'] = make_game_trie(games)
-                ret = {'message': f'{len(games)} games loaded'}
+                trie = set_session_index(session_id, pgn_filename)
+                ret = {'message': f'{count_trie(trie)} games loaded'}
             else:
                 ret = {'message': f'Provided PGN empty or invalid'}
                 error_code = 201
         
         elif action == 'get-cached-pgn':
-            cached_pgn_filename = data['cachedPGNFilename']
-            games_gen = games_generator_from_file(cached_pgn_filename)
-            games = app_cache[session_id]['games'] = list(games_gen)
-            trie = app_cache[session_id]['trie'] = make_game_trie(games)
-            ret = {'message': f'{len(games)} games loaded'}
+            cached_pgn_filenames = data.get('cachedPGNFilenames') or data['cachedPGNFilename']
+            trie = set_session_index(session_id, cached_pgn_filenames)
+            shards = f' from {len(trie.nodes)} shards' if isinstance(trie, ShardedNode) else ''
+            ret = {'message': f'{count_trie(trie)} games loaded{shards}'}
+
+        elif action == 'set-filters':
+            filters = data.get('filters', {})
+            sessions.update_session(session_id, filters=filters or None)
+            ret = {'message': f'Filtering by {filters}' if filters else 'Filters cleared'}
+
+        elif action == 'cache-stats':
+            ret = {'message': 'Index cache statistics', 'stats': index_cache.stats()}
         
         elif action == 'get-moves':
-            trie = app_cache[session_id].get('trie', {})
-            if not trie:
-                games = app_cache[session_id].get('games', [])
-                if not games:
-                    ret = {'message': 'No PGN loaded'}
-                    return ret, error_code
-                else:
-                    trie = app_cache[session_id]['trie'] = make_game_trie(games)
+            trie = get_session_trie(session_id)
+            if trie is None:
+                ret = {'message': 'No PGN loaded'}
+                return ret, error_code
             moves = data['moves']
-            line_trie = get_sub_trie(trie, moves)
-            counts = {m: count_trie(line_trie[m]) for m in line_trie}
-            next_moves_zipped = sorted(counts.items(), key=lambda x: x[1], reverse=True)
-            next_moves, next_move_counts = list(zip(*next_moves_zipped))
-            total_count = sum(list(counts.values()))
-
-            if None in next_moves:
-                cur_games = line_trie[None]
-                next_moves = tuple(x for x in next_moves if x is not None)
-            else:
-                cur_games = []
+            line_trie = get_line_trie(trie, moves, data.get('transpositions', POSITION_GRAPH),
+                                      data.get('eloRange'), data.get('dateRange'))
+            if line_trie is None:
+                ret = {'message': f'No games reach {moves}', 'nextMoves': [], 'curGamesCount': 0, 'curGamesCursor': None}
+                return ret, error_code
+
+            move_stats = get_move_stats(line_trie)
+            next_moves = tuple(move for move, _, _ in move_stats)
+            total_count = count_trie(line_trie)
+            # games ending here are only counted; list-games pages through them with the cursor
+            n_cur_games = line_trie.ending_count()
+            cursor = encode_cursor({
+                'moves': moves,
+                'transpositions': data.get('transpositions', POSITION_GRAPH),
+                'eloRange': data.get('eloRange'),
+                'dateRange': data.get('dateRange'),
+                'scope': 'ending',
+                'offset': 0,
+            })
 
             ret = {
                 'message': f'{len(next_moves)} moves ({next_moves}) from prefix {moves} totaling {total_count} games' + \
-                            (f' (this includes {len(cur_games)} concluding here)' if len(cur_games) else ''),
+                            (f' (this includes {n_cur_games} concluding here)' if n_cur_games else ''),
                 'nextMoves': next_moves,
-                'curGames': cur_games,
+                'nextMoveCounts': [count for _, count, _ in move_stats],
+                'nextMoveResults': [results for _, _, results in move_stats],
+                'curGamesCount': n_cur_games,
+                'curGamesCursor': cursor if n_cur_games else None,
             }
 
+        elif action == 'list-games':
+            trie = get_session_trie(session_id)
+            if trie is None:
+                ret = {'message': 'No PGN loaded'}
+                return ret, error_code
+            try:
+                page_size = min(int(data.get('pageSize', PAGE_SIZE)), MAX_PAGE_SIZE)
+            except (TypeError, ValueError):
+                page_size = 0
+            if page_size < 1:
+                return {'message': f"pageSize must be a positive number, got {data.get('pageSize')!r}"}, 400
+            state = decode_cursor(data['cursor']) if data.get('cursor') else {'moves': data.get('moves', []), 'offset': 0}
+            # changing the scope or the sort starts over from the first page
+            for key in ('scope', 'sort', 'descending', 'eloRange', 'dateRange'):
+                if key in data and data[key] != state.get(key):
+                    state[key], state['offset'] = data[key], 0
+            line_trie = get_line_trie(trie, state['moves'], state.get('transpositions', POSITION_GRAPH),
+                                      state.get('eloRange'), state.get('dateRange'))
+            offset = state['offset']
+            try:
+                total, games = list_games(line_trie, state.get('scope', 'ending'), state.get('sort'),
+                                          state.get('descending', False), offset, page_size) if line_trie is not None else (0, [])
+            except ValueError as err:
+                return {'message': str(err)}, 400
+            next_offset = offset + len(games)
+            ret = {
+                'message': f'Games {min(offset + 1, total)}-{next_offset} of {total}',
+                'total': total,
+                'games': games,
+                'nextCursor': encode_cursor({**state, 'offset': next_offset}) if next_offset < total else None,
+            }
+
+        elif action == 'get-game-pgn':
+            trie = get_session_trie(session_id)
+            if trie is None:
+                ret = {'message': 'No PGN loaded'}
+                return ret, error_code
+            trie = getattr(trie, 'trie', trie)
+            try:
+                row = int(data['row'])
+            except (KeyError, TypeError, ValueError):
+                return {'message': f"row must be a game number, got {data.get('row')!r}"}, 400
+            if not 0 <= row < trie.n_games:
+                return {'message': f'No game {row}'}, 404
+            ret = {'message': f'Game {row}', 'pgn': make_pgn(trie.record(row))}
+
         elif action == 'top-lines':
-            trie = app_cache[session_id].get('trie', {})
+            trie = get_session_trie(session_id)
             M = data.get('quantity', 5)
             D = data.get('depth', 5)
             moves = data.get('moves', [])
-            line_trie = get_sub_trie(trie, moves)
-            top_lines = get_top_lines(line_trie, max_depth=D)[:M]
+            line_trie = get_line_trie(trie, moves, data.get('transpositions', POSITION_GRAPH),
+                                      data.get('eloRange'), data.get('dateRange'))
+            top_lines = get_top_lines(line_trie, max_depth=D, max_lines=M)
             top_lines_df = pd.DataFrame(line._asdict() for line in top_lines)
             accum_prob = sum(l.score for l in top_lines)
             data = []
@@ -113,11 +307,13 @@ def api_analysis():
             for line in top_lines:
                 data.append([np.round(line.score, 5), list(zip(line.moves, np.round(line.freqs, 3).tolist(), line.counts))])
             ret = {'message': message, 'topLines': data}
-            print('data', data)
+            logger.debug('top lines %s', data)
         
         elif action == 'get-cached-pgn-ids':
             from glob2 import glob
             pgn_filenames = glob('*.pgn')
+            # indexes without their PGN next to them (e.g. shards copied from another machine)
+            pgn_filenames += [filename for filename in glob('*.idx') if filename[:-len('.idx')] not in pgn_filenames]
             message = f"{len(pgn_filenames)} to choose from"
             ret = {'message': message, 'PGNFilenames': pgn_filenames}
 
@@ -126,8 +322,10 @@ def api_analysis():
 
         else:
             ret = {}
-    pprint(ret)
-    return json.dumps(ret, cls=NpEncoder), error_code
+    logger.info(ret.get('message'))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('response %s', ret)
+    return json_response(ret, error_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+import random, sys
+import chess
+import pytest
+
+# pytest imports its own `py` compatibility module before this runs; the app's `py` package
+# (on the path through pytest.ini) has the same name, so drop pytest's from the module cache
+if not hasattr(sys.modules.get('py'), '__path__'):
+    sys.modules.pop('py', None)
+
+from py.game import make_pgn, games_generator_from_file
+from py.trie import make_game_trie, make_dict_trie
+
+# openings that transpose into each other, so the position graph merges move orders
+OPENINGS = [
+    ['e4', 'e5', 'Nf3', 'Nc6'],
+    ['e4', 'c5', 'Nf3'],
+    ['d4', 'd5', 'Nf3'],
+    ['Nf3', 'd5', 'd4'],
+    ['Nc3', 'Nc6', 'Nf3', 'Nf6'],
+    ['Nf3', 'Nf6', 'Nc3', 'Nc6'],
+    ['c4', 'e5'],
+]
+
+
+def random_games(n_games, seed=0):
+    # opening, then a few random moves out of the first three legal ones so lines are shared;
+    # every fifth game has no Elo and every seventh no date
+    rng = random.Random(seed)
+    games = []
+    for i in range(n_games):
+        board, moves = chess.Board(), []
+        for san in rng.choice(OPENINGS) + [None] * rng.randrange(8):
+            if san is None:
+                if board.is_game_over():
+                    break
+                san = rng.choice(sorted(board.san(move) for move in board.legal_moves)[:3])
+            board.push_san(san)
+            moves.append(san)
+        game = {
+            'Event': 'Rated Blitz game',
+            'White': f'player{rng.randrange(6)}',
+            'Black': f'player{rng.randrange(6)}',
+            'Result': rng.choice(['1-0', '1/2-1/2', '0-1']),
+            'TimeControl': rng.choice(['180+0', '300+3']),
+        }
+        if i % 5:
+            game['WhiteElo'], game['BlackElo'] = str(rng.randrange(1000, 2600)), str(rng.randrange(1000, 2600))
+        if i % 7:
+            game['UTCDate'] = f'{2013 + i % 4}.{1 + i % 12:02d}.{1 + i % 28:02d}'
+        game['moves'] = moves
+        games.append(game)
+    return games
+
+
+def write_pgn(filename, games):
+    with open(filename, 'w') as pgn_file:
+        pgn_file.write('\n'.join(make_pgn(game) for game in games))
+    return str(filename)
+
+
+@pytest.fixture(scope='session')
+def pgn_file(tmp_path_factory):
+    return write_pgn(tmp_path_factory.mktemp('pgn') / 'games.pgn', random_games(300))
+
+
+@pytest.fixture(scope='session')
+def games(pgn_file):
+    return list(games_generator_from_file(pgn_file))
+
+
+@pytest.fixture
+def root(games):
+    return make_game_trie(games)
+
+
+@pytest.fixture
+def dict_trie(games):
+    return make_dict_trie(games)
+
+
+@pytest.fixture
+def lines(dict_trie):
+    # every move sequence played in the fixture games
+    def prefixes(trie, moves):
+        yield list(moves)
+        for move, sub_trie in trie.items():
+            if move is not None:
+                yield from prefixes(sub_trie, moves + (move,))
+    return list(prefixes(dict_trie, ()))
@@ -0,0 +1,15 @@
+from py import game
+from py.game import games_generator_from_file
+
+
+def test_chunk_size_reaches_serial_parsing(pgn_file, games, monkeypatch):
+    get_pgn_chunks, chunks = game.get_pgn_chunks, []
+
+    def recorded_chunks(*args, **kwargs):
+        for chunk in get_pgn_chunks(*args, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+    monkeypatch.setattr(game, 'get_pgn_chunks', recorded_chunks)
+    parsed = list(games_generator_from_file(pgn_file, chunk_size=2**12))
+    assert len(chunks) > 10 and all(end - start < 2 * 2**12 for start, end in chunks[:-1])
+    assert [parsed_game['moves'] for parsed_game in parsed] == [parsed_game['moves'] for parsed_game in games]
@@ -0,0 +1,88 @@
+import pytest
+
+from py.game import games_generator_from_file
+from py.trie import make_game_trie, get_sub_trie, get_move_stats
+from py.positions import get_position_graph
+from py.histograms import RangedNode, RangedPositionNode
+from .conftest import random_games, write_pgn
+
+RANGES = [
+    (None, None),
+    ([0, 3500], None),
+    ([None, None], [None, None]),
+    ([1400, 2000], None),
+    ([1000, 3500], None),
+    (None, [None, 2014]),
+    (None, [2015, None]),
+    ([1500, 2500], [2014, 2015]),
+]
+
+
+def in_range(game, elo_range, date_range):
+    # what the slider and date filter mean: a range from 0 keeps unknown Elo, any other bound needs a value
+    if elo_range is not None:
+        low, high = elo_range
+        if low:
+            if game.get('avg_elo') is None or not low <= game['avg_elo'] < (high or 3500):
+                return False
+        elif high and game.get('avg_elo') is not None and game['avg_elo'] >= high:
+            return False
+    if date_range is not None:
+        low, high = date_range
+        if game.get('year') is None or (low and game['year'] < low) or (high and game['year'] > high):
+            return False
+    return True
+
+def expected_stats(games, moves, elo_range, date_range):
+    games = [game for game in games if in_range(game, elo_range, date_range) and game['moves'][:len(moves)] == moves]
+    return make_game_trie(games) if games else None
+
+
+@pytest.mark.parametrize('elo_range,date_range', RANGES)
+def test_ranged_node_counts(root, games, lines, elo_range, date_range):
+    for moves in lines[:200]:
+        node = RangedNode(root.trie, get_sub_trie(root, moves).node, elo_range, date_range)
+        expected = expected_stats(games, moves, elo_range, date_range)
+        expected_node = expected and get_sub_trie(expected, moves)
+        assert node.count == (expected_node.count if expected_node else 0)
+        if expected_node:
+            assert sorted(get_move_stats(node)) == sorted(get_move_stats(expected_node))
+            assert node.results == expected_node.results
+            assert len(node.rows()) == node.count
+
+@pytest.mark.parametrize('elo_range,date_range', RANGES)
+def test_ranged_position_node(root, games, elo_range, date_range):
+    graph = get_position_graph(root)
+    for line in (['d4', 'd5', 'Nf3'], ['Nf3', 'd5', 'd4'], ['e4'], []):
+        node = RangedPositionNode(graph, graph.find(line).position, elo_range, date_range)
+        if (expected := expected_stats(games, [], elo_range, date_range)) is None:
+            assert node.count == 0
+            continue
+        expected_node = get_position_graph(expected).find(line)
+        assert node.count == (expected_node.count if expected_node else 0)
+        if expected_node:
+            assert get_move_stats(node) == get_move_stats(expected_node)
+            assert node.ending_count() == expected_node.ending_count()
+
+def test_unranged_position_node(root):
+    graph = get_position_graph(root)
+    node = graph.find(['e4', 'e5'])
+    ranged = RangedPositionNode(graph, node.position, [0, 3500])
+    assert ranged.count == node.count and get_move_stats(ranged) == get_move_stats(node)
+
+def test_without_elo_tags(tmp_path):
+    games = random_games(50)
+    for game in games:
+        game.pop('WhiteElo', None), game.pop('BlackElo', None)
+    root = make_game_trie(games_generator_from_file(write_pgn(tmp_path / 'no_elo.pgn', games)))
+    assert RangedNode(root.trie, 0, [0, 3500]).count == RangedNode(root.trie, 0, [None, None]).count == 50
+    assert RangedNode(root.trie, 0, [0, 2000]).count == 50
+    assert RangedNode(root.trie, 0, [100, 3500]).count == 0
+
+def test_bin_ranges(root):
+    histograms = RangedNode(root.trie, 0).histograms
+    first_year, last_year = histograms.years.tolist()
+    n_years = last_year - first_year + 1
+    assert histograms.bin_ranges() == histograms.bin_ranges([0, 3500], [None, None])[:1] + ((0, n_years),)
+    assert histograms.bin_ranges(None, [None, None])[1] == (1, n_years)
+    assert histograms.bin_ranges([1400, 2000])[0] == (15, 20)
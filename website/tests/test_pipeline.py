@@ -0,0 +1,98 @@
+import bz2, os
+import pytest
+
+from py import store
+from py.pipeline import Pipeline
+from py.ingest import ingest_files
+from py.store import load_index
+from py.trie import make_game_trie, get_sub_trie, get_move_stats
+
+
+class Crash(Exception):
+    pass
+
+
+def run_pipeline(source, index_filename, **kwargs):
+    return Pipeline(source, index_filename, download_dir=os.path.dirname(index_filename),
+                    checkpoint_bytes=2**14, chunk_size=2**12, **kwargs).run()
+
+def assert_indexes(root, games, lines):
+    expected = make_game_trie(games)
+    assert root.trie.n_games == len(games)
+    for moves in lines:
+        assert get_move_stats(get_sub_trie(root, moves)) == get_move_stats(get_sub_trie(expected, moves))
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_resume_after_crash(pgn_file, games, lines, tmp_path, monkeypatch, compressed):
+    source = pgn_file
+    if compressed:
+        source = str(tmp_path / 'games.pgn.bz2')
+        with open(pgn_file, 'rb') as pgn, bz2.open(source, 'wb') as compressed_file:
+            compressed_file.write(pgn.read())
+    index_filename = str(tmp_path / 'games.idx')
+    checkpoint = Pipeline.checkpoint
+
+    def crash_after_checkpoint(self):
+        checkpoint(self)
+        raise Crash()
+    monkeypatch.setattr(Pipeline, 'checkpoint', crash_after_checkpoint)
+    with pytest.raises(Crash):
+        run_pipeline(source, index_filename)
+    monkeypatch.undo()
+
+    saved = load_index(index_filename).trie
+    state = next(iter(saved.sources.values()))
+    assert 0 < saved.n_games == state['games'] < len(games) and not state['complete']
+    root, n_games = run_pipeline(source, index_filename)
+    assert n_games == len(games) - saved.n_games
+    assert_indexes(load_index(index_filename), games, lines)
+    assert run_pipeline(source, index_filename)[1] == 0
+
+def test_resume_after_interrupted_save(pgn_file, games, lines, tmp_path, monkeypatch):
+    # the second checkpoint dies while writing; the first one is still intact and resumed from
+    index_filename = str(tmp_path / 'games.idx')
+    write_arrays, saves = store.write_arrays, []
+
+    def failing_replace(*args):
+        raise Crash()
+
+    def interrupted_write(filename, arrays, meta):
+        saves.append(meta['n_games'])
+        if len(saves) == 2:
+            monkeypatch.setattr(store.os, 'replace', failing_replace)
+        write_arrays(filename, arrays, meta)
+    monkeypatch.setattr(store, 'write_arrays', interrupted_write)
+    with pytest.raises(Crash):
+        run_pipeline(pgn_file, index_filename)
+    monkeypatch.undo()
+
+    assert os.listdir(tmp_path) == ['games.idx']
+    assert load_index(index_filename).trie.n_games == saves[0] < saves[1]
+    root, n_games = run_pipeline(pgn_file, index_filename)
+    assert n_games == len(games) - saves[0]
+    assert_indexes(load_index(index_filename), games, lines)
+
+
+def test_ingest_rerun_is_a_no_op(pgn_file, games, lines, tmp_path):
+    index_filename = str(tmp_path / 'games.idx')
+    root, n_games = ingest_files(index_filename, [pgn_file])
+    assert n_games == len(games)
+    modified = os.path.getmtime(index_filename)
+    root, n_games = ingest_files(index_filename, [pgn_file])
+    assert n_games == 0 and os.path.getmtime(index_filename) == modified
+    assert_indexes(load_index(index_filename), games, lines)
+
+def test_ingest_grown_file(pgn_file, games, lines, tmp_path):
+    index_filename, grown = str(tmp_path / 'games.idx'), str(tmp_path / 'grown.pgn')
+    data = open(pgn_file, 'rb').read()
+    # the first copy stops partway through a game, which is left for the next run
+    cut = data.index(b'[Event ', len(data) // 2) + 20
+    open(grown, 'wb').write(data[:cut])
+    root, first = ingest_files(index_filename, [grown])
+    assert 0 < first < len(games)
+    open(grown, 'wb').write(data)
+    root, second = ingest_files(index_filename, [grown])
+    assert first + second == len(games)
+    assert_indexes(load_index(index_filename), games, lines)
+    assert ingest_files(index_filename, [grown])[1] == 0
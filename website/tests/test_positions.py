@@ -0,0 +1,63 @@
+from collections import Counter, defaultdict
+import chess, chess.polyglot
+
+from py.index import RESULTS, RESULT_NAMES
+from py.positions import PositionNode, get_position_graph, get_position_index, games_reaching_fen
+
+
+def replay(games):
+    # per position: games reaching it (counted once per game), their results, the move played
+    # after first reaching it, and the games ending there
+    counts, results, edges, endings = Counter(), defaultdict(Counter), defaultdict(Counter), Counter()
+    for game in games:
+        board, seen = chess.Board(), set()
+        for ply in range(len(game['moves']) + 1):
+            if (key := chess.polyglot.zobrist_hash(board)) not in seen:
+                seen.add(key)
+                counts[key] += 1
+                if (result := RESULTS.get(game.get('Result'))) is not None:
+                    results[key][RESULT_NAMES[result]] += 1
+                if ply < len(game['moves']):
+                    edges[key][game['moves'][ply]] += 1
+            if ply < len(game['moves']):
+                board.push_san(game['moves'][ply])
+        endings[key] += 1
+    return counts, results, edges, endings
+
+def positions(moves):
+    board = chess.Board()
+    yield board.copy()
+    for move in moves:
+        board.push_san(move)
+        yield board.copy()
+
+
+def test_graph_matches_replay(root, games):
+    graph = get_position_graph(root)
+    counts, results, edges, endings = replay(games)
+    assert len(graph.keys) == len(counts)
+    for key, count in counts.items():
+        node = PositionNode(graph, graph.position_id(key))
+        assert node.count == count
+        assert node.results == {name: results[key][name] for name in RESULT_NAMES}
+        assert node.ending_count() == endings[key]
+        moves, move_counts, _ = node.child_stats()
+        assert dict(zip(moves, move_counts.tolist())) == dict(edges[key])
+
+def test_transpositions_merge(root):
+    graph = get_position_graph(root)
+    line, transposed = ['d4', 'd5', 'Nf3'], ['Nf3', 'd5', 'd4']
+    node = graph.find(line)
+    assert node.position == graph.find(transposed).position
+    assert node.count == root[line[0]][line[1]][line[2]].count + root[transposed[0]][transposed[1]][transposed[2]].count
+    assert graph.find(['e4', 'e4']) is None and graph.find(['h4', 'h5']) is None
+
+def test_games_reaching_fen(root, games):
+    board = chess.Board()
+    for move in ['Nc3', 'Nc6', 'Nf3', 'Nf6']:
+        board.push_san(move)
+    expected = sorted(game['White'] + game['Black'] + ' '.join(game['moves']) for game in games
+                      if board.fen() in {position.fen() for position in positions(game['moves'])})
+    found = sorted(game['White'] + game['Black'] + ' '.join(game['moves']) for game in games_reaching_fen(root, board.fen()))
+    assert found == expected and len(found) == get_position_graph(root).find(['Nf3', 'Nf6', 'Nc3', 'Nc6']).count
+    assert sum(count for _, count in get_position_index(root).move_orders(board.fen())) >= len(found)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from py import store
+from py.store import save_index, load_index, write_arrays, TRIE_ARRAYS, PREAMBLE
+from py.trie import make_game_trie, get_sub_trie, get_move_stats
+from py.positions import get_position_graph
+from py.histograms import get_histograms, RangedNode
+from py.bitmap import get_game_bitmaps
+from py.utils import IndexFormatError
+
+
+def encode_v1_column(values):
+    # how version 1 files stored a column: int64 or float64 values, or dictionary-encoded strings
+    present = [value for value in values if value is not None]
+    if all(isinstance(value, int) for value in present):
+        return 'int', {'values': np.array([np.iinfo(np.int64).min if value is None else value for value in values], dtype=np.int64)}
+    if all(isinstance(value, (int, float)) for value in present):
+        return 'float', {'values': np.array([np.nan if value is None else value for value in values], dtype=np.float64)}
+    categories = {}
+    codes = np.array([-1 if value is None else categories.setdefault(value, len(categories)) for value in values], dtype=np.int32)
+    encoded = [category.encode('utf-8') for category in categories]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(category) for category in encoded], out=offsets[1:])
+    return 'str', {'codes': codes, 'offsets': offsets, 'blob': np.frombuffer(b''.join(encoded), dtype=np.uint8)}
+
+def save_v1_index(root, filename, monkeypatch):
+    trie = root.trie
+    trie.index()
+    arrays = {f'trie/{name}': getattr(trie, name) for name in TRIE_ARRAYS}
+    columns = {}
+    for key, column in trie.games.columns.items():
+        columns[key], column_arrays = encode_v1_column(column.tolist())
+        arrays.update({f'games/{key}/{name}': array for name, array in column_arrays.items()})
+    monkeypatch.setattr(store, 'FORMAT_VERSION', 1)
+    write_arrays(filename, arrays, {'max_depth': trie.max_depth, 'moves': trie.moves, 'n_games': trie.n_games, 'columns': columns})
+    monkeypatch.undo()
+
+def assert_same_index(loaded, root, lines):
+    assert loaded.trie.n_games == root.trie.n_games
+    for moves in lines:
+        assert get_move_stats(get_sub_trie(loaded, moves)) == get_move_stats(get_sub_trie(root, moves))
+    for row in range(root.trie.n_games):
+        assert loaded.trie.record(row).copy() == root.trie.record(row).copy()
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_round_trip(root, lines, tmp_path, mmap):
+    get_position_graph(root)
+    get_histograms(root)
+    get_game_bitmaps(root.trie)
+    root.trie.sources['games.pgn'] = {'end': 123}
+    loaded = load_index(save_index(root, tmp_path / 'games.idx'), mmap=mmap)
+    assert_same_index(loaded, root, lines)
+    assert loaded.trie.sources == root.trie.sources
+    for name in ('positions', 'graph', 'histograms', 'bitmaps'):
+        assert getattr(loaded.trie, name) is not None
+    assert (loaded.trie.graph.counts == root.trie.graph.counts).all()
+    assert (loaded.trie.histograms.tables == root.trie.histograms.tables).all()
+
+def test_appending_to_a_loaded_index(root, games, lines, tmp_path):
+    loaded = make_game_trie(games[:10], root=load_index(save_index(root, tmp_path / 'games.idx')))
+    assert_same_index(loaded, make_game_trie(games + games[:10]), lines)
+
+def test_version_1(root, lines, tmp_path, monkeypatch):
+    filename = tmp_path / 'v1.idx'
+    save_v1_index(root, filename, monkeypatch)
+    assert PREAMBLE.unpack(open(filename, 'rb').read(PREAMBLE.size))[1] == 1
+    loaded = load_index(filename)
+    assert_same_index(loaded, root, lines)
+    assert loaded.trie.sources == {} and loaded.trie.positions is None
+    for elo_range in ([1400, 2000], [0, 3500]):
+        assert RangedNode(loaded.trie, 0, elo_range).results == RangedNode(root.trie, 0, elo_range).results
+    # saving it again writes the current version
+    assert_same_index(load_index(save_index(loaded, tmp_path / 'v2.idx')), root, lines)
+
+def test_unreadable_files(root, tmp_path):
+    filename = save_index(root, tmp_path / 'games.idx')
+    data = open(filename, 'rb').read()
+    magic, version, header_length = PREAMBLE.unpack(data[:PREAMBLE.size])
+    (tmp_path / 'future.idx').write_bytes(PREAMBLE.pack(magic, version + 1, header_length) + data[PREAMBLE.size:])
+    (tmp_path / 'other.idx').write_bytes(b'NOTANIDX' + data[8:])
+    for name in ('future.idx', 'other.idx'):
+        with pytest.raises(IndexFormatError):
+            load_index(tmp_path / name)
@@ -0,0 +1,49 @@
+from py.game import make_pgn
+from py.report import get_line_move_df
+from py.trie import count_trie, get_sub_trie, get_move_stats, get_leaves, filter_trie
+
+
+def leaf_keys(trie):
+    return sorted((game['White'], game['Black'], tuple(game['moves'])) for game in get_leaves(trie))
+
+
+def test_counts_match_dict_trie(root, dict_trie, lines):
+    assert count_trie(root) == count_trie(dict_trie) == root.trie.n_games
+    for moves in lines:
+        node, sub_trie = get_sub_trie(root, moves), get_sub_trie(dict_trie, moves)
+        assert node is not None
+        assert count_trie(node) == count_trie(sub_trie)
+        assert sorted(get_move_stats(node)) == sorted(get_move_stats(sub_trie))
+        assert node.ending_count() == len(sub_trie.get(None, []))
+
+def test_missing_lines(root, dict_trie):
+    for moves in (['e4', 'e4'], ['h4'], ['e4', 'e5', 'Ke2', 'Ke7', 'Ke1']):
+        assert get_sub_trie(root, moves) is None
+        assert get_sub_trie(dict_trie, moves) is None
+
+def test_games_match_dict_trie(root, dict_trie):
+    for moves in ([], ['e4'], ['Nf3', 'd5'], ['c4', 'e5']):
+        assert leaf_keys(get_sub_trie(root, moves)) == leaf_keys(get_sub_trie(dict_trie, moves))
+
+def test_filter_matches_dict_trie(root, dict_trie, lines):
+    for kwargs in ({'white': 'player1'}, {'black': 'player2'}, {'time_control': '300+3'},
+                   {'white_moves': {'Nf3'}}, {'black_moves': {'Nc6', 'Nf6'}}):
+        filtered, filtered_dict = filter_trie(root, **kwargs), filter_trie(dict_trie, **kwargs)
+        assert 0 < count_trie(filtered) == count_trie(filtered_dict) < count_trie(root)
+        for moves in lines:
+            if (sub_trie := get_sub_trie(filtered_dict, moves)) is not None and count_trie(sub_trie):
+                assert count_trie(get_sub_trie(filtered, moves)) == count_trie(sub_trie)
+                # the dict trie keeps emptied branches, the compact trie skips moves without games
+                expected = [stats for stats in get_move_stats(sub_trie) if stats[1]]
+                assert sorted(get_move_stats(get_sub_trie(filtered, moves))) == sorted(expected)
+        assert leaf_keys(filtered) == leaf_keys(filtered_dict)
+
+def test_records_keep_missing_columns(root, games):
+    # a game without a date still has a (None) year, so a FEN lookup's move_df has the same columns as a line's
+    record = next(record for record in root.games() if record['year'] is None)
+    assert set(record) == set(root.trie.games.columns) | {'moves'}
+    assert make_pgn(record) == make_pgn({key: value for key, value in record.items() if value is not None})
+    fen_df, _ = get_line_move_df(root, {'fen': 'rnbqkbnr/pppppppp/8/8/8/5N2/PPPPPPPP/RNBQKB1R b KQkq - 1 1'})
+    line_df, _ = get_line_move_df(root, {'line': ['Nf3']})
+    assert set(fen_df.columns) - {'moves'} == set(line_df.columns) and {'year', 'avg_elo', 'move'} <= set(fen_df.columns)
+    assert len(fen_df) == len(line_df) == root['Nf3'].count
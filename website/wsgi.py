@@ -0,0 +1,8 @@
+import os
+from werkzeug.middleware.proxy_fix import ProxyFix
+from server import app
+
+# Behind a reverse proxy, trust its X-Forwarded-* headers (one hop by default) so
+# request URLs, schemes and client addresses are the ones the browser used.
+if (proxies := int(os.environ.get('TRUSTED_PROXIES', 1))):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies, x_prefix=proxies)